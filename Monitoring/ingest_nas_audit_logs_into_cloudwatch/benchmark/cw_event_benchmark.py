@@ -0,0 +1,122 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program measures how many audit events per second createCWEvent() in
+# ingest_audit_log.py can convert into CloudWatch events. It doesn't go
+# through the ONTAP API or any AWS services. The events are generated in the
+# same form the XML parser returns them, and handed directly to the function.
+#
+# To compare against another version of ingest_audit_log.py, pass its path
+# with the --script option. For example, to compare against the previous
+# commit:
+#   git show HEAD~1:./ingest_audit_log.py > /tmp/ingest_audit_log_before.py
+#   python3 cw_event_benchmark.py --script /tmp/ingest_audit_log_before.py
+#
+# It requires the packages in the Lambda layer, and boto3. For example:
+#   pip install boto3 requests requests_toolbelt
+#   python3 cw_event_benchmark.py --events 200000 --runs 3
+################################################################################
+
+import argparse
+import datetime
+import importlib.util
+import os
+import time
+
+os.environ["AWS_LAMBDA_FUNCTION_NAME"] = "benchmark"  # Keeps the module from running the handler when imported.
+
+################################################################################
+# This function returns an audit event, in the form returned by the XML
+# parser. The events cycle through the different kinds of data fields found
+# in the audit logs.
+################################################################################
+def makeEvent(i, eventTime):
+    kind = i % 4
+    if kind == 0:
+        data = [{'@Name': 'SubjectIP', '@IPVersion': '4', '#text': f'10.0.{i % 250}.{i % 200}'},
+                {'@Name': 'SubjectUnix', '@Uid': str(i % 1000), '@Gid': '0', '@Local': 'false'},
+                {'@Name': 'ObjectServer', '#text': 'Security'},
+                {'@Name': 'ObjectType', '#text': 'File'},
+                {'@Name': 'HandleID', '#text': '00000000000442;00;00000040;04e81b0c'},
+                {'@Name': 'ObjectName', '#text': f'(audit_logs);/dir{i % 10}/file{i}.txt'},
+                {'@Name': 'InformationRequested', '#text': 'File Type; File Size'}]
+    elif kind == 1:
+        data = [{'@Name': 'SubjectIP', '@IPVersion': '4', '#text': f'10.1.{i % 250}.1'},
+                {'@Name': 'SubjectUserSid', '#text': f'S-1-5-21-{i}'},
+                {'@Name': 'SubjectUserIsLocal', '#text': 'false'},
+                {'@Name': 'SubjectDomainName', '#text': 'CORP'},
+                {'@Name': 'SubjectUserName', '#text': f'user{i % 50}'},
+                {'@Name': 'ObjectServer', '#text': 'Security'},
+                {'@Name': 'ObjectType', '#text': 'Directory'},
+                {'@Name': 'FileName', '#text': f'(vol1);/share/dir{i}'},
+                {'@Name': 'InformationSet'}]
+    elif kind == 2:
+        data = [{'@Name': 'SubjectIP', '@IPVersion': '4', '#text': f'10.2.0.{i % 250}'},
+                {'@Name': 'SubjectPort', '#text': str(1000 + i % 5000)},
+                {'@Name': 'ObjectName', '#text': f'(vol2);/a/b/c{i}'},
+                {'@Name': 'InformationSet', '#text': 'Attributes'},
+                {'@Name': 'AccessMask', '#text': '2'}]
+    else:
+        data = [{'@Name': 'SubjectUserName', '#text': f'user{i}'},
+                {'@Name': 'ObjectName', '#text': f'(vol3);/x{i}'},
+                {'@Name': 'InformationSet', '#text': f'Set{i}'},
+                {'@Name': 'Size', '#text': str(i * 3)}]
+
+    return {
+        'System': {
+            'Provider': {'@Name': 'NetApp-Security-Auditing', '@Guid': '{3CB2A168-FE19-4A4E-BDAD-DCF422F13473}'},
+            'EventID': '4663',
+            'EventName': ['Open Object', 'Read Object', 'Write Object', 'Get Object Attributes'][kind],
+            'Version': '101.3',
+            'Source': 'CIFS',
+            'Level': '0',
+            'Opcode': '0',
+            'Keywords': '0x8020000000000000',
+            'Result': 'Audit Success' if i % 9 else 'Audit Failure',
+            'TimeCreated': {'@SystemTime': eventTime.strftime('%Y-%m-%dT%H:%M:%S.') + f'{(i * 7919) % 1000000000:09d}Z'},
+            'Correlation': None,
+            'Channel': 'Security',
+            'Computer': 'fsx1/svm1',
+            'ComputerUUID': 'abc',
+            'Security': None
+        },
+        'EventData': {'Data': data}
+    }
+
+################################################################################
+# Main logic starts here.
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion of audit events into CloudWatch events by ingest_audit_log.py.")
+    parser.add_argument("--events", type=int, default=200000, help="Number of audit events.")
+    parser.add_argument("--eventsPerSecond", type=int, default=50, help="Number of audit events generated for each second of time.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of times to convert the events.")
+    parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ingest_audit_log.py"), help="Path of the ingest_audit_log.py to benchmark.")
+    args = parser.parse_args()
+
+    spec = importlib.util.spec_from_file_location("ingest_audit_log", args.script)
+    ingest_audit_log = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ingest_audit_log)
+
+    startTime = datetime.datetime(2024, 9, 22, 21, 5, 27)
+    events = [makeEvent(i, startTime + datetime.timedelta(seconds=i // args.eventsPerSecond)) for i in range(args.events)]
+
+    print(f'{"run":>3} {"seconds":>8} {"events/s":>10}')
+    for run in range(args.runs):
+        startTime = time.perf_counter()
+        for event in events:
+            ingest_audit_log.createCWEvent(event)
+        elapsed = time.perf_counter() - startTime
+        print(f'{run:>3} {elapsed:>8.3f} {args.events / elapsed:>10,.0f}')
@@ -4,8 +4,9 @@
 # This script is used to ingest all the NAS audit logs from all the FSx for
 # ONTAP File Systems from the specified volume into a specified CloudWatch log
 # group. It will create a log stream for each FSxN audit logfile it finds.
-# It will attempt to process every FSxN within the region. It leverage AWS
-# secrets manager to get the credentials for the fsxadmin user on each FSxNs.
+# It will attempt to process every FSxN within the region. The FSxNs, and
+# their SVMs, are processed concurrently. It leverage AWS secrets manager to
+# get the credentials for the fsxadmin user on each FSxNs.
 # It will store the last read file for each FSxN in the specified S3 bucket so
 # that it will not process the same file twice. It will skip any FSxN file
 # system that it doesn't have credentials for. It will also skip any FSxN file
@@ -22,12 +23,18 @@
 from requests_toolbelt.multipart import decoder
 import urllib3
 import datetime
-import xmltodict
+import xml.etree.ElementTree
+import re
 import os
 import json
+import tempfile
+import collections
+import concurrent.futures
+import threading
 from urllib3.util import Retry
 import boto3
 import botocore
+import botocore.config
 
 ################################################################################
 # You can configure this script by either setting the following variables in
@@ -108,6 +115,35 @@ import botocore
 # If you want the program to copy all the raw audit files into the S3 bucket,
 # then set this to the string "true". It will be converted to a boolean later.
 # copyToS3 = "true"
+#
+# The number of blocks of an audit file to download at the same time.
+# downloadThreads = "4"
+#
+# The number of batches of events to send to CloudWatch at the same time.
+# cloudWatchThreads = "4"
+#
+# The number of SVMs to process at the same time, across all the FSxNs, and
+# the most of them to process at the same time on a single FSxN.
+# svmThreads = "8"
+# svmThreadsPerFileSystem = "4"
+
+################################################################################
+# The largest block ONTAP will return from a file read, and the smallest a
+# block will be reduced to when retrying a failed read.
+################################################################################
+maxBlockSize = 1024*1024
+minBlockSize = 64*1024
+maxBlockRetries = 4
+
+################################################################################
+# The limits of a CloudWatch put_log_events call. The size of a batch is the
+# sum of the size of the messages, in bytes, plus 26 bytes for each event.
+# A batch can't span more than 24 hours, so stop 5 minutes short of that.
+################################################################################
+maxBatchBytes = 1048576
+maxBatchEvents = 10000
+eventOverheadBytes = 26
+maxBatchSpan = 86100000
 
 ################################################################################
 # This function returns the epoch time from the filename. It assumes the
@@ -127,196 +163,630 @@ def getEpoch(filename):
     return datetime.datetime(year, month, day, hour, minute, second).timestamp()
 
 ################################################################################
-# This function copies a file from the FSxN file system, using the ONTAP
-# APIs, and then calls the ingestAuditFile function to upload the audit
-# log entires to the CloudWatch log group.
+# This function reads up to 'length' bytes, starting at 'offset', from a file
+# on the FSxN file system using the ONTAP APIs. It returns the data read,
+# which can be less than what was requested, and is empty once the end of the
+# file has been reached. It raises an exception if the API call fails.
 ################################################################################
-def readFile(ontapAdminServer, headers, volumeUUID, filePath):
+def readBlock(ontapAdminServer, headers, volumeUUID, filePath, offset, length):
     global http
+
+    endpoint = f'https://{ontapAdminServer}/api/storage/volumes/{volumeUUID}/files/{filePath}?length={length}&byte_offset={offset}'
+    response = http.request('GET', endpoint, headers=headers, timeout=5.0)
+    if response.status != 200:
+        raise Exception(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+    data = response.data
     #
-    # Create the tempoary file to hold the contents from the ONTAP/FSxN file.
-    tmpFileName = "/tmp/testout"
-    f = open(tmpFileName, "wb")
+    # Get the multipart boundary separator from the first part of the file.
+    boundary = data[4:20].decode('utf-8')
     #
-    # Number of bytes to read for each API call.
-    blockSize=1024*1024
-
-    failed = False
-    bytesRead = 0
-    requestSize = 1   # Set to > 0 to start the loop.
-    while requestSize > 0:
-        endpoint = f'https://{ontapAdminServer}/api/storage/volumes/{volumeUUID}/files/{filePath}?length={blockSize}&byte_offset={bytesRead}'
-        response = http.request('GET', endpoint, headers=headers, timeout=5.0)
-        if response.status == 200:
-            bytesRead += blockSize
-            data = response.data
-            #
-            # Get the multipart boundary separator from the first part of the file.
-            boundary = data[4:20].decode('utf-8')
-            #
-            # Get MultipartDecoder to decode the data.
-            contentType = f"multipart/form-data; boundary={boundary}"
-            multipart_data = decoder.MultipartDecoder(data, contentType)
-            #
-            # The first part returned from ONTAP contains the amount of data in the response. When it is 0, we have read the entire file.
-            firstPart = True
-            for part in multipart_data.parts:
-                if(firstPart):
-                    requestSize = int(part.text)
-                    firstPart = False
-                else:
-                    f.write(part.content)
+    # Get MultipartDecoder to decode the data.
+    contentType = f"multipart/form-data; boundary={boundary}"
+    multipart_data = decoder.MultipartDecoder(data, contentType)
+    #
+    # The first part returned from ONTAP contains the amount of data in the response. When it is 0, we have read the entire file.
+    content = b''
+    firstPart = True
+    for part in multipart_data.parts:
+        if(firstPart):
+            if int(part.text) == 0:
+                return b''
+            firstPart = False
         else:
-            print(f'Warning: API call to {endpoint} failed. HTTP status code: {response.status}.')
+            content += part.content
+    return content
+
+################################################################################
+# This function reads the bytes from 'offset' up to 'end' of a file on the
+# FSxN file system, and returns them. If fewer bytes are returned, the end of
+# the file was reached first. A failed read is retried from the last byte
+# successfully read, with a smaller block size, which is grown back after
+# each successful read. It raises an exception if the reads keep failing.
+################################################################################
+def readRange(ontapAdminServer, headers, volumeUUID, filePath, offset, end):
+    blockSize = maxBlockSize
+    failures = 0
+    data = b''
+    while offset < end:
+        try:
+            content = readBlock(ontapAdminServer, headers, volumeUUID, filePath, offset, min(blockSize, end - offset))
+        except Exception as err:
+            failures += 1
+            if failures > maxBlockRetries:
+                raise Exception(f'Failed to read {filePath} at offset {offset}: {err}')
+            blockSize = max(blockSize // 2, minBlockSize)
+            continue
+
+        if len(content) == 0:
             break
+        data += content
+        offset += len(content)
+        blockSize = min(blockSize * 2, maxBlockSize)
+        failures = 0
+    return data
 
-    f.close()
-    if failed:
-        os.remove(tmpFileName)
-        return None
-    else:
-        return tmpFileName
-        #
-        # Upload the audit events to CloudWatch.
+################################################################################
+# This function reads a file from the FSxN file system, using the ONTAP APIs,
+# and yields its contents, in order, a block at a time. If the size of the
+# file is known, the blocks are read concurrently, in the background, up to
+# twice downloadThreads blocks ahead of the one being processed. That way the
+# file is downloaded while it is being processed, and only a few blocks of it
+# are held in memory at a time. It raises an exception if the file can't be
+# read.
+################################################################################
+def readFile(ontapAdminServer, headers, volumeUUID, filePath, fileSize=None):
+    global config
+
+    offset = 0
+    if fileSize is not None and fileSize > 0:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=config['downloadThreads'])
+        try:
+            ranges = iter(range(0, fileSize, maxBlockSize))
+            pending = collections.deque()
+            while True:
+                #
+                # Keep the blocks ahead of this one being read.
+                while len(pending) < 2 * config['downloadThreads']:
+                    start = next(ranges, None)
+                    if start is None:
+                        break
+                    end = min(start + maxBlockSize, fileSize)
+                    pending.append((end, executor.submit(readRange, ontapAdminServer, headers, volumeUUID, filePath, start, end)))
+                if len(pending) == 0:
+                    break
+                end, future = pending.popleft()
+                data = future.result()
+                yield data
+                offset += len(data)
+                if offset < end:
+                    #
+                    # The file is shorter than it was when it was listed.
+                    return
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    #
+    # Read anything added to the file since it was listed, or the whole file
+    # if its size isn't known.
+    while True:
+        data = readRange(ontapAdminServer, headers, volumeUUID, filePath, offset, offset + maxBlockSize)
+        if len(data) == 0:
+            break
+        yield data
+        offset += len(data)
+
+################################################################################
+# This function yields the blocks passed to it, after writing them to the
+# file passed in.
+################################################################################
+def copyBlocks(blocks, f):
+    for data in blocks:
+        f.write(data)
+        yield data
 
 ################################################################################
 # This functions converts the timestamp from the XML file to a timestamp in
 # milliseconds. An example format of the time is:
 #    2024-09-22T21:05:27.263864000Z
+# Since the events in a file are in chronological order, many of them share
+# the same second, so the epoch of each second is cached.
 ################################################################################
+timestampRegex = re.compile(r'(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)$')
+secondsEpochCache = {}
+maxSecondsEpochCache = 4096
 def getTimestampFromEvent(event):
+    global secondsEpochCache
 
-    year = int(event['System']['TimeCreated']['@SystemTime'].split('-')[0])
-    month = int( event['System']['TimeCreated']['@SystemTime'].split('-')[1])
-    day =  int(event['System']['TimeCreated']['@SystemTime'].split('-')[2].split('T')[0])
-    hour =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[0])
-    minute =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[1])
-    second =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[2].split('.')[0])
-    msecond = event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[2].split('.')[1].split('Z')[0]
-    t = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc).timestamp()
+    seconds, _, msecond = event['System']['TimeCreated']['@SystemTime'].partition('.')
+    t = secondsEpochCache.get(seconds)
+    if t is None:
+        match = timestampRegex.match(seconds)
+        if match is None:
+            raise Exception(f"Invalid event timestamp: {event['System']['TimeCreated']['@SystemTime']}")
+        year, month, day, hour, minute, second = (int(field) for field in match.groups())
+        t = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc).timestamp() * 1000
+        if len(secondsEpochCache) >= maxSecondsEpochCache:
+            secondsEpochCache.clear()
+        secondsEpochCache[seconds] = t
     #
-    # Convert the timestep from a float in seconds to an integer in milliseconds.
-    msecond = int(msecond)/(10 ** (len(msecond) - 3))
-    t = int(t * 1000 + msecond)
-    return t
+    # Add the fraction of a second, truncated to milliseconds.
+    msecond = msecond.rstrip('Z')
+    if msecond == '':
+        return int(t)
+    return int(t + int(msecond)/(10 ** (len(msecond) - 3)))
 
 ################################################################################
-# This puts the CloudWatch event into the CloudWatch log stream.
+# This puts the CloudWatch events into the CloudWatch log stream. Throttled
+# calls are retried by the CloudWatch client. The events CloudWatch rejects
+# because of their timestamp are reported, since sending them again would
+# just get them rejected again.
 ################################################################################
 def putEventInCloudWatch(cwEvents, auditLogName):
     global cwLogsClient, config
 
     response = cwLogsClient.put_log_events(logGroupName=config['logGroupName'], logStreamName=auditLogName, logEvents=cwEvents)
-    if response.get('rejectedLogEventsInfo') != None:
-        if response['rejectedLogEventsInfo'].get('tooNewLogEventStartIndex') is not None:
-            print(f"Warning: Too new log event start index: {response['rejectedLogEventsInfo']['tooNewLogEventStartIndex']}")
-        if response['rejectedLogEventsInfo'].get('tooOldLogEventEndIndex') is not None:
-            print(f"Warning: Too old log event end index: {response['rejectedLogEventsInfo']['tooOldLogEventEndIndex']}")
+    rejectedInfo = response.get('rejectedLogEventsInfo')
+    if rejectedInfo != None:
+        if rejectedInfo.get('tooNewLogEventStartIndex') is not None:
+            index = rejectedInfo['tooNewLogEventStartIndex']
+            print(f"Warning: {len(cwEvents) - index} events sent to {auditLogName} were rejected for being too new, starting at index {index}.")
+        if rejectedInfo.get('tooOldLogEventEndIndex') is not None:
+            index = rejectedInfo['tooOldLogEventEndIndex']
+            print(f"Warning: {index + 1} events sent to {auditLogName} were rejected for being too old, ending at index {index}.")
+        if rejectedInfo.get('expiredLogEventEndIndex') is not None:
+            index = rejectedInfo['expiredLogEventEndIndex']
+            print(f"Warning: {index + 1} events sent to {auditLogName} were rejected for being past the log group's retention, ending at index {index}.")
+
+################################################################################
+# This class collects the CloudWatch events of a log stream into batches as
+# large as a put_log_events call allows, and sends them, in the background,
+# as they fill up. Up to twice cloudWatchThreads batches can be waiting to be
+# sent, after that add() waits for the oldest one to be sent first.
+################################################################################
+class LogStreamBatcher:
+    def __init__(self, logStreamName, executor):
+        self.logStreamName = logStreamName
+        self.executor = executor
+        self.pending = collections.deque()
+        self.cwEvents = []
+        self.batchBytes = 0
+        self.minTimestamp = None
+        self.maxTimestamp = None
+
+    ############################################################################
+    # This method adds an event to the batch, sending the batch first if the
+    # event doesn't fit in it.
+    ############################################################################
+    def add(self, cwEvent):
+        eventBytes = len(cwEvent['message'].encode('utf-8')) + eventOverheadBytes
+        timestamp = cwEvent['timestamp']
+        if len(self.cwEvents) > 0:
+            if (len(self.cwEvents) >= maxBatchEvents or self.batchBytes + eventBytes > maxBatchBytes or
+                    max(self.maxTimestamp, timestamp) - min(self.minTimestamp, timestamp) > maxBatchSpan):
+                self.flush()
+
+        if len(self.cwEvents) == 0:
+            self.minTimestamp = timestamp
+            self.maxTimestamp = timestamp
+        elif timestamp < self.minTimestamp:
+            self.minTimestamp = timestamp
+        elif timestamp > self.maxTimestamp:
+            self.maxTimestamp = timestamp
+        self.cwEvents.append(cwEvent)
+        self.batchBytes += eventBytes
+
+    ############################################################################
+    # This method sends the batch in the background. The events are sorted
+    # first, since CloudWatch requires them to be in chronological order.
+    ############################################################################
+    def flush(self):
+        global config
+
+        if len(self.cwEvents) == 0:
+            return
+        self.cwEvents.sort(key=lambda cwEvent: cwEvent['timestamp'])
+        print(f"Info: Putting {len(self.cwEvents)} events ({self.batchBytes} bytes) into {self.logStreamName}.")
+        self.pending.append(self.executor.submit(putEventInCloudWatch, self.cwEvents, self.logStreamName))
+        self.cwEvents = []
+        self.batchBytes = 0
+        self.wait(2 * config['cloudWatchThreads'])
+
+    ############################################################################
+    # This method waits until no more than 'maxPending' batches are waiting to
+    # be sent. It raises the exception of any batch that failed to be sent.
+    ############################################################################
+    def wait(self, maxPending=0):
+        while len(self.pending) > maxPending:
+            self.pending.popleft().result()
+
+    ############################################################################
+    # This method sends the rest of the events and waits for all the batches
+    # to be sent.
+    ############################################################################
+    def close(self):
+        self.flush()
+        self.wait()
+
+################################################################################
+# The data fields of an event that aren't included in the CloudWatch message:
+# ObjectServer: Always just seems to be: 'Security'.
+# HandleID: Is some odd string of numbers.
+# InformationRequested: A verbose string of information.
+# AccessList: A string of numbers that I'm not sure what they represent.
+# AccessMask: A number that represent the access mask.
+# DesiredAccess: A verbose list of strings represent the desired access.
+# Attributes: A verbose list of strings representing the attributes.
+# DirHandleID: A string of numbers that I'm not sure what they represent.
+# SearchFilter: Always seems to be null.
+# SearchPattern: Always seems to be set to "Not Present".
+# SubjectPort: Just the TCP port that the user came in on.
+# OldDirHandle and NewDirHandle: Are the UUIDs of the directory. The OldPath and NewPath are human readable.
+################################################################################
+ignoredDataFields = frozenset(["ObjectServer", "HandleID", "InformationRequested", "AccessList", "AccessMask", "DesiredAccess", "Attributes", "DirHandleID", "SearchFilter", "SearchPattern", "SubjectPort", "OldDirHandle", "NewDirHandle"])
+
+################################################################################
+# This function formats a path data field as its volume and name.
+################################################################################
+def formatPathField(data):
+    volume, _, name = data['#text'].partition(';')
+    return f"volume={volume.replace('(', '').replace(')', '')}, name={name.split(';')[0]}"
+
+################################################################################
+# The functions that format the data fields that require special handling.
+# The rest are formatted as "<Name>=<text>".
+################################################################################
+dataFieldFormatters = {
+    'SubjectIP': lambda data: f"IP={data['#text']}",
+    'SubjectUnix': lambda data: f"UnixID={data['@Uid']}, GroupID={data['@Gid']}",
+    'SubjectUserSid': lambda data: f"UserSid={data['#text']}",
+    'SubjectUserName': lambda data: f"UserName={data['#text']}",
+    'SubjectDomainName': lambda data: f"Domain={data['#text']}",
+    'ObjectName': formatPathField,
+    'FileName': formatPathField,
+    'InformationSet': lambda data: "InformationSet=Null" if data.get('#text') == None else f"InformationSet={data['#text']}"
+}
 
 ################################################################################
 # This function returns a CloudWatch event from the XML audit log event.
 ################################################################################
 def createCWEvent(event):
-    # ObjectServer: Always just seems to be: 'Security'.
-    # HandleID: Is some odd string of numbers.
-    # InformationRequested: A verbose string of information.
-    # AccessList: A string of numbers that I'm not sure what they represent.
-    # AccessMask: A number that represent the access mask.
-    # DesiredAccess: A verbose list of strings represent the desired access.
-    # Attributes: A verbose list of strings representing the attributes.
-    # DirHandleID: A string of numbers that I'm not sure what they represent.
-    # SearchFilter: Always seems to be null.
-    # SearchPattern: Always seems to be set to "Not Present".
-    # SubjectPort: Just the TCP port that the user came in on.
-    # OldDirHandle and NewDirHandle: Are the UUIDs of the directory. The OldPath and NewPath are human readable.
-    ignoredDataFields = ["ObjectServer", "HandleID", "InformationRequested", "AccessList", "AccessMask", "DesiredAccess", "Attributes", "DirHandleID", "SearchFilter", "SearchPattern", "SubjectPort", "OldDirHandle", "NewDirHandle"]
-
-    eventTimestamp = getTimestampFromEvent(event)
+    system = event['System']
+    fs, _, svm = system['Computer'].partition('/')
     #
     # Build the message to send to CloudWatch.
-    cwData  = f"Date={event['System']['TimeCreated']['@SystemTime']}, "
-    cwData += f"Event={event['System']['EventName'].replace(' ', '-')}, " # Replace spaces with dashes.
-    cwData += f"fs={event['System']['Computer'].split('/')[0]}, "
-    cwData += f"svm={event['System']['Computer'].split('/')[1]}, "
-    cwData += f"Result={event['System']['Result'].replace(' ', '-')}"     # Replace spaces with dashes.
+    cwData = [
+        f"Date={system['TimeCreated']['@SystemTime']}",
+        f"Event={system['EventName'].replace(' ', '-')}",  # Replace spaces with dashes.
+        f"fs={fs}",
+        f"svm={svm.split('/')[0]}",
+        f"Result={system['Result'].replace(' ', '-')}"     # Replace spaces with dashes.
+    ]
     #
     # Add the data fields to the message. Some fields are ignored. Some required special handling.
     for data in event['EventData']['Data']:
-        if data['@Name'] not in ignoredDataFields:
-            if data['@Name'] == 'SubjectIP':
-                cwData += f", IP={data['#text']}"
-            elif data['@Name'] == 'SubjectUnix':
-                cwData += f", UnixID={data['@Uid']}, GroupID={data['@Gid']}"
-            elif data['@Name'] == 'SubjectUserSid':
-                cwData += f", UserSid={data['#text']}"
-            elif data['@Name'] == 'SubjectUserName':
-                cwData += f", UserName={data['#text']}"
-            elif data['@Name'] == 'SubjectDomainName':
-                cwData += f", Domain={data['#text']}"
-            elif data['@Name'] == 'ObjectName' or data['@Name'] == 'FileName':
-                cwData += f", volume={data['#text'].split(';')[0].replace('(', '').replace(')', '')}, name={data['#text'].split(';')[1]}"
-            elif data['@Name'] == 'InformationSet':
-                if data.get('#text') == None:
-                    cwData += ", InformationSet=Null"
-                else:
-                    cwData += f", InformationSet={data['#text']}"
-            else: # Assume the rest of the fields don't need special handling.
-                cwData += f", {data['@Name']}={data['#text']}"
-
-    return {'timestamp': eventTimestamp, 'message': cwData}
+        name = data['@Name']
+        if name not in ignoredDataFields:
+            formatter = dataFieldFormatters.get(name)
+            if formatter is None:
+                cwData.append(f"{name}={data['#text']}")
+            else:
+                cwData.append(formatter(data))
+
+    return {'timestamp': getTimestampFromEvent(event), 'message': ", ".join(cwData)}
+
+################################################################################
+# This function returns the name of an XML element without its namespace. The
+# names are cached since the same few are used over and over again.
+################################################################################
+localNames = {}
+def getLocalName(tag):
+    name = localNames.get(tag)
+    if name is None:
+        name = tag.rsplit('}', 1)[-1]
+        localNames[tag] = name
+    return name
+
+################################################################################
+# This function converts an XML element into the same structure xmltodict
+# would: attributes are stored as "@name", the text as "#text", and child
+# elements by their name, in a list if there is more than one of them. An
+# element with just text is stored as the text. The elements named in
+# 'forceList' are always stored in a list.
+################################################################################
+def elementToDict(element, forceList=('Data',)):
+    text = element.text
+    if text is not None:
+        text = text.strip()
+    attrib = element.attrib
+    if len(element) == 0 and len(attrib) == 0:
+        return text if text else None
+
+    result = {'@' + name: value for name, value in attrib.items()}
+    for child in element:
+        name = getLocalName(child.tag)
+        if len(child) == 0 and len(child.attrib) == 0:
+            #
+            # Handle the most common case, an element with just text, here.
+            value = child.text
+            if value is not None:
+                value = value.strip() or None
+        else:
+            value = elementToDict(child, forceList)
+        current = result.get(name)
+        if current is None and name not in result:
+            result[name] = [value] if name in forceList else value
+        elif isinstance(current, list):
+            current.append(value)
+        else:
+            result[name] = [current, value]
+    if text:
+        result['#text'] = text
+    return result
+
+################################################################################
+# This function parses an audit log file, as its blocks are passed to it,
+# and yields its events, one at a time, as dictionaries. Each event is
+# discarded once it has been converted, so only one is held in memory at a
+# time.
+################################################################################
+def readAuditEvents(blocks):
+    parser = xml.etree.ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
+    for data in blocks:
+        parser.feed(data)
+        for action, element in parser.read_events():
+            if action == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    if getLocalName(root.tag) == 'Events' and getLocalName(element.tag) == 'Event':
+                        yield elementToDict(element)
+                    root.remove(element)
+    parser.close()
 
 ################################################################################
 # This function uploads the audit log events stored in XML format to a
-# CloudWatch log stream.
+# CloudWatch log stream. The events are sent as the file is parsed, with the
+# blocks of the file passed to it as they are read.
 ################################################################################
-def ingestAuditFile(auditLogPath, auditLogName):
-    global cwLogsClient, config
-    #
-    # Convert the XML audit log file into a dictionary.
-    f = open(auditLogPath, 'r')
-    data = f.read()
-    dictData = xmltodict.parse(data)
+def ingestAuditFile(blocks, auditLogName):
+    global cwLogsClient, cwExecutor, config
+
+    batcher = None
+    try:
+        for event in readAuditEvents(blocks):
+            cwEvent = createCWEvent(event)
+            if batcher is None:
+                #
+                # Ensure the logstream exists.
+                try:
+                    cwLogsClient.create_log_stream(logGroupName=config['logGroupName'], logStreamName=auditLogName)
+                except cwLogsClient.exceptions.ResourceAlreadyExistsException:
+                    #
+                    # This really shouldn't happen, since we should only be processing
+                    # each file once, but during testing it happens all the time.
+                    print(f"Info: Log stream {auditLogName} already exists.")
+                batcher = LogStreamBatcher(auditLogName, cwExecutor)
+            batcher.add(cwEvent)
+    except Exception:
+        #
+        # Let the batches already sent finish, before giving up on the file.
+        if batcher is not None:
+            for future in batcher.pending:
+                future.exception()
+        raise
 
-    if dictData.get('Events') == None or dictData['Events'].get('Event') == None:
+    if batcher is None:
         print(f"Info: No events found in {auditLogName}.")
         return
+
+    batcher.close()
+
+################################################################################
+# This function returns the epoch of the last file read from an SVM, or None
+# if no file has been read from it yet.
+################################################################################
+def getLastFileRead(fsxn, vserverName):
+    global lastFileRead, lastFileReadLock
+
+    with lastFileReadLock:
+        if lastFileRead.get(fsxn) is None:
+            return None
+        return lastFileRead[fsxn].get(vserverName)
+
+################################################################################
+# This function records the epoch of the last file read from an SVM, and
+# saves it in the S3 bucket. It is saved while holding the lock, so the
+# copies saved by the different threads can't overwrite each other out of
+# order.
+################################################################################
+def setLastFileRead(fsxn, vserverName, epoch):
+    global lastFileRead, lastFileReadLock, s3Client, config
+
+    with lastFileReadLock:
+        if lastFileRead.get(fsxn) is None:
+            lastFileRead[fsxn] = {vserverName: epoch}
+        else:
+            lastFileRead[fsxn][vserverName] = epoch
+        s3Client.put_object(Key=config['statsName'], Bucket=config['s3BucketName'], Body=json.dumps(lastFileRead).encode('UTF-8'))
+
+################################################################################
+# This function gets the credentials of an FSxN and the list of its SVMs. It
+# returns the work to process each of the SVMs. An empty list is returned if
+# the FSxN can't be processed.
+################################################################################
+def getSvmWork(fsxn):
+    global http, secretARNs
+
+    fsId = fsxn.split('.')[1]
     #
-    # Ensure the logstream exists.
-    try:
-        cwLogsClient.create_log_stream(logGroupName=config['logGroupName'], logStreamName=auditLogName)
-    except cwLogsClient.exceptions.ResourceAlreadyExistsException:
+    # Get the credentials.
+    if secretARNs.get(fsId) is not None:
         #
-        # This really shouldn't happen, since we should only be processing
-        # each file once, but during testing it happens all the time.
-        print(f"Info: Log stream {auditLogName} already exists.")
+        # Get the username and password of the ONTAP/FSxN system. Sessions
+        # can't be shared between threads, so create one for this thread.
+        try:
+            session = boto3.session.Session()
+            secretsClient = session.client(service_name='secretsmanager', region_name=secretARNs[fsId].split(':')[3])
+            secretsInfo = secretsClient.get_secret_value(SecretId=secretARNs[fsId])
+            secret = json.loads(secretsInfo['SecretString'])
+            if secret.get('username') is None or secret.get('password') is None:
+                print(f"Warning: The 'username' or 'password' keys were not found in the secret for '{fsId}' in the secretARN '{secretARNs[fsId]}'.")
+                return []
+            username = secret['username']
+            password = secret['password']
+            secretsClient.close()
+        except botocore.exceptions.ClientError as err:
+            print(f"Warning: Unable to retrieve the credentials for '{fsId}' using the secretARN '{secretARNs[fsId]}'. {err}")
+            return []
+    else:
+        print(f'Warning: No secret ARN was found for {fsId}.')
+        return []
     #
-    # If there is only one event, then the dict['Events']['Event'] will be a
-    # dictionary, otherwise it will be a list of dictionaries.
-    if isinstance(dictData['Events']['Event'], list):
+    # Create a header with the basic authentication.
+    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
+    headersDownload = { **auth, 'Accept': 'multipart/form-data' }
+    headersQuery = { **auth }
+    #
+    # Get the list of SVMs on the FSxN.
+    svmWork = []
+    endpoint = f"https://{fsxn}/api/svm/svms?return_timeout=4"
+    response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
+    if response.status != 200:
+        print(f"Warning: API call to {endpoint} failed. HTTP status code: {response.status}.")
+        return []
+    svmsData = json.loads(response.data.decode('utf-8'))
+    numSvms = svmsData['num_records']
+    while numSvms > 0:
+        for record in svmsData['records']:
+            svmWork.append((processSvm, (fsxn, fsId, record['name'], headersQuery, headersDownload)))
         #
-        # Make sure not to span more than 24 hours of events in a single put_log_events call.
-        firstEventTimestamp = getTimestampFromEvent(dictData['Events']['Event'][0])
-        cwEvents = []
-        for event in dictData['Events']['Event']:
-            currentEventTimestamp = getTimestampFromEvent(event)
-            if currentEventTimestamp - firstEventTimestamp > 79200000:  # 23 hours and 55 minutes in milliseconds.
-                print("Info: Putting 24 hours of events.")
-                putEventInCloudWatch(cwEvents, auditLogName)
-                cwEvents = []
-                firstEventTimestamp = currentEventTimestamp
-
-            cwEvents.append(createCWEvent(event))
-            if len(cwEvents) == 5000:  # The real maximum is 10000 events, but there is also a size limit, so we will use 5000.
-                print("Info: Putting 5000 events")
-                putEventInCloudWatch(cwEvents, auditLogName)
-                cwEvents = []
-                firstEventTimestamp = currentEventTimestamp
-    else:
-        cwEvents = [createCWEvent(dictData['Events']['Event'])]
+        # Get the next set of SVMs.
+        if svmsData['_links'].get('next') != None:
+            endpoint = f"https://{fsxn}{svmsData['_links']['next']['href']}"
+            response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
+            if response.status == 200:
+                svmsData = json.loads(response.data.decode('utf-8'))
+                numSvms = svmsData['num_records']
+            else:
+                print(f"Warning: API call to {endpoint} failed. HTTP status code: {response.status}.")
+                break # Just process the SVMs found so far.
+        else:
+            numSvms = 0
+    return svmWork
 
-    if len(cwEvents) > 0:
-        print(f"Info: Putting {len(cwEvents)} events")
-        putEventInCloudWatch(cwEvents, auditLogName)
+################################################################################
+# This function ingests the audit log files, of an SVM, that haven't been
+# read yet. The files are processed one at a time, in the order they were
+# created, so the last file read is always the newest one ingested.
+################################################################################
+def processSvm(fsxn, fsId, vserverName, headersQuery, headersDownload):
+    global http, s3Client, config
+    #
+    # Get the volume UUID for the audit_logs volume.
+    volumeUUID = None
+    endpoint = f"https://{fsxn}/api/storage/volumes?name={config['volumeName']}&svm={vserverName}"
+    response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
+    if response.status == 200:
+        data = json.loads(response.data.decode('utf-8'))
+        if data['num_records'] > 0:
+            volumeUUID = data['records'][0]['uuid']  # Since we specified the volume, and vserver name, there should only be one record.
+
+    if volumeUUID == None:
+        print(f"Warning: Volume {config['volumeName']} not found for {fsId} under SVM: {vserverName}.")
+        return
+    #
+    # Get all the files in the volume that match the audit file pattern.
+    endpoint = f"https://{fsxn}/api/storage/volumes/{volumeUUID}/files?name=audit_{vserverName}_D*.xml&order_by=name%20asc&fields=name,size"
+    response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
+    data = json.loads(response.data.decode('utf-8'))
+    if data.get('num_records') == 0:
+        print(f"Warning: No XML audit log files found on FsID: {fsId}; SvmID: {vserverName}; Volume: {config['volumeName']}.")
+        return
+
+    lastEpoch = getLastFileRead(fsxn, vserverName)
+    for file in data['records']:
+        filePath = file['name']
+        if lastEpoch is None or getEpoch(filePath) > lastEpoch:
+            fileBlocks = readFile(fsxn, headersDownload, volumeUUID, filePath, file.get('size'))
+            blocks = fileBlocks
+            #
+            # If the file is to be copied to S3, keep a copy of it while it is being ingested.
+            localFile = None
+            if config['copyToS3']:
+                localFile = tempfile.NamedTemporaryFile(prefix="audit_", suffix=".xml")
+                blocks = copyBlocks(fileBlocks, localFile)
+            try:
+                ingestAuditFile(blocks, filePath)
+                if localFile is not None:
+                    localFile.flush()
+                    s3Client.upload_file(localFile.name, config['s3BucketName'], filePath)
+            except Exception as err:
+                #
+                # Stop here, so the file will be tried again on the next run, instead of being skipped.
+                print(f"Warning: Unable to ingest {filePath} from FsID: {fsId}; SvmID: {vserverName}. It will be retried on the next run. {err}")
+                return
+            finally:
+                #
+                # Stop any reads still in progress, if the file wasn't completely read.
+                fileBlocks.close()
+                if localFile is not None:
+                    localFile.close()
+            lastEpoch = getEpoch(filePath)
+            setLastFileRead(fsxn, vserverName, lastEpoch)
+
+################################################################################
+# This function processes all the FSxNs. The work is queued per FSxN, and
+# run by a pool of svmThreads threads, with no more than
+# svmThreadsPerFileSystem of them working on the same FSxN at a time. The
+# queue of an FSxN starts with getting its list of SVMs, which then queues
+# the work to process each of them. The FSxNs take turns starting their
+# work, so a slow one doesn't hold up the others. It returns the number of
+# work items that failed with an unexpected exception.
+################################################################################
+def processFileSystems(fsxNs):
+    global config
+
+    queues = {fsxn: collections.deque([(getSvmWork, (fsxn,))]) for fsxn in fsxNs}
+    running = {fsxn: 0 for fsxn in fsxNs}
+    futures = {}
+    failures = 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=config['svmThreads'])
+    try:
+        while True:
+            #
+            # Start as much of the queued work as the limits allow.
+            started = True
+            while started and len(futures) < config['svmThreads']:
+                started = False
+                for fsxn in queues:
+                    if len(queues[fsxn]) > 0 and running[fsxn] < config['svmThreadsPerFileSystem'] and len(futures) < config['svmThreads']:
+                        function, args = queues[fsxn].popleft()
+                        futures[executor.submit(function, *args)] = fsxn
+                        running[fsxn] += 1
+                        started = True
+
+            if len(futures) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                fsxn = futures.pop(future)
+                running[fsxn] -= 1
+                try:
+                    work = future.result()
+                except Exception as err:
+                    print(f"Warning: Failed to process {fsxn}. {err}")
+                    failures += 1
+                    continue
+                if work is not None:
+                    queues[fsxn].extend(work)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return failures
 
 ################################################################################
 # This function checks that all the required configuration variables are set.
@@ -332,6 +802,10 @@ def checkConfig():
         's3BucketName': s3BucketName if 's3BucketName' in globals() else None,         # pylint: disable=E0602
         'statsName': statsName if 'statsName' in globals() else None,                  # pylint: disable=E0602
         'copyToS3': copyToS3 if 'copyToS3' in globals() else None,                     # pylint: disable=E0602
+        'downloadThreads': downloadThreads if 'downloadThreads' in globals() else None,  # pylint: disable=E0602
+        'cloudWatchThreads': cloudWatchThreads if 'cloudWatchThreads' in globals() else None,  # pylint: disable=E0602
+        'svmThreads': svmThreads if 'svmThreads' in globals() else None,               # pylint: disable=E0602
+        'svmThreadsPerFileSystem': svmThreadsPerFileSystem if 'svmThreadsPerFileSystem' in globals() else None,  # pylint: disable=E0602
         'fsxnSecretARNsFile': fsxnSecretARNsFile if 'fsxnSecretARNsFile' in globals() else None,  # pylint: disable=E0602
         'fileSystem1ID': fileSystem1ID if 'fileSystem1ID' in globals() else None,      # pylint: disable=E0602
         'fileSystem2ID': fileSystem2ID if 'fileSystem2ID' in globals() else None,      # pylint: disable=E0602
@@ -344,7 +818,8 @@ def checkConfig():
         'fileSystem4SecretARN': fileSystem4SecretARN if 'fileSystem4SecretARN' in globals() else None,  # pylint: disable=E0602
         'fileSystem5SecretARN': fileSystem5SecretARN if 'fileSystem5SecretARN' in globals() else None   # pylint: disable=E0602
     }
-    optionalConfig = ['copyToS3', 'fsxnSecretARNsFile', 'fileSystem1ID',
+    optionalConfig = ['copyToS3', 'downloadThreads', 'cloudWatchThreads', 'svmThreads', 'svmThreadsPerFileSystem',
+                      'fsxnSecretARNsFile', 'fileSystem1ID',
                       'fileSystem2ID', 'fileSystem3ID', 'fileSystem4ID',
                       'fileSystem5ID', 'fileSystem1SecretARN', 'fileSystem2SecretARN',
                       'fileSystem3SecretARN', 'fileSystem4SecretARN', 'fileSystem5SecretARN']
@@ -359,6 +834,26 @@ def checkConfig():
         config['copyToS3'] = False
     else:
         config['copyToS3'] = config['copyToS3'].lower() == 'true'
+
+    if config['downloadThreads'] == None:
+        config['downloadThreads'] = 4
+    else:
+        config['downloadThreads'] = int(config['downloadThreads'])
+
+    if config['cloudWatchThreads'] == None:
+        config['cloudWatchThreads'] = 4
+    else:
+        config['cloudWatchThreads'] = int(config['cloudWatchThreads'])
+
+    if config['svmThreads'] == None:
+        config['svmThreads'] = 8
+    else:
+        config['svmThreads'] = int(config['svmThreads'])
+
+    if config['svmThreadsPerFileSystem'] == None:
+        config['svmThreadsPerFileSystem'] = 4
+    else:
+        config['svmThreadsPerFileSystem'] = int(config['svmThreadsPerFileSystem'])
     #
     # To be backwards compatible, load the vserverName.
     config['vserverName'] = vserverName if 'vserverName' in globals() else os.environ.get('vserverName')  # pylint: disable=E0602
@@ -403,14 +898,11 @@ def checkConfig():
 # and then processes all the FSxNs.
 ################################################################################
 def lambda_handler(event, context):     # pylint: disable=W0613
-    global http, cwLogsClient, config, s3Client, secretARNs
+    global http, cwLogsClient, cwExecutor, config, s3Client, secretARNs, lastFileRead, lastFileReadLock
     #
     # Check that we have all the configuration variables we need.
     checkConfig()
     #
-    # Create a Secrets Manager client.
-    session = boto3.session.Session()
-    #
     # Create a S3 client.
     # Created in the checkCofnig function.
     # s3Client = boto3.client('s3', config['s3BucketRegion'])
@@ -418,13 +910,16 @@ def lambda_handler(event, context):     # pylint: disable=W0613
     # Create a FSx client.
     fsxClient = boto3.client('fsx', config['fsxRegion'])
     #
-    # Create a CloudWatch client.
-    cwLogsClient = boto3.client('logs', config['fsxRegion'])
+    # Create a CloudWatch client. Have it slow down, and retry, when it gets
+    # throttled, and allow a connection for each of the batches being sent.
+    cwConfig = botocore.config.Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=config['cloudWatchThreads'])
+    cwLogsClient = boto3.client('logs', config['fsxRegion'], config=cwConfig)
+    cwExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=config['cloudWatchThreads'])
     #
     # Disable warning about connecting to servers with self-signed SSL certificates.
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
-    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries)
+    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries, maxsize=config['downloadThreads'] * config['svmThreadsPerFileSystem'])
     #
     # Get a list of FSxNs in the region.
     fsxNs = []   # Holds the FQDN of the FSxNs management ports.
@@ -451,105 +946,19 @@ def lambda_handler(event, context):     # pylint: disable=W0613
             raise err
     else:
         lastFileRead = json.loads(response['Body'].read().decode('utf-8'))
+    lastFileReadLock = threading.Lock()
     #
-    # Process each FSxN.
+    # Since the format of the lastReadFile structure has changed, we need to update it.
     for fsxn in fsxNs:
-        fsId = fsxn.split('.')[1]
-        #
-        # Since the format of the lastReadFile structure has changed, we need to update it.
         if lastFileRead.get(fsxn) is not None and config['vserverName'] is not None:
             if type(lastFileRead[fsxn]) is float:                                  # Old format
                 lastFileRead[fsxn] = {config['vserverName']: lastFileRead[fsxn]}   # New format
-        #
-        # Get the credentials.
-        if secretARNs.get(fsId) is not None:
-            #
-            # Get the username and password of the ONTAP/FSxN system.
-            try:
-                secretsClient = session.client(service_name='secretsmanager', region_name=secretARNs[fsId].split(':')[3])
-                secretsInfo = secretsClient.get_secret_value(SecretId=secretARNs[fsId])
-                secret = json.loads(secretsInfo['SecretString'])
-                if secret.get('username') is None or secret.get('password') is None:
-                    print(f"Warning: The 'username' or 'password' keys were not found in the secret for '{fsId}' in the secretARN '{secretARNs[fsId]}'.")
-                    continue
-                username = secret['username']
-                password = secret['password']
-                secretsClient.close()
-            except botocore.exceptions.ClientError as err:
-                print(f"Warning: Unable to retrieve the credentials for '{fsId}' using the secretARN '{secretARNs[fsId]}'. {err}")
-                continue
-        else:
-            print(f'Warning: No secret ARN was found for {fsId}.')
-            continue
-        #
-        # Create a header with the basic authentication.
-        auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
-        headersDownload = { **auth, 'Accept': 'multipart/form-data' }
-        headersQuery = { **auth }
-        #
-        # Get the list of SVMs on the FSxN.
-        endpoint = f"https://{fsxn}/api/svm/svms?return_timeout=4"
-        response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
-        if response.status == 200:
-            svmsData = json.loads(response.data.decode('utf-8'))
-            numSvms = svmsData['num_records']
-            #
-            # Loop over all the SVMs.
-            while numSvms > 0:
-                for record in svmsData['records']:
-                    vserverName = record['name']
-                    #
-                    # Get the volume UUID for the audit_logs volume.
-                    volumeUUID = None
-                    endpoint = f"https://{fsxn}/api/storage/volumes?name={config['volumeName']}&svm={vserverName}"
-                    response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
-                    if response.status == 200:
-                        data = json.loads(response.data.decode('utf-8'))
-                        if data['num_records'] > 0:
-                            volumeUUID = data['records'][0]['uuid']  # Since we specified the volume, and vserver name, there should only be one record.
-
-                    if volumeUUID == None:
-                        print(f"Warning: Volume {config['volumeName']} not found for {fsId} under SVM: {vserverName}.")
-                        continue
-                    #
-                    # Get all the files in the volume that match the audit file pattern.
-                    endpoint = f"https://{fsxn}/api/storage/volumes/{volumeUUID}/files?name=audit_{vserverName}_D*.xml&order_by=name%20asc&fields=name"
-                    response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
-                    data = json.loads(response.data.decode('utf-8'))
-                    if data.get('num_records') == 0:
-                        print(f"Warning: No XML audit log files found on FsID: {fsId}; SvmID: {vserverName}; Volume: {config['volumeName']}.")
-                        continue
-
-                    for file in data['records']:
-                        filePath = file['name']
-                        if lastFileRead.get(fsxn) is None or lastFileRead[fsxn].get(vserverName) is None or getEpoch(filePath) > lastFileRead[fsxn][vserverName]:
-                            localFileName = readFile(fsxn, headersDownload, volumeUUID, filePath)
-                            if localFileName is not None:
-                                if config['copyToS3']:
-                                    s3Client.upload_file(localFileName, config['s3BucketName'], filePath)
-                                ingestAuditFile(localFileName, filePath)
-                                if lastFileRead.get(fsxn) is None:
-                                    lastFileRead[fsxn] = {vserverName: getEpoch(filePath)}
-                                else:
-                                    lastFileRead[fsxn][vserverName] = getEpoch(filePath)
-                                s3Client.put_object(Key=config['statsName'], Bucket=config['s3BucketName'], Body=json.dumps(lastFileRead).encode('UTF-8'))
-                                os.remove(localFileName)
-                #
-                # Get the next set of SVMs.
-                if svmsData['_links'].get('next') != None:
-                    endpoint = f"https://{fsxn}{svmsData['_links']['next']['href']}"
-                    response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
-                    if response.status == 200:
-                        svmsData = json.loads(response.data.decode('utf-8'))
-                        numSvms = svmsData['num_records']
-                    else:
-                        print(f"Warning: API call to {endpoint} failed. HTTP status code: {response.status}.")
-                        break # Break out of the for all SVMs loop. Maybe the call to the next FSxN will work.
-                else:
-                    numSvms = 0
-        else:
-            print(f"Warning: API call to {endpoint} failed. HTTP status code: {response.status}.")
-            break # Break out of the for all FSxNs loop.
+    #
+    # Process all the FSxNs.
+    failures = processFileSystems(fsxNs)
+    cwExecutor.shutdown()
+    if failures > 0:
+        raise Exception(f"Failed to process {failures} of the FSxNs, or their SVMs. See the warnings above.")
 #
 # If this script is not running as a Lambda function, then call the lambda_handler function.
 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') == None:
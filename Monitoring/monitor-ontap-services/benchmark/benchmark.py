@@ -0,0 +1,183 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program measures the performance of monitor_ontap_services.py without
+# a live FSxN or any AWS resources. It runs the lambda_handler against the
+# synthetic ONTAP API served by mock_ontap_server.py, with the AWS services
+# (S3, SNS, CloudWatch Logs and Secrets Manager) faked by the "moto" package.
+#
+# Each service is benchmarked in its own process, so the peak memory usage
+# (RSS) can be reported for each of them. For each service, it reports the
+# wall time of the first run (when all the alerts are sent) and of the
+# following runs (when the alerts have already been sent), the number of
+# ONTAP API calls made and bytes received, the number of AWS API calls made,
+# and the peak RSS.
+#
+# It requires the packages in the Lambda layer (cronsim and pytz), boto3,
+# moto, and the openssl command. For example:
+#   pip install boto3 moto cronsim pytz
+#   python3 benchmark.py --volumes 5000 --quotas 20000 --runs 3
+################################################################################
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_ontap_server
+
+services = ["systemHealth", "ems", "snapmirror", "storage", "quota", "vserver"]
+
+matchingConditions = {
+    "systemHealth": [{"versionChange": True}, {"failover": True}, {"networkInterfaces": True}],
+    "ems": [{"name": "wafl.*|raid.*", "severity": "error|alert|emergency", "message": "", "filter": ""},
+            {"name": "arw.volume.state", "severity": "", "message": "", "filter": ""}],
+    "snapmirror": [{"maxLagTime": 86400}, {"maxLagTimePercent": 200}, {"healthy": False}, {"stalledTransferSeconds": 600}],
+    "storage": [{"aggrWarnPercentUsed": 80}, {"aggrCriticalPercentUsed": 95}, {"volumeWarnPercentUsed": 85},
+                {"volumeCriticalPercentUsed": 95}, {"volumeWarnFilesPercentUsed": 80},
+                {"volumeCriticalFilesPercentUsed": 95}, {"offline": True}, {"aggrProjectedFullHours": 72},
+                {"volumeProjectedFullHours": 72}],
+    "quota": [{"maxHardQuotaSpacePercentUsed": 95}, {"maxSoftQuotaSpacePercentUsed": 100}, {"maxQuotaInodesPercentUsed": 95}],
+    "vserver": [{"vserverState": True}, {"nfsProtocolState": True}, {"cifsProtocolState": True}]
+}
+
+################################################################################
+# This function runs the benchmark of one, or all, of the services. It is run
+# in a child process. It prints the results as a JSON object.
+################################################################################
+def runService(service, args):
+    from moto import mock_aws
+    import boto3
+    import botocore.client
+
+    region = "us-west-2"
+    certFile, keyFile = mock_ontap_server.createSelfSignedCert(tempfile.mkdtemp())
+    mockOntap = mock_ontap_server.mockOntapFromArgs(args)
+    server = mock_ontap_server.startServer(mockOntap, certFile=certFile, keyFile=keyFile)
+
+    with mock_aws():
+        s3Client = boto3.client("s3", region)
+        s3Client.create_bucket(Bucket="benchmark", CreateBucketConfiguration={"LocationConstraint": region})
+        secretArn = boto3.client("secretsmanager", region).create_secret(Name="benchmark", SecretString=json.dumps({"username": "admin", "password": "password"}))["ARN"]
+        topicArn = boto3.client("sns", region).create_topic(Name="benchmark")["TopicArn"]
+        boto3.client("logs", region).create_log_group(logGroupName="benchmark")
+
+        ontapAdminServer = f'127.0.0.1:{server.server_address[1]}'
+        conditions = {"services": [{"name": name, "rules": matchingConditions[name]} for name in services if service in (name, "all")]}
+        s3Client.put_object(Bucket="benchmark", Key=f'{ontapAdminServer}-conditions', Body=json.dumps(conditions).encode('UTF-8'))
+
+        os.environ.update({
+            "OntapAdminServer": ontapAdminServer,
+            "s3BucketName": "benchmark",
+            "s3BucketRegion": region,
+            "secretArn": secretArn,
+            "secretUsernameKey": "username",
+            "secretPasswordKey": "password",
+            "snsTopicArn": topicArn,
+            "cloudWatchLogGroupArn": f'arn:aws:logs:{region}:123456789012:log-group:benchmark:*',
+            "AWS_LAMBDA_FUNCTION_NAME": "benchmark"  # Keeps the module from running the handler when imported.
+        })
+        #
+        # Count the AWS API calls.
+        awsCalls = {}
+        makeApiCall = botocore.client.BaseClient._make_api_call
+        def countApiCall(self, operation, params):
+            awsCalls[operation] = awsCalls.get(operation, 0) + 1
+            return makeApiCall(self, operation, params)
+        botocore.client.BaseClient._make_api_call = countApiCall
+
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import monitor_ontap_services
+        import logging
+        logging.disable(logging.CRITICAL)
+
+        startRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results = []
+        for run in range(args.runs):
+            awsCalls.clear()
+            mockOntap.resetStats()
+            startTime = time.perf_counter()
+            monitor_ontap_services.lambda_handler({}, None)
+            wallTime = time.perf_counter() - startTime
+            ontapStats = mockOntap.resetStats()
+            results.append({
+                "wallTime": wallTime,
+                "ontapCalls": sum(stat["calls"] for stat in ontapStats.values()),
+                "ontapBytes": sum(stat["bytes"] for stat in ontapStats.values()),
+                "ontapEndpoints": ontapStats,
+                "awsCalls": dict(awsCalls)
+            })
+        server.shutdown()
+
+    print(json.dumps({
+        "service": service,
+        "runs": results,
+        "startRssKB": startRss,
+        "peakRssKB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }))
+
+################################################################################
+# This function formats a number of bytes for the report.
+################################################################################
+def formatBytes(numBytes):
+    for unit in ["B", "KiB", "MiB"]:
+        if numBytes < 1024:
+            return f'{numBytes:.0f}{unit}'
+        numBytes /= 1024
+    return f'{numBytes:.1f}GiB'
+
+################################################################################
+# Main logic starts here.
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark monitor_ontap_services.py against a synthetic ONTAP API.")
+    mock_ontap_server.addScaleArguments(parser)
+    parser.add_argument("--runs", type=int, default=2, help="Number of times to run the handler for each service.")
+    parser.add_argument("--services", default=",".join(services + ["all"]), help="Comma separated list of the services to benchmark, \"all\" for all of them at once.")
+    parser.add_argument("--json", action="store_true", help="Output the raw results as JSON.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        runService(args.child, args)
+        sys.exit(0)
+
+    #
+    # Pass the scale options on to the child processes.
+    childArgs = []
+    for name, value in vars(args).items():
+        if name not in ("services", "json", "child"):
+            childArgs.append(f'--{name.replace("_", "-")}={value}')
+
+    allResults = []
+    for service in args.services.split(","):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", service] + childArgs,
+                                check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        allResults.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(allResults, indent=4))
+        sys.exit(0)
+
+    print(f'{"service":<13} {"run":>3} {"wall(s)":>8} {"ONTAP calls":>11} {"ONTAP bytes":>11} {"AWS calls":>9} {"peak RSS":>9}')
+    for result in allResults:
+        for run, runResult in enumerate(result["runs"]):
+            peakRss = formatBytes(result["peakRssKB"] * 1024) if run == 0 else ""
+            print(f'{result["service"]:<13} {run:>3} {runResult["wallTime"]:>8.3f} {runResult["ontapCalls"]:>11} '
+                  f'{formatBytes(runResult["ontapBytes"]):>11} {sum(runResult["awsCalls"].values()):>9} {peakRss:>9}')
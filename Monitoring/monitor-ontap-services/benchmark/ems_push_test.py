@@ -0,0 +1,184 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program tests the EMS push mode of monitor_ontap_services.py without a
+# live FSxN or any AWS resources. It:
+#   1. Runs the lambda_handler once, against mock_ontap_server.py, with
+#      emsPushUrl set to a local HTTP receiver. That run polls for the EMS
+#      events and registers the EMS filter and destination with the mock.
+#   2. Creates new EMS events in the mock and has it push them, like ONTAP
+#      would, to the receiver. The receiver passes them to the lambda_handler
+#      the same way a Lambda function URL would.
+#   3. Runs the lambda_handler again, to show the EMS events are no longer
+#      polled for.
+#   4. Runs the lambda_handler without emsPushUrl, to show the destination is
+#      removed and the EMS events are polled for again.
+# The AWS services are faked by the "moto" package.
+#
+# It requires the packages in the Lambda layer (cronsim and pytz), boto3,
+# moto, and the openssl command. For example:
+#   pip install boto3 moto cronsim pytz
+#   python3 ems_push_test.py --events 100
+################################################################################
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import mock_ontap_server
+
+emsRules = [{"name": "wafl.*|raid.*", "severity": "error|alert|emergency", "message": "", "filter": ""},
+            {"name": "arw.volume.state", "severity": "", "message": "", "filter": ""}]
+
+################################################################################
+# This function starts an HTTP server that passes the requests it receives to
+# the handler, as a Lambda function URL event. It returns the server.
+################################################################################
+def startReceiver(handler):
+    class ReceiverHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            length = int(self.headers.get("Content-Length", 0))
+            event = {
+                "rawPath": url.path,
+                "queryStringParameters": {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()},
+                "headers": {key.lower(): value for key, value in self.headers.items()},
+                "body": self.rfile.read(length).decode('UTF-8'),
+                "isBase64Encoded": False,
+                "requestContext": {"http": {"method": "POST", "path": url.path}}
+            }
+            response = handler(event, None)
+            data = response.get("body", "").encode('UTF-8')
+            self.send_response(response.get("statusCode", 200))
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+    #
+    # The handler isn't meant to be run concurrently in one process, so only
+    # handle one request at a time, like a single Lambda instance would.
+    server = http.server.HTTPServer(("127.0.0.1", 0), ReceiverHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+################################################################################
+# This function runs the test and prints the results.
+################################################################################
+def runTest(args):
+    from moto import mock_aws
+    import boto3
+
+    region = "us-west-2"
+    certFile, keyFile = mock_ontap_server.createSelfSignedCert(tempfile.mkdtemp())
+    mockOntap = mock_ontap_server.MockOntap(volumes=100, emsEvents=args.initial_events)
+    server = mock_ontap_server.startServer(mockOntap, certFile=certFile, keyFile=keyFile)
+
+    with mock_aws():
+        s3Client = boto3.client("s3", region)
+        s3Client.create_bucket(Bucket="emspush", CreateBucketConfiguration={"LocationConstraint": region})
+        secretArn = boto3.client("secretsmanager", region).create_secret(Name="emspush", SecretString=json.dumps({"username": "admin", "password": "password"}))["ARN"]
+        topicArn = boto3.client("sns", region).create_topic(Name="emspush")["TopicArn"]
+
+        ontapAdminServer = f'127.0.0.1:{server.server_address[1]}'
+        conditions = {"services": [{"name": "ems", "rules": emsRules}]}
+        s3Client.put_object(Bucket="emspush", Key=f'{ontapAdminServer}-conditions', Body=json.dumps(conditions).encode('UTF-8'))
+
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        os.environ["AWS_LAMBDA_FUNCTION_NAME"] = "emspush"  # Keeps the module from running the handler when imported.
+        import monitor_ontap_services
+        import logging
+        logging.disable(logging.CRITICAL)
+        receiver = startReceiver(monitor_ontap_services.lambda_handler)
+
+        os.environ.update({
+            "OntapAdminServer": ontapAdminServer,
+            "s3BucketName": "emspush",
+            "s3BucketRegion": region,
+            "secretArn": secretArn,
+            "secretUsernameKey": "username",
+            "secretPasswordKey": "password",
+            "snsTopicArn": topicArn,
+            "emsPushUrl": f'http://127.0.0.1:{receiver.server_address[1]}/ems',
+            "emsPushToken": "not-a-real-token",
+            "metricsFormat": "none"
+        })
+        #
+        # The first run polls for the events and registers the destination.
+        mockOntap.resetStats()
+        monitor_ontap_services.lambda_handler({}, None)
+        stats = mockOntap.resetStats()
+        print(f'Polling run: {stats.get("/api/support/ems/events", {}).get("calls", 0)} EMS event API calls, '
+              f'filters registered: {list(mockOntap.emsFilters)}, destinations registered: {list(mockOntap.emsDestinations)}')
+        if len(mockOntap.emsDestinations) == 0:
+            print("Error, the EMS destination was not registered.")
+            sys.exit(1)
+        #
+        # Push new events, and see how long it takes to alert on them.
+        records = [mockOntap.addEMSEvent() for _ in range(args.events)]
+        startTime = time.perf_counter()
+        results = mockOntap.pushEMSEvents(records, asJson=args.json)
+        elapsed = time.perf_counter() - startTime
+        failures = [result for result in results if result["status"] != 200]
+        alerts = sum(json.loads(result["body"])["alerts"] for result in results if result["status"] == 200)
+        latencies = sorted(result["seconds"] for result in results)
+        print(f'Pushed {len(results)} of {len(records)} new events (the rest were excluded by the EMS filter) in {elapsed:.3f}s, '
+              f'{alerts} alerts sent, {len(failures)} failed.')
+        if len(latencies) > 0:
+            print(f'Push to alert latency: median {latencies[len(latencies) // 2] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms.')
+        #
+        # A push without the token should be rejected.
+        destination = next(iter(mockOntap.emsDestinations.values()))
+        destination["destination"] = destination["destination"].replace("token=", "token=wrong")
+        rejected = mockOntap.pushEMSEvents([mockOntap.addEMSEvent("wafl.vol.full", "error")])
+        print(f'Push with an invalid token: HTTP status {rejected[0]["status"]}.')
+        #
+        # The next scheduled run shouldn't poll for the events.
+        mockOntap.resetStats()
+        monitor_ontap_services.lambda_handler({}, None)
+        stats = mockOntap.resetStats()
+        print(f'Next scheduled run: {stats.get("/api/support/ems/events", {}).get("calls", 0)} EMS event API calls.')
+        #
+        # Once push mode is turned off, the destination should be removed, and
+        # the events polled for again.
+        del os.environ["emsPushUrl"]
+        monitor_ontap_services.lambda_handler({}, None)
+        stats = mockOntap.resetStats()
+        print(f'Run without emsPushUrl: {stats.get("/api/support/ems/events", {}).get("calls", 0)} EMS event API calls, '
+              f'destinations registered: {list(mockOntap.emsDestinations)}')
+        receiver.shutdown()
+        server.shutdown()
+
+    if len(failures) > 0:
+        sys.exit(1)
+
+################################################################################
+# Main logic starts here.
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test the EMS push mode of monitor_ontap_services.py.")
+    parser.add_argument("--events", type=int, default=100, help="Number of new EMS events to push.")
+    parser.add_argument("--initial-events", type=int, default=1000, help="Number of EMS events in the mock before the first run.")
+    parser.add_argument("--json", action="store_true", help="Push the events as JSON instead of XML.")
+    runTest(parser.parse_args())
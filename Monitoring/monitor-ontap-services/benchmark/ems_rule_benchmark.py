@@ -0,0 +1,128 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program measures how many EMS events per second can be checked against
+# the EMS matching conditions. It compares the original way of doing it, where
+# every rule is evaluated for every event with four re.search() calls, against
+# EMSRuleEngine.matches() in monitor_ontap_services.py. It doesn't go through
+# HTTP or any AWS services. The events come from mock_ontap_server.py, and are
+# handed directly to the matching code.
+#
+# The matching conditions are the "ems" service of the conditions file passed
+# with the --conditions option, or a set of rules like the ones typically used
+# if it isn't given.
+#
+# To compare against another version of monitor_ontap_services.py, pass its
+# path with the --script option. For example, to compare against the previous
+# commit:
+#   git show HEAD~1:./monitor_ontap_services.py > /tmp/monitor_ontap_services_before.py
+#   python3 ems_rule_benchmark.py --script /tmp/monitor_ontap_services_before.py
+# If that version doesn't have EMSRuleEngine, only the original way is measured.
+#
+# It requires the packages in the Lambda layer (cronsim and pytz). For example:
+#   pip install cronsim pytz
+#   python3 ems_rule_benchmark.py --events 100000 --runs 3
+################################################################################
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import re
+import time
+
+import mock_ontap_server
+
+os.environ["AWS_LAMBDA_FUNCTION_NAME"] = "benchmark"  # Keeps the module from running the handler when imported.
+
+rules = [{"name": "wafl.vol.*", "severity": "error|alert|emergency", "message": "", "filter": ""},
+         {"name": "raid.disk.failed", "severity": "", "message": "", "filter": ""},
+         {"name": "callhome.battery.low", "severity": "", "message": "", "filter": ""},
+         {"name": "sms.status.out.of.sync", "severity": "", "message": "", "filter": ""},
+         {"name": "secd.cifsAuth.problem", "severity": "error|alert", "message": "volume", "filter": "vol1[0-9]\\."},
+         {"name": "arw.volume.state", "severity": "", "message": "", "filter": ""},
+         {"name": "mgmtgwd.jobmgr.*", "severity": "alert|emergency", "message": "vol[0-9]+\\.", "filter": ""},
+         {"name": "", "severity": "emergency", "message": "", "filter": ""}]
+
+################################################################################
+# This function checks the events the way processEMSEvents() originally did,
+# and returns the number of them that matched a rule.
+################################################################################
+def perRuleSearch(events, rules):
+    matches = 0
+    for record in events:
+        for rule in rules:
+            messageFilter = rule.get("filter")
+            if messageFilter == None or messageFilter == "":
+                messageFilter = "ThisShouldn'tMatchAnything"
+
+            if (not re.search(messageFilter, record["log_message"]) and
+                re.search(rule["name"], record["message"]["name"]) and
+                re.search(rule["severity"], record["message"]["severity"]) and
+                re.search(rule["message"], record["log_message"])):
+                matches += 1
+                break
+    return matches
+
+################################################################################
+# This function checks the events with EMSRuleEngine, and returns the number
+# of them that matched a rule. The engine is created on every call, like it
+# is on every run, so the time to compile the rules is included.
+################################################################################
+def ruleEngine(events, rules):
+    engine = monitor_ontap_services.EMSRuleEngine(rules)
+    matches = 0
+    for record in events:
+        if engine.matches(record["message"]["name"], record["message"]["severity"], record["log_message"]):
+            matches += 1
+    return matches
+
+################################################################################
+# Main logic starts here.
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the EMS event matching of monitor_ontap_services.py.")
+    parser.add_argument("--events", type=int, default=100000, help="Number of EMS events.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of times to check the events.")
+    parser.add_argument("--conditions", help="Path of a matching conditions file to take the EMS rules from.")
+    parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "monitor_ontap_services.py"), help="Path of the monitor_ontap_services.py to benchmark.")
+    args = parser.parse_args()
+
+    spec = importlib.util.spec_from_file_location("monitor_ontap_services", args.script)
+    monitor_ontap_services = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(monitor_ontap_services)
+    logging.disable(logging.CRITICAL)
+    monitor_ontap_services.logger = logging.getLogger("mon_fsxn_service")
+
+    if args.conditions is not None:
+        with open(args.conditions) as conditionsFile:
+            conditions = json.load(conditionsFile)
+        rules = next(service["rules"] for service in conditions["services"] if service["name"] == "ems")
+
+    mockOntap = mock_ontap_server.MockOntap(volumes=100, emsEvents=args.events, snapmirrors=0, quotas=0)
+    events = mockOntap.emsEvents
+
+    methods = [("re.search per rule", perRuleSearch)]
+    if hasattr(monitor_ontap_services, "EMSRuleEngine"):
+        methods.append(("EMSRuleEngine", ruleEngine))
+
+    print(f'{"method":<20} {"run":>3} {"seconds":>8} {"events/s":>12} {"matches":>8}')
+    for methodName, method in methods:
+        for run in range(args.runs):
+            startTime = time.perf_counter()
+            matches = method(events, rules)
+            elapsed = time.perf_counter() - startTime
+            print(f'{methodName:<20} {run:>3} {elapsed:>8.3f} {args.events / elapsed:>12,.0f} {matches:>8}')
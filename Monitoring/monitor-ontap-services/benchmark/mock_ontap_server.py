@@ -0,0 +1,458 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program is a stand-in for the ONTAP REST API, as used by
+# monitor_ontap_services.py. It serves synthetic data, at a configurable
+# scale and latency, so the performance of the monitoring program can be
+# measured without a live FSxN. It supports the "fields", "max_records" and
+# "is_constituent" query parameters, and the "time=>=" filter on EMS events,
+# and it pages through the collections with "_links.next" like ONTAP does.
+# All other query parameters are ignored.
+#
+# It keeps track of the number of calls made, and the bytes returned, for
+# each endpoint. They can be retrieved from the /_stats endpoint.
+#
+# EMS filters and REST API destinations can be created and deleted. New EMS
+# events, created with addEMSEvent(), can be pushed to the destinations, like
+# ONTAP would, with pushEMSEvents().
+#
+# It can either be run on its own, or used by benchmark.py.
+################################################################################
+
+import argparse
+import datetime
+import fnmatch
+import http.server
+import json
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from xml.sax.saxutils import escape
+
+################################################################################
+# This function creates a self-signed certificate, with the openssl command,
+# so the server can use HTTPS like ONTAP does. It returns the names of the
+# certificate and key files.
+################################################################################
+def createSelfSignedCert(directory):
+    certFile = os.path.join(directory, "mock_ontap.crt")
+    keyFile = os.path.join(directory, "mock_ontap.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", keyFile, "-out", certFile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certFile, keyFile
+
+################################################################################
+# This function returns a copy of the record with only the fields requested.
+# The fields are a comma separated list of, possibly dotted, field names. The
+# key fields (uuid, name and index) are always returned, like ONTAP does.
+################################################################################
+def selectFields(record, fields):
+    if fields is None or "*" in fields:
+        return record
+
+    selected = {}
+    for field in fields + ["uuid", "name", "index"]:
+        parts = field.split(".")
+        source = record
+        for part in parts:
+            if not isinstance(source, dict) or part not in source:
+                break
+            source = source[part]
+        else:
+            target = selected
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = source
+    return selected
+
+################################################################################
+# This class holds the synthetic cluster data, and answers the API calls.
+################################################################################
+class MockOntap:
+    emsMessageNames = ["wafl.vol.full", "wafl.vol.almostFull", "raid.disk.failed", "callhome.battery.low",
+                       "sms.status.out.of.sync", "secd.cifsAuth.problem", "arw.volume.state",
+                       "mgmtgwd.jobmgr.jobcomplete.failure", "kern.uptime.filer", "nblade.cifs.share.access"]
+    emsSeverities = ["emergency", "alert", "error", "notice", "informational", "debug"]
+
+    def __init__(self, volumes=1000, constituents=0, aggregates=4, emsEvents=1000, snapmirrors=100, quotas=1000,
+                 svms=10, interfaces=20, latency=0.0, seed=1):
+        self.latency = latency
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.emsFilters = {}
+        self.emsDestinations = {}
+        self.rand = rand = random.Random(seed)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        self.cluster = {
+            "name": "mockcluster",
+            "uuid": "00000000-0000-0000-0000-000000000000",
+            "version": {"full": "NetApp Release 9.14.1P5: Thu Jun 20 00:00:00 UTC 2024"},
+            "timezone": {"name": "Etc/UTC"}
+        }
+
+        self.svms = [{"uuid": f"svm-{i}", "name": f"svm{i}", "state": "stopped" if i == 0 else "running"} for i in range(svms)]
+        self.nfsServices = [{"svm": {"uuid": svm["uuid"], "name": svm["name"]}, "state": "offline" if i == 1 else "online"} for i, svm in enumerate(self.svms)]
+        self.cifsServices = [{"svm": {"uuid": svm["uuid"], "name": svm["name"]}, "enabled": i != 2} for i, svm in enumerate(self.svms)]
+        self.interfaces = [{"uuid": f"lif-{i}", "name": f"lif{i}", "state": "down" if i == 0 else "up"} for i in range(interfaces)]
+
+        self.aggregates = [{"uuid": f"aggr-{i}", "name": f"aggr{i}", "space": {"block_storage": {"used_percent": rand.randint(10, 99), "size": 10**13, "used": 10**12, "available": 9 * 10**12}}} for i in range(aggregates)]
+
+        self.volumes = []
+        for i in range(volumes + constituents):
+            svm = self.svms[i % len(self.svms)]
+            isConstituent = i >= volumes
+            maxFiles = rand.randint(10**5, 10**7)
+            self.volumes.append({
+                "uuid": f"vol-{i}",
+                "name": f"vol{i}" if not isConstituent else f"fg{i % 10}__{i:04d}",
+                "svm": {"uuid": svm["uuid"], "name": svm["name"]},
+                "state": "offline" if rand.random() < 0.01 else "online",
+                "is_constituent": isConstituent,
+                "space": {"size": 10**11, "used": 10**10, "available": 9 * 10**10, "percent_used": rand.choice([10, 20, 50, 70, 85, 92, 97])},
+                "files": {"maximum": maxFiles, "used": int(maxFiles * rand.choice([0.01, 0.1, 0.5, 0.85, 0.97]))}
+            })
+
+        self.schedules = [{"uuid": f"sched-{i}", "name": f"sched{i}", "type": "cron", "cron": {"minutes": [i * 5 % 60], "hours": [] if i % 2 else [i % 24]}} for i in range(5)]
+        self.policies = [{"uuid": f"policy-{i}", "name": f"policy{i}"} for i in range(8)]
+        for i in range(len(self.schedules)):
+            self.policies[i]["transfer_schedule"] = {"uuid": self.schedules[i]["uuid"]}
+        self.snapmirrors = []
+        for i in range(snapmirrors):
+            healthy = rand.random() > 0.1
+            relationship = {
+                "uuid": f"sm-{i}",
+                "source": {"path": f"srcsvm:vol{i}", "cluster": {"name": "sourcecluster"}},
+                "destination": {"path": f"{self.svms[i % len(self.svms)]['name']}:vol{i}_dp"},
+                "state": "snapmirrored",
+                "healthy": healthy,
+                "unhealthy_reason": [] if healthy else [{"message": "Transfer failed."}],
+                "lag_time": rand.choice(["PT5M", "PT1H", "PT1H30M12S", "P1D", "P2DT3H"]),
+                "policy": {"uuid": self.policies[i % len(self.policies)]["uuid"]}
+            }
+            if i % 3 == 0:
+                relationship["transfer_schedule"] = {"uuid": self.schedules[i % len(self.schedules)]["uuid"]}
+            if i % 7 == 0:
+                relationship["transfer"] = {"uuid": f"transfer-{i}", "state": "transferring", "bytes_transferred": 0}
+            self.snapmirrors.append(relationship)
+
+        self.quotas = []
+        for i in range(quotas):
+            volume = self.volumes[i % max(volumes, 1)] if volumes > 0 else {"name": "vol0", "svm": {"name": "svm0"}}
+            quota = {
+                "index": i,
+                "type": "user" if i % 2 else "tree",
+                "svm": volume["svm"],
+                "volume": {"name": volume["name"]},
+                "qtree": {"name": f"qtree{i}"},
+                "space": {"used": {"total": 10**9, "hard_limit_percent": rand.choice([5, 50, 90, 96, 99]), "soft_limit_percent": rand.choice([5, 50, 96])}},
+                "files": {"used": {"total": 1000, "hard_limit_percent": rand.choice([1, 50, 97])}}
+            }
+            if i % 2:
+                quota["users"] = [{"name": f"user{i}", "id": str(i)}]
+            self.quotas.append(quota)
+
+        self.emsEvents = []
+        for i in range(emsEvents):
+            eventTime = now - datetime.timedelta(seconds=emsEvents - i)
+            self.emsEvents.append({
+                "index": i + 1,
+                "node": {"name": f"mockcluster-0{i % 2 + 1}"},
+                "time": eventTime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "message": {"name": rand.choice(self.emsMessageNames), "severity": rand.choice(self.emsSeverities)},
+                "log_message": f"Synthetic EMS event {i + 1} for volume vol{rand.randint(0, max(volumes - 1, 0))}."
+            })
+
+        self.collections = {
+            "/api/svm/svms": self.svms,
+            "/api/protocols/nfs/services": self.nfsServices,
+            "/api/protocols/cifs/services": self.cifsServices,
+            "/api/network/ip/interfaces": self.interfaces,
+            "/api/storage/aggregates": self.aggregates,
+            "/api/storage/volumes": self.volumes,
+            "/api/storage/quota/reports": self.quotas,
+            "/api/snapmirror/relationships": self.snapmirrors,
+            "/api/snapmirror/policies": self.policies,
+            "/api/cluster/schedules": self.schedules,
+            "/api/support/ems/events": self.emsEvents,
+            "/api/private/cli/system/node/virtual-machine/instance/show-settings": [{"node": "mockcluster-01"}, {"node": "mockcluster-02"}]
+        }
+
+    ############################################################################
+    # This method returns the HTTP status and the body for an API call.
+    ############################################################################
+    def handle(self, path, query):
+        fields = query["fields"][0].split(",") if "fields" in query else None
+        if path == "/api/cluster":
+            return 200, selectFields(self.cluster, fields)
+
+        if path in self.collections:
+            records = self.collections[path]
+            #
+            # Apply the filters that change what monitor_ontap_services sees.
+            if path == "/api/storage/volumes":
+                isConstituent = query.get("is_constituent", ["false"])[0].split("|")
+                records = [record for record in records if str(record["is_constituent"]).lower() in isConstituent]
+            if path == "/api/support/ems/events" and query.get("time", [""])[0].startswith(">="):
+                since = query["time"][0][2:]
+                records = [record for record in records if record["time"] >= since]
+
+            start = int(query.get("start", ["0"])[0])
+            maxRecords = int(query["max_records"][0]) if "max_records" in query else len(records)
+            page = records[start:start + maxRecords]
+            body = {
+                "records": [selectFields(record, fields) for record in page],
+                "num_records": len(page)
+            }
+            if start + maxRecords < len(records):
+                nextQuery = {key: value for key, value in query.items() if key != "start"}
+                nextQuery["start"] = [str(start + maxRecords)]
+                body["_links"] = {"next": {"href": f'{path}?{urllib.parse.urlencode(nextQuery, doseq=True, safe="*|,>=:")}'}}
+            return 200, body
+        #
+        # Individual policy and schedule lookups.
+        for collection in ("/api/snapmirror/policies/", "/api/cluster/schedules/"):
+            if path.startswith(collection):
+                uuid = path[len(collection):]
+                for record in self.collections[collection[:-1]]:
+                    if record["uuid"] == uuid:
+                        return 200, selectFields(record, fields)
+
+        return 404, {"error": {"message": f"API not found: {path}", "code": "4"}}
+
+    ############################################################################
+    # This method creates or deletes an EMS filter or destination. It returns
+    # the HTTP status and the body.
+    ############################################################################
+    def handleChange(self, method, path, body):
+        for collection, objects in (("/api/support/ems/filters", self.emsFilters), ("/api/support/ems/destinations", self.emsDestinations)):
+            if method == "POST" and path == collection:
+                if body.get("name") in objects:
+                    return 409, {"error": {"message": f'"{body.get("name")}" already exists.', "code": "983089"}}
+                objects[body["name"]] = body
+                return 201, {}
+            if method == "DELETE" and path.startswith(collection + "/"):
+                name = urllib.parse.unquote(path[len(collection) + 1:])
+                if objects.pop(name, None) is None:
+                    return 404, {"error": {"message": f'"{name}" not found.', "code": "4"}}
+                return 200, {}
+
+        return 404, {"error": {"message": f"API not found: {path}", "code": "4"}}
+
+    ############################################################################
+    # This method creates a new EMS event and returns it.
+    ############################################################################
+    def addEMSEvent(self, name=None, severity=None):
+        with self.lock:
+            index = len(self.emsEvents) + 1
+            record = {
+                "index": index,
+                "node": {"name": f"mockcluster-0{index % 2 + 1}"},
+                "time": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "message": {"name": name or self.rand.choice(self.emsMessageNames), "severity": severity or self.rand.choice(self.emsSeverities)},
+                "log_message": f"Synthetic EMS event {index} for volume vol{self.rand.randint(0, max(len(self.volumes) - 1, 0))}."
+            }
+            self.emsEvents.append(record)
+        return record
+
+    ############################################################################
+    # This method returns True if one of the rules of the EMS filter includes
+    # the event. Like ONTAP, an event that no rule matches is excluded.
+    ############################################################################
+    def filterIncludes(self, filterName, record):
+        emsFilter = self.emsFilters.get(filterName)
+        if emsFilter is None:
+            return False
+        for rule in sorted(emsFilter.get("rules", []), key=lambda rule: rule.get("index", 0)):
+            criteria = rule.get("message_criteria", {})
+            severities = criteria.get("severities", "*")
+            if (fnmatch.fnmatchcase(record["message"]["name"], criteria.get("name_pattern", "*")) and
+                    (severities == "*" or record["message"]["severity"] in severities.split(","))):
+                return rule.get("type", "include") == "include"
+        return False
+
+    ############################################################################
+    # This method pushes the EMS events to all the REST API destinations whose
+    # filters include them, one POST per event, like ONTAP does. They are
+    # sent as XML, unless "asJson" is True. It returns a list with the
+    # destination, event index, HTTP status, response body and the seconds
+    # each POST took.
+    ############################################################################
+    def pushEMSEvents(self, records, asJson=False):
+        results = []
+        for destination in list(self.emsDestinations.values()):
+            if destination.get("type") != "rest_api":
+                continue
+            for record in records:
+                if not any(self.filterIncludes(emsFilter["name"], record) for emsFilter in destination.get("filters", [])):
+                    continue
+                if asJson:
+                    body = json.dumps(record).encode('UTF-8')
+                    contentType = "application/json"
+                else:
+                    body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                            '<netapp version="1.0" xmlns="http://www.netapp.com/filer/admin"><ems-message-info>'
+                            f'<seq-num>{record["index"]}</seq-num><message-time>{escape(record["time"])}</message-time>'
+                            f'<node>{escape(record["node"]["name"])}</node><message-name>{escape(record["message"]["name"])}</message-name>'
+                            f'<severity>{escape(record["message"]["severity"])}</severity><event>{escape(record["log_message"])}</event>'
+                            '</ems-message-info></netapp>').encode('UTF-8')
+                    contentType = "application/xml"
+                request = urllib.request.Request(destination["destination"], data=body, method="POST", headers={"Content-Type": contentType})
+                startTime = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(request, timeout=30) as response:
+                        status, responseBody = response.status, response.read().decode('UTF-8')
+                except urllib.error.HTTPError as err:
+                    status, responseBody = err.code, err.read().decode('UTF-8')
+                results.append({"destination": destination["name"], "index": record["index"], "status": status,
+                                "body": responseBody, "seconds": time.perf_counter() - startTime})
+        return results
+
+    ############################################################################
+    # This method records a call to an endpoint.
+    ############################################################################
+    def recordCall(self, path, numBytes):
+        with self.lock:
+            stat = self.stats.setdefault(path, {"calls": 0, "bytes": 0})
+            stat["calls"] += 1
+            stat["bytes"] += numBytes
+
+    ############################################################################
+    # This method returns the statistics collected so far and resets them.
+    ############################################################################
+    def resetStats(self):
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+        return stats
+
+################################################################################
+# This function returns an HTTP request handler class that serves the data
+# from the MockOntap object passed in.
+################################################################################
+def makeHandler(mockOntap):
+    class MockOntapHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            path = url.path.rstrip("/")
+            if path == "/_stats":
+                status, body = 200, mockOntap.resetStats()
+            else:
+                if mockOntap.latency > 0:
+                    time.sleep(mockOntap.latency)
+                status, body = mockOntap.handle(path, urllib.parse.parse_qs(url.query))
+            data = json.dumps(body).encode('UTF-8')
+            if path != "/_stats":
+                mockOntap.recordCall(path, len(data))
+
+            self.sendResponse(status, data)
+
+        def do_POST(self):
+            self.changeObject("POST")
+
+        def do_DELETE(self):
+            self.changeObject("DELETE")
+
+        def changeObject(self, method):
+            path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                body = json.loads(self.rfile.read(length)) if length > 0 else {}
+            except json.decoder.JSONDecodeError:
+                status, response = 400, {"error": {"message": "Invalid JSON.", "code": "262179"}}
+            else:
+                status, response = mockOntap.handleChange(method, path, body)
+            data = json.dumps(response).encode('UTF-8')
+            mockOntap.recordCall(f'{method} {path}', len(data))
+            self.sendResponse(status, data)
+
+        def sendResponse(self, status, data):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/hal+json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockOntapHandler
+
+################################################################################
+# This function starts the server in a background thread. It returns the
+# server, whose "server_address" holds the address and port it listens on.
+################################################################################
+def startServer(mockOntap, host="127.0.0.1", port=0, certFile=None, keyFile=None):
+    server = http.server.ThreadingHTTPServer((host, port), makeHandler(mockOntap))
+    server.daemon_threads = True
+    if certFile is not None:
+        sslContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        sslContext.load_cert_chain(certFile, keyFile)
+        server.socket = sslContext.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+################################################################################
+# This function adds the options that control the scale of the synthetic
+# cluster to an argument parser. It is shared with benchmark.py.
+################################################################################
+def addScaleArguments(parser):
+    parser.add_argument("--volumes", type=int, default=1000, help="Number of volumes.")
+    parser.add_argument("--constituents", type=int, default=0, help="Number of FlexGroup constituent volumes.")
+    parser.add_argument("--aggregates", type=int, default=4, help="Number of aggregates.")
+    parser.add_argument("--ems-events", type=int, default=1000, help="Number of EMS events.")
+    parser.add_argument("--snapmirrors", type=int, default=100, help="Number of SnapMirror relationships.")
+    parser.add_argument("--quotas", type=int, default=1000, help="Number of quota report entries.")
+    parser.add_argument("--svms", type=int, default=10, help="Number of SVMs.")
+    parser.add_argument("--interfaces", type=int, default=20, help="Number of network interfaces.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each API call.")
+
+################################################################################
+# This function creates a MockOntap object from the parsed arguments.
+################################################################################
+def mockOntapFromArgs(args):
+    return MockOntap(volumes=args.volumes, constituents=args.constituents, aggregates=args.aggregates,
+                     emsEvents=args.ems_events, snapmirrors=args.snapmirrors, quotas=args.quotas,
+                     svms=args.svms, interfaces=args.interfaces, latency=args.latency)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic ONTAP REST API.")
+    addScaleArguments(parser)
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8443, help="Port to listen on.")
+    parser.add_argument("--http", action="store_true", help="Use HTTP instead of HTTPS.")
+    args = parser.parse_args()
+
+    certFile = keyFile = None
+    if not args.http:
+        certFile, keyFile = createSelfSignedCert(tempfile.mkdtemp())
+    server = startServer(mockOntapFromArgs(args), args.host, args.port, certFile, keyFile)
+    print(f'Serving a synthetic ONTAP API on {"http" if args.http else "https"}://{args.host}:{server.server_address[1]}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,78 @@
+#!/bin/python3
+################################################################################
+# THIS SOFTWARE IS PROVIDED BY NETAPP "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL NETAPP BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR'
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+################################################################################
+#
+################################################################################
+# This program measures how many SnapMirror relationships per second
+# processSnapMirrorRelationships() in monitor_ontap_services.py can evaluate.
+# Unlike benchmark.py, it doesn't go through HTTP or any AWS services. The
+# relationship records, from mock_ontap_server.py, are handed directly to the
+# function, so only the time spent evaluating them is measured. The first
+# run sends the alerts, the following ones find them already reported.
+#
+# It requires the packages in the Lambda layer (cronsim and pytz). For example:
+#   pip install cronsim pytz
+#   python3 snapmirror_benchmark.py --snapmirrors 50000 --runs 3
+################################################################################
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import mock_ontap_server
+
+os.environ["AWS_LAMBDA_FUNCTION_NAME"] = "benchmark"  # Keeps the module from running the handler when imported.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import monitor_ontap_services
+
+rules = [{"maxLagTime": 86400}, {"maxLagTimePercent": 200}, {"healthy": False}, {"stalledTransferSeconds": 600}]
+
+################################################################################
+# This class is a ClusterContext that returns the records straight from the
+# MockOntap object, instead of calling the ONTAP API.
+################################################################################
+class BenchmarkContext(monitor_ontap_services.ClusterContext):
+    def __init__(self, mockOntap):
+        config = {**monitor_ontap_services.optionalVariables, "OntapAdminServer": "mockcluster"}
+        super().__init__(config, None, None, monitor_ontap_services.StateStore(None, config))
+        self.mockOntap = mockOntap
+        self.clusterName = "mockcluster"
+        self.clusterTimezone = "Etc/UTC"
+
+    def getRecords(self, path, fields, query="", returnTimeout=15):
+        return iter(self.mockOntap.collections[path])
+
+################################################################################
+# Main logic starts here.
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SnapMirror relationship evaluation of monitor_ontap_services.py.")
+    parser.add_argument("--snapmirrors", type=int, default=50000, help="Number of SnapMirror relationships.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of times to evaluate the relationships.")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    monitor_ontap_services.logger = logging.getLogger("mon_fsxn_service")
+    mockOntap = mock_ontap_server.MockOntap(volumes=100, emsEvents=0, quotas=0, snapmirrors=args.snapmirrors)
+    ctx = BenchmarkContext(mockOntap)
+
+    print(f'{"run":>3} {"seconds":>8} {"relationships/s":>16} {"alerts":>7}')
+    service = {"name": "snapmirror", "rules": rules}
+    for run in range(args.runs):
+        alertsBefore = len(ctx.alerts.alerts)
+        startTime = time.perf_counter()
+        monitor_ontap_services.processSnapMirrorRelationships(ctx, service)
+        elapsed = time.perf_counter() - startTime
+        print(f'{run:>3} {elapsed:>8.3f} {args.snapmirrors / elapsed:>16,.0f} {len(ctx.alerts.alerts) - alertsBefore:>7}')
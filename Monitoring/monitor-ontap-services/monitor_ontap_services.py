@@ -23,9 +23,21 @@
 ################################################################################
 
 import json
+import gzip
+import zlib
+import array
+import operator
 import re
 import os
+import urllib.parse
+import base64
+import hmac
+import hashlib
+import xml.etree.ElementTree
 import datetime
+import time
+import threading
+import concurrent.futures
 import pytz
 import logging
 from logging.handlers import SysLogHandler
@@ -41,183 +53,748 @@ eventResilience = 4 # Times an event has to be missing before it is removed
                     # events would often drop some events and then including
                     # them in the subsequent calls. If I don't "age" the
                     # alert history duplicate alerts will be sent.
+stateJournalDefaultMaxRatio = 0.25  # How big the state journal can get, relative to the snapshot, before it is compacted.
 initialVersion = "Initial Run"  # The version to store if this is the first
                                 # time the program has been run against a
                                 # FSxN.
-
-################################################################################
-# This function is used to extract the one-, two-, or three-digit number from
-# the string passed in, starting at the 'start' character. Then, multiple it
-# by the unit after the number:
-# D = Day = 60*60*24
-# H = Hour = 60*60
-# M = Minutes = 60
+maxLogEventsPerBatch = 10000    # CloudWatch PutLogEvents limits.
+maxLogBatchBytes = 1048576
+logEventOverheadBytes = 26
+maxSnsMessageBytes = 256000     # SNS messages can be up to 256KiB. Leave some room.
+defaultRequestTimeoutSeconds = 60   # The longest an ONTAP API call can take, unless the run is about to run out of time.
+defaultDeadlineMarginSeconds = 10   # The time left, at the end of a Lambda invocation, to deliver the alerts and save the state.
+defaultMaxConcurrentRequests = 8    # The most ONTAP API calls in flight, to one cluster, at a time.
 #
-# It returns a tuple that has the extracted number and the end position.
-################################################################################
-def getNumber(string, start):
+# The capacity history, used to forecast when volumes and aggregates will be full.
+capacityHistoryDefaultSamples = 48          # The number of samples kept for each volume and aggregate.
+capacityHistoryDefaultIntervalMinutes = 60  # The minimum time between samples.
+capacityHistoryHalfLife = 12                # The weight of a sample halves every this many samples.
 
-    if len(string) <= start:
-        return (0, start)
-    #
-    # Check to see if it is a 1, 2 or 3 digit number.
-    startp1=start+1   # Single digit
-    startp2=start+2   # Double digit
-    startp3=start+3   # Triple digit
-    if re.search('[0-9]', string[startp1:startp2]) and re.search('[0-9]', string[startp2:startp3]):
-        end=startp3
-    elif re.search('[0-9]', string[startp1:startp2]):
-        end=startp2
-    else:
-        end=startp1
-
-    num=int(string[start:end])
-
-    endp1=end+1
-    if string[end:endp1] == "D":
-        num=num*60*60*24
-    elif string[end:endp1] == "H":
-        num=num*60*60
-    elif string[end:endp1] == "M":
-        num=num*60
-    elif string[end:endp1] != "S":
-        logger.warning(f'Unknown lag time specifier "{string[end:endp1]}".')
-
-    return (num, endp1)
+knownLogStreams = set()         # The CloudWatch log streams known to exist.
+knownLogStreamsLock = threading.Lock()
+#
+# The name of the EMS filter and destination used to have ONTAP push the EMS events.
+emsPushName = "monitor_ontap_services"
+emsSeverities = ["emergency", "alert", "error", "notice", "informational", "debug"]
+#
+# The names of the elements, in an XML EMS notification, that hold each field.
+emsNotificationFields = {
+    "index": ["seq-num", "index"],
+    "time": ["time", "message-time"],
+    "node": ["node", "node-name"],
+    "name": ["message-name", "messagename", "name"],
+    "severity": ["severity", "ems-severity"],
+    "logMessage": ["log-message", "event", "message-text"]
+}
+#
+# The following are kept between invocations of a warm Lambda container, so
+# they don't have to be set up again.
+defaultCacheSeconds = 300       # How long S3 objects and secrets are reused before being checked again.
+config = None
+loggerConfigured = False
+syslogHandler = None
+awsClients = {}                 # (service, region, endpoint) -> boto3 client.
+s3ObjectCache = {}              # (bucket, key) -> body, ETag and when it was last checked.
+secretsCache = {}               # secret ARN -> secret and when it was retrieved.
+httpPool = None                 # The urllib3 PoolManager, so the connections (and TLS sessions) are reused.
+httpPoolSettings = None
+warmCacheLock = threading.Lock()
+#
+# The states of a SnapMirror transfer that is in progress.
+smActiveTransferStates = frozenset(["transferring", "finalizing", "preparing", "fasttransferring"])
+#
+# The parsed SnapMirror lag times, indexed by the ISO-8601 duration string.
+lagTimePattern = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)(?:\.\d*)?S)?)?')
+lagTimeCache = {}
+maxLagTimeCacheSize = 10000
 
 ################################################################################
 # This function is used to parse the lag time string returned by the
 # ONTAP API and return the equivalent seconds it represents.
-# The input string is assumed to follow this pattern "P#DT#H#M#S" where
-# each of those "#" can be one to three digits long. Also, if the lag isn't
-# more than 24 hours, then the "#D" isn't there and the string simply starts
-# with "PT". Similarly, if the lag time isn't more than an hour then the "#H"
-# string is missing.
+# The input string is an ISO-8601 duration like "P#DT#H#M#S", where any of
+# the fields can be missing (e.g. "PT5M"). Since the same few lag times tend
+# to show up over and over again, the results are cached. If the string can't
+# be parsed, it logs a warning and returns 0.
 ################################################################################
 def parseLagTime(string):
-    #
-    num=0
-    #
-    # First check to see if the Day field is there, by checking to see if the
-    # second character is a digit. If not, it is assumed to be 'T'.
-    includesDay=False
-    if re.search('[0-9]', string[1:2]):
-        includesDay=True
-        start=1
-    else:
-        start=2
-    data=getNumber(string, start)
-    num += data[0]
+    seconds = lagTimeCache.get(string)
+    if seconds is None:
+        match = lagTimePattern.fullmatch(string)
+        if match is None:
+            logger.warning(f'Unknown lag time format "{string}".')
+            return 0
+        days, hours, minutes, secs = match.groups()
+        seconds = (int(days or 0) * 24 + int(hours or 0)) * 3600 + int(minutes or 0) * 60 + int(secs or 0)
+        if len(lagTimeCache) >= maxLagTimeCacheSize:
+            lagTimeCache.clear()
+        lagTimeCache[string] = seconds
+    return seconds
 
-    start=data[1]
+################################################################################
+# This class holds the history of events that have already been alerted on,
+# indexed by their unique identifier, so checking if an event has already been
+# reported doesn't require a scan of all the previous events. It is stored in
+# S3 as a list of events, each having an "index" field that holds the unique
+# identifier, and a "firstSeen" field with the run number it was added in.
+# Once an event is no longer seen, the run number it was last seen in is
+# stored in its "lastSeen" field, and it is removed after it has been missing
+# for eventResilience runs. Since an event only changes when it starts, or
+# stops, being seen, a history that hasn't changed doesn't have to be saved.
+#
+# Previous versions stored a "refresh" counter in each event, that counted
+# down the runs it could still be missing. It is converted when read in.
+################################################################################
+class AlertHistory:
+    def __init__(self, events=None, runNumber=0):
+        self.runNumber = runNumber
+        self.events = {}
+        self.seen = set()
+        self.changes = {}   # Unique identifier -> the updated event, or None if it was removed.
+        self.aging = False  # True if any of the events are missing, so the run numbers need to be kept.
+        if events is not None:
+            for event in events:
+                refresh = event.pop("refresh", None)
+                if refresh is not None:
+                    event.setdefault("firstSeen", runNumber - 1)
+                    if refresh < eventResilience:
+                        event["lastSeen"] = runNumber - 1 - (eventResilience - refresh)
+                    self.changes[event["index"]] = event
+                self.events[event["index"]] = event
+
+    ############################################################################
+    # This method checks to see if an event, based on the unique identifier
+    # passed in, is in the history. It also marks it as "seen" so it won't be
+    # aged out.
+    ############################################################################
+    def exists(self, uniqueIdentifier):
+        if uniqueIdentifier in self.events:
+            self.seen.add(uniqueIdentifier)
+            return True
+
+        return False
+
+    ############################################################################
+    # This method adds an event to the history.
+    ############################################################################
+    def add(self, event):
+        event["firstSeen"] = self.runNumber
+        self.events[event["index"]] = event
+        self.seen.add(event["index"])
+        self.changes[event["index"]] = event
+
+    ############################################################################
+    # This method should be called once all the records have been processed.
+    # In a single pass it clears the "lastSeen" field on all the events that
+    # were seen, sets it on the ones that have just gone missing, and removes
+    # any that have been missing for eventResilience runs. It returns True if
+    # the history has changed and therefore needs to be saved.
+    ############################################################################
+    def age(self):
+        events = {}
+        self.aging = False
+        for uniqueIdentifier, event in self.events.items():
+            if uniqueIdentifier in self.seen:
+                if "lastSeen" in event:
+                    del event["lastSeen"]
+                    self.changes[uniqueIdentifier] = event
+            else:
+                if "lastSeen" not in event:
+                    event["lastSeen"] = self.runNumber - 1
+                    self.changes[uniqueIdentifier] = event
+                if self.runNumber - event["lastSeen"] >= eventResilience:
+                    logger.debug(f'Deleting event: {event.get("message", uniqueIdentifier)}')
+                    self.changes[uniqueIdentifier] = None
+                    continue
+                self.aging = True
+            events[uniqueIdentifier] = event
+        self.events = events
+        self.seen = set()
+        return len(self.changes) > 0
+
+    ############################################################################
+    # This method should be called instead of age() when not all the records
+    # could be processed. Since the events that weren't seen might just not
+    # have been gotten to, none of them are aged. It returns True if the
+    # history has changed and therefore needs to be saved.
+    ############################################################################
+    def keep(self):
+        self.aging = any("lastSeen" in event for event in self.events.values())
+        self.seen = set()
+        return len(self.changes) > 0
+
+    ############################################################################
+    # This method returns the history in the format it is stored in S3.
+    ############################################################################
+    def toList(self):
+        return list(self.events.values())
+
+################################################################################
+# This class collects performance metrics while monitoring a cluster, so it
+# can be seen where the time of a run is spent. Everything is recorded per
+# service (the service is tracked per thread, since the services are checked
+# concurrently):
+#   - The duration of the service check.
+#   - For each ONTAP API endpoint, the number of calls, the bytes received,
+#     and a histogram of the latency.
+#   - Other counters, like the records evaluated, alerts sent, and S3 reads
+#     and writes.
+################################################################################
+class RunMetrics:
+    latencyBuckets = [50, 100, 250, 500, 1000, 2500, 5000, 10000]  # Upper bounds in milliseconds.
+
+    def __init__(self, clusterName):
+        self.clusterName = clusterName
+        self.services = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    ############################################################################
+    # This method sets the service that the calling thread is working on.
+    ############################################################################
+    def setService(self, service):
+        self.local.service = service
+
+    ############################################################################
+    # This method returns the service that the calling thread is working on.
+    ############################################################################
+    def getService(self):
+        return getattr(self.local, "service", "general")
+
+    ############################################################################
+    # This method returns the metrics of the service the calling thread is
+    # working on. Must be called with the lock held.
+    ############################################################################
+    def getServiceMetrics(self):
+        service = self.getService()
+        serviceMetrics = self.services.get(service)
+        if serviceMetrics is None:
+            serviceMetrics = {"durationMs": 0, "counters": {}, "endpoints": {}}
+            self.services[service] = serviceMetrics
+        return serviceMetrics
+
+    ############################################################################
+    # This method records an ONTAP API call.
+    ############################################################################
+    def recordApiCall(self, endpoint, latency, numBytes):
+        path = urllib.parse.urlsplit(endpoint).path
+        latencyMs = latency * 1000
+        with self.lock:
+            endpoints = self.getServiceMetrics()["endpoints"]
+            endpointMetrics = endpoints.get(path)
+            if endpointMetrics is None:
+                endpointMetrics = {"calls": 0, "bytes": 0, "latencyMs": 0, "maxLatencyMs": 0, "latencyHistogram": [0] * (len(self.latencyBuckets) + 1)}
+                endpoints[path] = endpointMetrics
+            endpointMetrics["calls"] += 1
+            endpointMetrics["bytes"] += numBytes
+            endpointMetrics["latencyMs"] += latencyMs
+            endpointMetrics["maxLatencyMs"] = max(endpointMetrics["maxLatencyMs"], latencyMs)
+            bucket = 0
+            while bucket < len(self.latencyBuckets) and latencyMs > self.latencyBuckets[bucket]:
+                bucket += 1
+            endpointMetrics["latencyHistogram"][bucket] += 1
+
+    ############################################################################
+    # This method adds to one of the counters.
+    ############################################################################
+    def count(self, counter, amount=1):
+        with self.lock:
+            counters = self.getServiceMetrics()["counters"]
+            counters[counter] = counters.get(counter, 0) + amount
+
+    ############################################################################
+    # This method records how long the service the calling thread is working
+    # on took.
+    ############################################################################
+    def recordDuration(self, seconds):
+        with self.lock:
+            self.getServiceMetrics()["durationMs"] += seconds * 1000
+
+    ############################################################################
+    # This method returns all the metrics as a dictionary.
+    ############################################################################
+    def summary(self):
+        with self.lock:
+            services = json.loads(json.dumps(self.services))
+        for serviceMetrics in services.values():
+            serviceMetrics["durationMs"] = round(serviceMetrics["durationMs"], 1)
+            for endpointMetrics in serviceMetrics["endpoints"].values():
+                endpointMetrics["latencyMs"] = round(endpointMetrics["latencyMs"], 1)
+                endpointMetrics["maxLatencyMs"] = round(endpointMetrics["maxLatencyMs"], 1)
+        return {"cluster": self.clusterName, "latencyBucketsMs": self.latencyBuckets, "services": services}
+
+runMetrics = []                 # The RunMetrics of each cluster monitored in this run.
+runMetricsLock = threading.Lock()
+
+################################################################################
+# This class holds all the state information, for a cluster, that has to be
+# preserved between runs (e.g. the system status, and the events that have
+# already been alerted on). Optionally, it can be stored gzip compressed. It
+# is stored in two S3 objects:
+#   - The snapshot, which holds all the sections of the state.
+#   - The journal, which holds the changes made since the snapshot was
+#     written: the sections that were replaced, and the individual alert
+#     history events that were added, updated or removed.
+# Both are read at the start of a run. At the end, if anything has changed,
+# only the journal is written, unless it has grown to more than
+# stateJournalMaxRatio of the size of the snapshot. Then the changes are
+# compacted into a new snapshot instead. That way a change to a few events
+# doesn't rewrite a large alert history. The snapshot has a generation number
+# that the journal refers to, so a journal that was written before the last
+# compaction is ignored.
+#
+# The state also holds a run number, used to age the alert histories. It is
+# only saved when it is needed, that is, when an alert history has events
+# that are no longer being seen, so a run that doesn't change anything
+# doesn't write anything.
+#
+# Previous versions of this program stored each section in its own S3 object.
+# If the snapshot doesn't exist, those are read instead, so the alert history
+# is preserved when upgrading.
+################################################################################
+class StateStore:
     #
-    # If there is a 'D', then there is a 'T' between the D and the # of hours
-    # so skip pass it.
-    if includesDay:
-        start += 1
-    data=getNumber(string, start)
-    num += data[0]
+    # The sections that make up the state, and the configuration variable that
+    # holds the name of the S3 object that it was stored in, in previous versions.
+    sections = {
+        "systemStatus": "systemStatusFilename",
+        "emsEvents": "emsEventsFilename",
+        "smEvents": "smEventsFilename",
+        "smRelationships": "smRelationshipsFilename",
+        "storageEvents": "storageEventsFilename",
+        "quotaEvents": "quotaEventsFilename",
+        "vserverEvents": "vserverEventsFilename"
+    }
+
+    def __init__(self, s3Client, config, metrics=None):
+        self.s3Client = s3Client
+        self.config = config
+        self.metrics = metrics
+        self.state = {}
+        self.dirty = set()
+        self.generation = None      # The generation of the snapshot, None if it needs to be written.
+        self.snapshotBytes = 0
+        self.journal = {"sections": {}, "events": {}}
+        self.journalExists = False
+        self.runNumber = 1
+        self.keepRunNumber = False
+        self.lock = threading.Lock()  # Since the services are checked concurrently.
+
+    ############################################################################
+    # This method reads in the state from S3.
+    ############################################################################
+    def load(self):
+        body = self.readObject(self.config["stateFilename"])
+        if body is None:
+            #
+            # Since the consolidated state doesn't exist, get the state from the individual files.
+            for section, filenameVariable in self.sections.items():
+                sectionBody = self.readObject(self.config[filenameVariable])
+                if sectionBody is not None:
+                    self.state[section] = json.loads(sectionBody.decode('UTF-8'))
+                    self.dirty.add(section)
+            return
+
+        self.snapshotBytes = len(body)
+        self.state = json.loads(body.decode('UTF-8'))
+        self.generation = self.state.pop("generation", None)
+        runNumber = self.state.pop("runNumber", 0)
+        #
+        # Apply the changes made since the snapshot was written.
+        body = self.readObject(self.getJournalFilename())
+        if body is not None:
+            self.journalExists = True
+            journal = json.loads(body.decode('UTF-8'))
+            if self.generation is not None and journal.get("generation") == self.generation:
+                runNumber = journal.get("runNumber", runNumber)
+                self.journal = {"sections": journal.get("sections", {}), "events": journal.get("events", {})}
+                self.state.update(self.journal["sections"])
+                for section, changes in self.journal["events"].items():
+                    events = {event["index"]: event for event in self.state.get(section, [])}
+                    for uniqueIdentifier, event in changes.items():
+                        if event is None:
+                            events.pop(uniqueIdentifier, None)
+                        else:
+                            events[uniqueIdentifier] = event
+                    self.state[section] = list(events.values())
+        self.runNumber = runNumber + 1
+
+    ############################################################################
+    # This method returns the contents of an object in S3, uncompressed if it
+    # was compressed, or None if it doesn't exist.
+    ############################################################################
+    def readObject(self, key):
+        try:
+            self.countS3("s3Reads")
+            data = self.s3Client.get_object(Key=key, Bucket=self.config["s3BucketName"])
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] != "NoSuchKey":
+                raise err
+            return None
 
-    start=data[1]
-    data=getNumber(string, start)
-    num += data[0]
+        body = data["Body"].read()
+        if body[0:2] == b'\x1f\x8b':  # The gzip magic number.
+            body = gzip.decompress(body)
+        return body
+
+    ############################################################################
+    # This method writes an object, already encoded as JSON, to S3, compressed
+    # if configured to do so.
+    ############################################################################
+    def writeObject(self, key, body):
+        if self.config["compressState"] is not None and self.config["compressState"].lower() == "true":
+            body = gzip.compress(body)
+        self.countS3("s3Writes")
+        self.countS3("s3BytesWritten", len(body))
+        self.s3Client.put_object(Key=key, Bucket=self.config["s3BucketName"], Body=body)
+
+    ############################################################################
+    # This method returns the name of the S3 object the journal is stored in.
+    ############################################################################
+    def getJournalFilename(self):
+        return self.config["stateFilename"] + "-journal"
+
+    ############################################################################
+    # This method returns a section of the state. If the section doesn't exist,
+    # it returns the default passed in.
+    ############################################################################
+    def get(self, section, default=None):
+        return self.state.get(section, default)
+
+    ############################################################################
+    # This method updates a section of the state and marks it as changed.
+    ############################################################################
+    def set(self, section, value):
+        with self.lock:
+            self.state[section] = value
+            self.journal["sections"][section] = value
+            self.journal["events"].pop(section, None)
+            self.dirty.add(section)
+
+    ############################################################################
+    # This method returns the alert history stored in a section of the state.
+    ############################################################################
+    def getHistory(self, section):
+        return AlertHistory(self.get(section, []), self.runNumber)
+
+    ############################################################################
+    # This method ages an alert history, and saves the events that changed.
+    # If not all the records were processed, the history isn't aged, so only
+    # the events added are saved.
+    ############################################################################
+    def setHistory(self, section, history, complete=True):
+        changed = history.age() if complete else history.keep()
+        with self.lock:
+            if history.aging:
+                self.keepRunNumber = True
+            if changed:
+                self.state[section] = history.toList()
+                self.journal["events"].setdefault(section, {}).update(history.changes)
+                self.dirty.add(section)
+
+    ############################################################################
+    # This method records that the run number has to be saved, since an alert
+    # history has events that are no longer being seen.
+    ############################################################################
+    def markAging(self):
+        with self.lock:
+            self.keepRunNumber = True
+
+    ############################################################################
+    # This method writes the changes to the state to S3, if there are any.
+    ############################################################################
+    def flush(self):
+        with self.lock:
+            if len(self.dirty) == 0 and not self.keepRunNumber:
+                return
+
+            if self.generation is not None:
+                journal = json.dumps({"generation": self.generation, "runNumber": self.runNumber, **self.journal}, separators=(',', ':')).encode('UTF-8')
+                maxRatio = float(self.config["stateJournalMaxRatio"]) if self.config.get("stateJournalMaxRatio") is not None else stateJournalDefaultMaxRatio
+                if len(journal) <= self.snapshotBytes * maxRatio:
+                    self.writeObject(self.getJournalFilename(), journal)
+                    self.journalExists = True
+                    self.dirty = set()
+                    return
+            #
+            # Compact the changes into a new snapshot. If there was a journal,
+            # replace it with an empty one, so it doesn't have to be read in
+            # just to be ignored.
+            self.generation = self.generation + 1 if self.generation is not None else 1
+            snapshot = json.dumps({"generation": self.generation, "runNumber": self.runNumber, **self.state}, separators=(',', ':')).encode('UTF-8')
+            self.writeObject(self.config["stateFilename"], snapshot)
+            self.snapshotBytes = len(snapshot)
+            if self.journalExists:
+                self.writeObject(self.getJournalFilename(), json.dumps({"generation": self.generation}).encode('UTF-8'))
+            self.journal = {"sections": {}, "events": {}}
+            self.countS3("stateCompactions")
+            self.dirty = set()
+
+    ############################################################################
+    # This method records an S3 operation in the run metrics, if there are any.
+    ############################################################################
+    def countS3(self, counter, amount=1):
+        if self.metrics is not None:
+            self.metrics.count(counter, amount)
 
-    start=data[1]
-    data=getNumber(string, start)
-    num += data[0]
+################################################################################
+# This class keeps track of how much time a run has left. When running as a
+# Lambda function, the deadline is when the invocation will be stopped, less
+# a margin to deliver the alerts and save the state. Otherwise, there isn't
+# one. It is used to cap the timeout of every ONTAP API call, so a slow one
+# can't use up the rest of the invocation.
+################################################################################
+class RunDeadline:
+    def __init__(self, context=None, marginSeconds=defaultDeadlineMarginSeconds):
+        self.expires = None
+        if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+            self.expires = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - marginSeconds
+
+    ############################################################################
+    # This method returns the number of seconds left, or None if there isn't
+    # a deadline.
+    ############################################################################
+    def remaining(self):
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    ############################################################################
+    # This method returns True if the deadline has passed.
+    ############################################################################
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    ############################################################################
+    # This method returns the timeout to use, given the one requested, so it
+    # doesn't go past the deadline. It raises DeadlineExceeded if there is no
+    # time left.
+    ############################################################################
+    def capTimeout(self, timeout):
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return min(timeout, remaining)
 
-    return(num)
+################################################################################
+# This exception is raised when a run has run out of time.
+################################################################################
+class DeadlineExceeded(Exception):
+    def __init__(self):
+        super().__init__("Ran out of time for this run.")
 
 ################################################################################
-# This function checks to see if an event is in the events array based on
-# the unique Identifier passed in. It will also update the "refresh" field on
-# any matches.
+# This class holds everything the service checks need to know about the
+# cluster they are checking, for the current run. It is passed to all of them,
+# instead of having them use global variables, so they can run concurrently.
+#   config - The configuration parameters.
+#   http - The urllib3 PoolManager used to make the ONTAP API calls.
+#   headers - The headers, including the authentication, for the API calls.
+#   stateStore - The state preserved between runs.
+#   clusterName, clusterVersion and clusterTimezone - Set by checkSystem().
+#   alerts - The AlertDispatcher that delivers the alerts.
+#   metrics - The RunMetrics that the performance metrics are recorded in.
+#   deadline - The RunDeadline that limits how long the API calls can take.
+#
+# Since the run spends most of its time waiting on the ONTAP API, the calls
+# are made concurrently: the first page of a collection is requested as soon
+# as getRecords() is called, and the next page is requested while the
+# current one is being processed. That way a service can start all the
+# retrievals it needs before processing any of them. The number of calls in
+# flight to the cluster, by all the services, is capped by
+# maxConcurrentRequests.
 ################################################################################
-def eventExist (events, uniqueIdentifier):
-    for event in events:
-        if event["index"] == uniqueIdentifier:
-            event["refresh"] = eventResilience
-            return True
+class ClusterContext:
+    def __init__(self, config, http, headers, stateStore, metrics=None, deadline=None):
+        self.config = config
+        self.http = http
+        self.headers = headers
+        self.stateStore = stateStore
+        self.metrics = metrics if metrics is not None else RunMetrics(config["OntapAdminServer"])
+        self.deadline = deadline if deadline is not None else RunDeadline()
+        self.requestTimeout = float(config["ontapRequestTimeoutSeconds"]) if config.get("ontapRequestTimeoutSeconds") is not None else defaultRequestTimeoutSeconds
+        self.maxConcurrentRequests = int(config["maxConcurrentRequests"]) if config.get("maxConcurrentRequests") is not None else defaultMaxConcurrentRequests
+        self.requestSlots = threading.BoundedSemaphore(self.maxConcurrentRequests)
+        self.executor = None
+        self.executorLock = threading.Lock()
+        self.clusterName = None
+        self.clusterVersion = None
+        self.clusterTimezone = None
+        self.alerts = AlertDispatcher(self)
+
+    ############################################################################
+    # This method makes an ONTAP API call and records it in the run metrics.
+    # The call times out after requestTimeout seconds, or a shorter "timeout"
+    # if one is passed, but never after the deadline of the run. It raises
+    # DeadlineExceeded if the run is out of time.
+    ############################################################################
+    def request(self, method, endpoint, **kwargs):
+        requestedTimeout = min(kwargs.pop("timeout", self.requestTimeout), self.requestTimeout)
+        with self.requestSlots:
+            timeout = self.deadline.capTimeout(requestedTimeout)
+            startTime = time.monotonic()
+            try:
+                response = self.http.request(method, endpoint, headers=self.headers, timeout=urllib3.Timeout(total=timeout), **kwargs)
+            except urllib3.exceptions.HTTPError as err:
+                if self.deadline.expired():
+                    raise DeadlineExceeded() from err
+                raise err
+        self.metrics.recordApiCall(endpoint, time.monotonic() - startTime, len(response.data))
+        return response
+
+    ############################################################################
+    # This method runs a function in the background and returns its Future.
+    # The function is accounted for under the service of the calling thread.
+    ############################################################################
+    def submit(self, function, *args, **kwargs):
+        service = self.metrics.getService()
+        def run():
+            self.metrics.setService(service)
+            return function(*args, **kwargs)
+
+        with self.executorLock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxConcurrentRequests)
+            return self.executor.submit(run)
+
+    ############################################################################
+    # This method stops the background threads. Any page that was being
+    # prefetched, but is no longer needed, is discarded.
+    ############################################################################
+    def close(self):
+        with self.executorLock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+    ############################################################################
+    # This method retrieves one page of an ONTAP collection. It raises
+    # OntapApiError if the API call fails.
+    ############################################################################
+    def getPage(self, endpoint):
+        response = self.request('GET', endpoint)
+        if response.status != 200:
+            raise OntapApiError(endpoint, response.status)
+        return json.loads(response.data)
+
+    ############################################################################
+    # This method returns, one at a time, all the records of an ONTAP
+    # collection, retrieving them a page at a time by following the
+    # "_links.next" links. Only the fields passed in are requested. The first
+    # page is requested right away, in the background, so several collections
+    # can be retrieved at the same time. It raises OntapApiError, when the
+    # records are iterated over, if an API call fails.
+    ############################################################################
+    def getRecords(self, path, fields, query="", returnTimeout=15):
+        maxRecords = self.config["maxRecordsPerPage"] if self.config["maxRecordsPerPage"] is not None else 1000
+        #
+        # Don't let ONTAP spend more time on the call than the run has left.
+        remaining = self.deadline.remaining()
+        if remaining is not None:
+            returnTimeout = max(min(returnTimeout, int(remaining)), 1)
+        endpoint = f'https://{self.config["OntapAdminServer"]}{path}?fields={fields}&max_records={maxRecords}&return_timeout={returnTimeout}{query}'
+        return self.readPages(self.submit(self.getPage, endpoint))
+
+    ############################################################################
+    # This method yields the records of the page being retrieved by 'future',
+    # and of all the pages after it. While the records of one page are being
+    # processed, the next page is retrieved, so at most two pages are held in
+    # memory.
+    ############################################################################
+    def readPages(self, future):
+        try:
+            while future is not None:
+                data = future.result()
+                nextLink = data.get("_links", {}).get("next", {}).get("href")
+                future = self.submit(self.getPage, f'https://{self.config["OntapAdminServer"]}{nextLink}') if nextLink else None
+                self.metrics.count("recordsEvaluated", len(data["records"]))
+                for record in data["records"]:
+                    yield record
+                #
+                # Release the page before waiting on the next one.
+                del data
+        finally:
+            if future is not None:
+                future.cancel()
 
-    return False
+################################################################################
+# This exception is raised when an ONTAP API call fails.
+################################################################################
+class OntapApiError(Exception):
+    def __init__(self, endpoint, status):
+        self.endpoint = endpoint
+        self.status = status
+        super().__init__(f'API call to {endpoint} failed. HTTP status code: {status}.')
 
 ################################################################################
 # This function makes an API call to the FSxN to ensure it is up. If the
 # errors out, then it sends an alert, and returns 'False'. Otherwise it returns
 # 'True'.
 ################################################################################
-def checkSystem():
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger, clusterTimezone
-
+def checkSystem(ctx):
     changedEvents = False
     #
-    # Get the previous status.
-    try:
-        data = s3Client.get_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then this must be the
-        # first time this script has run against thie filesystem so create an
-        # initial status structure.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            fsxStatus = {
-                "systemHealth": True,
-                "version" : initialVersion,
-                "numberNodes" : 2,
-                "downInterfaces" : []
-            }
-            changedEvents = True
-        else:
-            raise err
-    else:
-        fsxStatus = json.loads(data["Body"].read().decode('UTF-8'))
+    # Get the previous status. If there isn't one, then this must be the
+    # first time this script has run against thie filesystem so create an
+    # initial status structure.
+    fsxStatus = ctx.stateStore.get("systemStatus")
+    if fsxStatus is None:
+        fsxStatus = {
+            "systemHealth": True,
+            "version" : initialVersion,
+            "numberNodes" : 2,
+            "downInterfaces" : []
+        }
+        changedEvents = True
     #
     # Get the cluster name, ONTAP version and timezone from the FSxN.
     # This is also a way to test that the FSxN cluster is accessible.
     badHTTPStatus = False
     try:
-        endpoint = f'https://{config["OntapAdminServer"]}/api/cluster?fields=version,name,timezone'
-        response = http.request('GET', endpoint, headers=headers, timeout=5.0)
+        endpoint = f'https://{ctx.config["OntapAdminServer"]}/api/cluster?fields=version,name,timezone'
+        response = ctx.request('GET', endpoint, timeout=5.0)
         if response.status == 200:
             if not fsxStatus["systemHealth"]:
                 fsxStatus["systemHealth"] = True
                 changedEvents = True
 
             data = json.loads(response.data)
-            if config["awsAccountId"] != None:
-                clusterName = f'{data["name"]}({config["awsAccountId"]})'
+            if ctx.config["awsAccountId"] != None:
+                ctx.clusterName = f'{data["name"]}({ctx.config["awsAccountId"]})'
             else:
-                clusterName = data['name']
+                ctx.clusterName = data['name']
             #
             # The following assumes that the format of the "full" version
             # looks like: "NetApp Release 9.13.1P6: Tue Dec 05 16:06:25 UTC 2023".
             # The reason for looking at the "full" instead of the individual
             # keys (generation, major, minor) is because they don't provide
             # the patch level. :-(
-            clusterVersion = data["version"]["full"].split()[2].replace(":", "")
+            ctx.clusterVersion = data["version"]["full"].split()[2].replace(":", "")
             if fsxStatus["version"] == initialVersion:
-                fsxStatus["version"] = clusterVersion
+                fsxStatus["version"] = ctx.clusterVersion
             #
             # Get the Timezone for SnapMirror lag time calculations.
-            clusterTimezone = data["timezone"]["name"]
+            ctx.clusterTimezone = data["timezone"]["name"]
         else:
             badHTTPStatus = True
             raise Exception(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+    except DeadlineExceeded as err:
+        raise err
     except:
         if fsxStatus["systemHealth"]:
-            if config["awsAccountId"] != None:
-                clusterName = f'{config["OntapAdminServer"]}({config["awsAccountId"]})'
+            if ctx.config["awsAccountId"] != None:
+                ctx.clusterName = f'{ctx.config["OntapAdminServer"]}({ctx.config["awsAccountId"]})'
             else:
-                clusterName = config["OntapAdminServer"]
+                ctx.clusterName = ctx.config["OntapAdminServer"]
             if badHTTPStatus:
-                message = f'CRITICAL: Received a non 200 HTTP status code ({response.status}) when trying to access {clusterName}.'
+                message = f'CRITICAL: Received a non 200 HTTP status code ({response.status}) when trying to access {ctx.clusterName}.'
             else:
-                message = f'CRITICAL: Failed to issue API against {clusterName}. Cluster could be down.'
-            sendAlert(message, "CRITICAL")
+                message = f'CRITICAL: Failed to issue API against {ctx.clusterName}. Cluster could be down.'
+            sendAlert(ctx, message, "CRITICAL")
             fsxStatus["systemHealth"] = False
             changedEvents = True
 
     if changedEvents:
-        s3Client.put_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"], Body=json.dumps(fsxStatus).encode('UTF-8'))
+        ctx.stateStore.set("systemStatus", fsxStatus)
     #
     # If the cluster is done, return false so the program can exit cleanly.
     return(fsxStatus["systemHealth"])
@@ -230,186 +807,585 @@ def checkSystem():
 #
 # ASSUMPTIONS: That checkSystem() has been called before it.
 ################################################################################
-def checkSystemHealth(service):
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
+def checkSystemHealth(ctx, service):
+    global logger
 
     changedEvents = False
     #
-    # Get the previous status.
-    # Shouldn't have to check for status of the get_object() call, to see if the object exist or not,
-    # since "checkSystem()" should already have been called and it creates the object if it doesn't
-    # already exist. So, if there is a failure, it should be something else than "non-existent".
-    data = s3Client.get_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"])
-    fsxStatus = json.loads(data["Body"].read().decode('UTF-8'))
+    # Get the previous status. Since "checkSystem()" should already have been
+    # called, and it creates the status if it doesn't already exist, it should
+    # always be there.
+    fsxStatus = ctx.stateStore.get("systemStatus")
+    #
+    # Start the API calls the rules need, so they run concurrently.
+    nodesEndpoint = f'https://{ctx.config["OntapAdminServer"]}/api/private/cli/system/node/virtual-machine/instance/show-settings'
+    nodesResponse = None
+    interfaceRecords = None
+    for rule in service["rules"]:
+        for key in rule.keys():
+            lkey = key.lower()
+            if lkey == "failover" and rule[key] and nodesResponse is None:
+                nodesResponse = ctx.submit(ctx.request, 'GET', nodesEndpoint)
+            elif lkey == "networkinterfaces" and rule[key] and interfaceRecords is None:
+                interfaceRecords = ctx.getRecords("/api/network/ip/interfaces", "name,state")
+    #
+    # The records can only be iterated over once, so they are kept in a list
+    # in case more than one rule checks them.
+    interfaces = None
+    interfacesFailed = False
 
     for rule in service["rules"]:
         for key in rule.keys():
             lkey = key.lower()
             if lkey == "versionchange":
-                if rule[key] and clusterVersion != fsxStatus["version"]:
-                    message = f'NOTICE: The ONTAP vesion changed on cluster {clusterName} from {fsxStatus["version"]} to {clusterVersion}.'
-                    sendAlert(message, "INFO")
-                    fsxStatus["version"] = clusterVersion
+                if rule[key] and ctx.clusterVersion != fsxStatus["version"]:
+                    message = f'NOTICE: The ONTAP vesion changed on cluster {ctx.clusterName} from {fsxStatus["version"]} to {ctx.clusterVersion}.'
+                    sendAlert(ctx, message, "INFO")
+                    fsxStatus["version"] = ctx.clusterVersion
                     changedEvents = True
             elif lkey == "failover":
                 #
                 # Check that both nodes are available.
                 # Using the CLI passthrough API because I couldn't find the equivalent API call.
                 if rule[key]:
-                    endpoint = f'https://{config["OntapAdminServer"]}/api/private/cli/system/node/virtual-machine/instance/show-settings'
-                    response = http.request('GET', endpoint, headers=headers)
+                    response = nodesResponse.result()
                     if response.status == 200:
                         data = json.loads(response.data)
                         if data["num_records"] != fsxStatus["numberNodes"]:
-                            message = f'Alert: The number of nodes on cluster {clusterName} went from {fsxStatus["numberNodes"]} to {data["num_records"]}.'
-                            sendAlert(message, "INFO")
+                            message = f'Alert: The number of nodes on cluster {ctx.clusterName} went from {fsxStatus["numberNodes"]} to {data["num_records"]}.'
+                            sendAlert(ctx, message, "INFO")
                             fsxStatus["numberNodes"] = data["num_records"]
                             changedEvents = True
                     else:
-                        logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+                        logger.warning(f'API call to {nodesEndpoint} failed. HTTP status code: {response.status}.')
             elif lkey == "networkinterfaces":
-                if rule[key]:
-                    endpoint = f'https://{config["OntapAdminServer"]}/api/network/ip/interfaces?fields=state'
-                    response = http.request('GET', endpoint, headers=headers)
-                    if response.status == 200:
-                        #
-                        # Decrement the refresh field to know if any events have really gone away.
-                        for interface in fsxStatus["downInterfaces"]:
-                            interface["refresh"] -= 1
-
-                        data = json.loads(response.data)
-                        for interface in data["records"]:
+                if rule[key] and not interfacesFailed:
+                    try:
+                        if interfaces is None:
+                            interfaces = list(interfaceRecords)
+                        downInterfaces = AlertHistory(fsxStatus["downInterfaces"], ctx.stateStore.runNumber)
+                        for interface in interfaces:
                             if interface.get("state") != None and interface["state"] != "up":
                                 uniqueIdentifier = interface["name"]
-                                if(not eventExist(fsxStatus["downInterfaces"], uniqueIdentifier)): # Resets the refresh key.
-                                    message = f'Alert: Network interface {interface["name"]} on cluster {clusterName} is down.'
-                                    sendAlert(message, "WARNING")
+                                if not downInterfaces.exists(uniqueIdentifier):
+                                    message = f'Alert: Network interface {interface["name"]} on cluster {ctx.clusterName} is down.'
+                                    sendAlert(ctx, message, "WARNING")
                                     event = {
-                                        "index": uniqueIdentifier,
-                                        "refresh": eventResilience
+                                        "index": uniqueIdentifier
                                     }
-                                    fsxStatus["downInterfaces"].append(event)
-                                    changedEvents = True
+                                    downInterfaces.add(event)
                         #
                         # After processing the records, see if any events need to be removed.
-                        i = 0
-                        while i < len(fsxStatus["downInterfaces"]):
-                            if fsxStatus["downInterfaces"][i]["refresh"] <= 0:
-                                logger.debug(f'Deleting interface: {fsxStatus["downInterfaces"][i]["index"]}')
-                                del fsxStatus["downInterfaces"][i]
-                                changedEvents = True
-                            else:
-                                if fsxStatus["downInterfaces"][i]["refresh"] != eventResilience:
-                                    changedEvents = True
-                                i += 1
-                    else:
-                        logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+                        if downInterfaces.age():
+                            fsxStatus["downInterfaces"] = downInterfaces.toList()
+                            changedEvents = True
+                        if downInterfaces.aging:
+                            ctx.stateStore.markAging()
+                    except OntapApiError as err:
+                        logger.warning(err)
+                        interfacesFailed = True
             else:
                 logger.warning(f'Unknown System Health alert type: "{key}".')
 
     if changedEvents:
-        s3Client.put_object(Key=config["systemStatusFilename"], Bucket=config["s3BucketName"], Body=json.dumps(fsxStatus).encode('UTF-8'))
+        ctx.stateStore.set("systemStatus", fsxStatus)
 
 ################################################################################
-# This function processes the EMS events.
+# This function converts a regular expression, as used in the matching
+# conditions, into an ONTAP API query value (e.g. "wafl.*|raid*") that
+# matches at least everything the regular expression would. It returns None
+# if it can't, in which case the field shouldn't be filtered by ONTAP.
 ################################################################################
-def processEMSEvents(service):
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
+def regexToOntapQuery(pattern):
+    if pattern is None or pattern == "" or re.search(r'[()\[\]{}+?]', pattern):
+        return None
 
-    changedEvents = False
+    values = []
+    for alternative in pattern.split("|"):
+        value = "" if alternative.startswith("^") else "*"
+        alternative = alternative.lstrip("^")
+        anchored = alternative.endswith("$") and not alternative.endswith("\\$")
+        alternative = alternative.rstrip("$") if anchored else alternative
+        i = 0
+        while i < len(alternative):
+            char = alternative[i]
+            if char == "\\":
+                if i + 1 >= len(alternative) or alternative[i+1].isalnum():
+                    return None
+                value += alternative[i+1]
+                i += 2
+                continue
+            if char == ".":
+                value += "*"
+                if alternative[i+1:i+2] == "*":
+                    i += 1
+            elif char == "*" or char == "^" or char == "$":
+                return None
+            else:
+                value += char
+            i += 1
+        if not anchored:
+            value += "*"
+        if value.strip("*") == "":
+            return None  # Matches everything.
+        values.append(re.sub(r'\*+', '*', value))
+
+    return "|".join(values)
+
+################################################################################
+# This function returns the query to add to the EMS events API call so ONTAP
+# only returns events that might match one of the rules. Since an event is
+# reported if any rule matches, a field can only be filtered on if every rule
+# can be converted into a filter on it.
+################################################################################
+def buildEMSQuery(rules):
+    query = ""
+    for field, ruleKey in (("message.name", "name"), ("message.severity", "severity")):
+        values = []
+        for rule in rules:
+            value = regexToOntapQuery(rule.get(ruleKey))
+            if value is None:
+                values = None
+                break
+            values.append(value)
+        if values:
+            query += f'&{field}={urllib.parse.quote("|".join(values), safe="*|")}'
+
+    return query
+
+################################################################################
+# This function converts an EMS event timestamp into a datetime so it can be
+# compared with others.
+################################################################################
+def parseEMSTime(emsTime):
+    return datetime.datetime.fromisoformat(emsTime.replace("Z", "+00:00"))
+
+################################################################################
+# This class holds the EMS rules, from the matching conditions file, compiled
+# so they can be applied to a large number of events quickly:
+#   - The regular expressions are only compiled once.
+#   - Patterns without any special characters are matched as plain strings.
+#   - Since there are relatively few distinct message names and severities,
+#     the rules that match a given name and severity are only determined
+#     once. For most events that leaves no rules to check at all.
+#   - The message patterns of all the rules, without a filter, that apply
+#     to a name and severity are combined into one regular expression. Only
+#     the patterns without any groups are combined, since combining them
+#     renumbers the groups, which breaks any backreferences to them.
+################################################################################
+class EMSRuleEngine:
+    def __init__(self, rules):
+        self.rules = []
+        for rule in rules:
+            try:
+                self.rules.append({
+                    "name": self.compile(rule.get("name")),
+                    "severity": self.compile(rule.get("severity")),
+                    "message": self.compile(rule.get("message")),
+                    "filter": self.compile(rule.get("filter")) if rule.get("filter") else None,
+                    "pattern": rule.get("message") if rule.get("message") is not None else "",
+                    "combinable": not rule.get("message") or re.compile(rule.get("message")).groups == 0
+                    })
+            except re.error as err:
+                logger.warning(f'Warning, skipping EMS rule {rule} since it has an invalid regular expression: {err}')
+        self.groups = {}
+
+    ############################################################################
+    # This method returns a function that returns True if the pattern is found
+    # in the string passed to it, like re.search() would.
+    ############################################################################
+    @staticmethod
+    def compile(pattern):
+        if pattern is None or pattern == "":
+            return lambda string: True
+        if re.escape(pattern) == pattern:
+            return lambda string: pattern in string
+        return re.compile(pattern).search
+
+    ############################################################################
+    # This method returns the rules that apply to events with the message
+    # name and severity passed in. The rules with a filter are returned as a
+    # list, the others as a single function that checks all their message
+    # patterns, with the ones that can be combined checked at once.
+    ############################################################################
+    def getGroup(self, name, severity):
+        group = self.groups.get((name, severity))
+        if group is None:
+            rules = [rule for rule in self.rules if rule["name"](name) and rule["severity"](severity)]
+            filteredRules = [rule for rule in rules if rule["filter"] is not None]
+            unfilteredRules = [rule for rule in rules if rule["filter"] is None]
+            if len(unfilteredRules) == 0:
+                combined = None
+            elif len(unfilteredRules) == 1:
+                combined = unfilteredRules[0]["message"]
+            elif any(rule["pattern"] == "" for rule in unfilteredRules):
+                combined = lambda string: True
+            else:
+                combinableRules = [rule for rule in unfilteredRules if rule["combinable"]]
+                messageChecks = [rule["message"] for rule in unfilteredRules if not rule["combinable"]]
+                if len(combinableRules) > 1:
+                    try:
+                        messageChecks.insert(0, re.compile("|".join(f'(?:{rule["pattern"]})' for rule in combinableRules)).search)
+                        combinableRules = []
+                    except re.error:
+                        # Patterns with inline flags can't be combined.
+                        pass
+                messageChecks[0:0] = [rule["message"] for rule in combinableRules]
+                combined = lambda string, messageChecks=messageChecks: any(check(string) for check in messageChecks)
+            group = (combined, filteredRules)
+            self.groups[(name, severity)] = group
+        return group
+
+    ############################################################################
+    # This method returns True if any of the rules match the EMS event.
+    ############################################################################
+    def matches(self, name, severity, logMessage):
+        combined, filteredRules = self.getGroup(name, severity)
+        if combined is not None and combined(logMessage):
+            return True
+        for rule in filteredRules:
+            if rule["message"](logMessage) and not rule["filter"](logMessage):
+                return True
+        return False
+
+################################################################################
+# This function processes the EMS events. Only the events newer than the ones
+# seen in the previous run are retrieved from ONTAP. To do that, the time of
+# the latest event seen (the high water mark) is stored with the state, along
+# with the identifiers of the events at that time, since more events might
+# show up with that same timestamp.
+#
+# If emsPushUrl is set, ONTAP is configured to push the events to it instead,
+# as they happen (see processEMSPush()), and they are no longer polled for.
+# Since anyone that can reach emsPushUrl could push events, that requires
+# emsPushToken to be set as well.
+################################################################################
+def processEMSEvents(ctx, service):
+    global logger
     #
-    # Get the saved events so we can ensure we are only reporting on new ones.
-    try:
-        data = s3Client.get_object(Key=config["emsEventsFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then it will get created once an alert it sent.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            events = []
+    # If ONTAP is already pushing the events, there is no need to poll for them.
+    registration = None
+    if ctx.config["emsPushUrl"] is not None:
+        if ctx.config["emsPushToken"] is None:
+            logger.error(f'Error, emsPushUrl is set without emsPushToken for {ctx.config["OntapAdminServer"]}, so its EMS events will be polled for instead of pushed.')
         else:
-            raise err
+            registration = buildEMSPushRegistration(ctx, service["rules"])
+            if ctx.stateStore.get("emsPush") == hashEMSPushRegistration(registration):
+                return
+    if ctx.stateStore.get("emsPush") is not None:
+        #
+        # The events up to now have been pushed, so only poll for the ones
+        # after them. If push is no longer configured, stop ONTAP pushing them.
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+        ctx.stateStore.set("emsHighWaterMark", {"time": now, "events": []})
+        if registration is None:
+            unregisterEMSPush(ctx)
+    #
+    # Get the high water mark from the previous run. If there isn't one, fall
+    # back to the history of events that have already been reported.
+    highWaterMark = ctx.stateStore.get("emsHighWaterMark")
+    events = None
+    if highWaterMark is None:
+        events = ctx.stateStore.getHistory("emsEvents")
+        highWaterTime = None
+        highWaterEvents = set()
     else:
-        events = json.loads(data["Body"].read().decode('UTF-8'))
+        highWaterTime = parseEMSTime(highWaterMark["time"])
+        highWaterEvents = set(highWaterMark["events"])
     #
-    # Decrement the refresh field to know if any records have really gone away.
-    for event in events:
-        event["refresh"] -= 1
+    # Compile the rules once, instead of for every event.
+    ruleEngine = EMSRuleEngine(service["rules"])
     #
-    # Run the API call to get the current list of EMS events.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/support/ems/events?return_timeout=15'
-    response = http.request('GET', endpoint, headers=headers)
-    if response.status == 200:
-        data = json.loads(response.data)
+    # Run the API call to get the list of EMS events since the last run. They
+    # are requested oldest first, so if the call fails partway through, the
+    # events processed so far all come before the ones that weren't.
+    query = buildEMSQuery(service["rules"]) + f'&order_by={urllib.parse.quote("time asc")}'
+    if highWaterMark is not None:
+        query += f'&time={urllib.parse.quote(">=" + highWaterMark["time"])}'
+    records = ctx.getRecords("/api/support/ems/events", "index,time,node.name,message.name,message.severity,log_message", query)
+
+    newHighWaterMark = None if highWaterMark is None else {"time": highWaterMark["time"], "events": list(highWaterMark["events"])}
+    numRecords = 0
+    completed = True
+    try:
+        for record in records:
+            numRecords += 1
+            eventId = f'{record.get("node", {}).get("name", "")}:{record["index"]}'
+            eventTime = parseEMSTime(record["time"])
+            if highWaterTime is not None and (eventTime < highWaterTime or (eventTime == highWaterTime and eventId in highWaterEvents)):
+                continue
+            #
+            # Keep track of the latest events seen.
+            if newHighWaterMark is None or eventTime > parseEMSTime(newHighWaterMark["time"]):
+                newHighWaterMark = {"time": record["time"], "events": [eventId]}
+            elif eventTime == parseEMSTime(newHighWaterMark["time"]) and eventId not in newHighWaterMark["events"]:
+                newHighWaterMark["events"].append(eventId)
+
+            if ruleEngine.matches(record["message"]["name"], record["message"]["severity"], record["log_message"]):
+                if events is None or not events.exists(record["index"]):
+                    sendEMSAlert(ctx, record)
+    except OntapApiError as err:
+        logger.warning(err)
         #
-        # Process the events to see if there are any new ones.
-        print(f'Received {len(data["records"])} EMS records.')
-        logger.debug(f'Received {len(data["records"])} EMS records.')
-        for record in data["records"]:
-            for rule in service["rules"]:
-                messageFilter = rule.get("filter")
-                if messageFilter == None or messageFilter == "":
-                    messageFilter = "ThisShouldn'tMatchAnything"
-
-                if (not re.search(messageFilter, record["log_message"]) and
-                    re.search(rule["name"], record["message"]["name"]) and
-                    re.search(rule["severity"], record["message"]["severity"]) and
-                    re.search(rule["message"], record["log_message"])):
-                    if (not eventExist (events, record["index"])):  # This resets the "refresh" field if found.
-                        message = f'{record["time"]} : {clusterName} {record["message"]["name"]}({record["message"]["severity"]}) - {record["log_message"]}'
-                        useverity=record["message"]["severity"].upper()
-                        if useverity == "EMERGENCY":
-                            sendAlert(message, "CRITICAL")
-                        elif useverity == "ALERT":
-                            sendAlert(message, "ERROR")
-                        elif useverity == "ERROR":
-                            sendAlert(message, "WARNING")
-                        elif useverity == "NOTICE" or useverity == "INFORMATIONAL":
-                            sendAlert(message, "INFO")
-                        elif useverity == "DEBUG":
-                            sendAlert(message, "DEBUG")
-                        else:
-                            sendAlert(f'Received unknown severity from ONTAP "{record["message"]["severity"]}". The message received is next.', "INFO")
-                            sendAlert(message, "INFO")
+        # The alerts for the events processed so far have already been sent,
+        # so still save the high water mark below, so they aren't sent again.
+        # The events after it are retrieved on the next run.
+        completed = False
 
-                        changedEvents = True
-                        event = {
-                                "index": record["index"],
-                                "time": record["time"],
-                                "messageName": record["message"]["name"],
-                                "message": record["log_message"],
-                                "refresh": eventResilience
-                                }
-                        events.append(event)
-        #
-        # Now that we have processed all the events, check to see if any events should be deleted.
-        i = 0
-        while i < len(events):
-            if events[i]["refresh"] <= 0:
-                logger.debug(f'Deleting event: {events[i]["time"]} : {events[i]["message"]}')
-                del events[i]
-                changedEvents = True
-            else:
-                # If an event wasn't refreshed, then we need to save the new refresh count.
-                if events[i]["refresh"] != eventResilience:
-                    changedEvents = True
-                i += 1
-        #
-        # If the events array changed, save it.
-        if changedEvents:
-            s3Client.put_object(Key=config["emsEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+    logger.debug(f'Received {numRecords} EMS records.')
+    #
+    # Now that the events have been processed, save the new high water mark.
+    # Once there is one, the history of reported events is no longer needed.
+    if newHighWaterMark != highWaterMark:
+        ctx.stateStore.set("emsHighWaterMark", newHighWaterMark)
+    if events is not None and newHighWaterMark is not None and len(events.toList()) > 0:
+        ctx.stateStore.set("emsEvents", [])
+    #
+    # Now that the events up to now have been processed, have ONTAP push the
+    # new ones, if configured to do so.
+    if registration is not None and completed:
+        registerEMSPush(ctx, registration)
+
+################################################################################
+# This function sends the alert for an EMS event, with the alert severity
+# based on the severity of the event.
+################################################################################
+def sendEMSAlert(ctx, record):
+    message = f'{record["time"]} : {ctx.clusterName} {record["message"]["name"]}({record["message"]["severity"]}) - {record["log_message"]}'
+    useverity=record["message"]["severity"].upper()
+    if useverity == "EMERGENCY":
+        sendAlert(ctx, message, "CRITICAL")
+    elif useverity == "ALERT":
+        sendAlert(ctx, message, "ERROR")
+    elif useverity == "ERROR":
+        sendAlert(ctx, message, "WARNING")
+    elif useverity == "NOTICE" or useverity == "INFORMATIONAL":
+        sendAlert(ctx, message, "INFO")
+    elif useverity == "DEBUG":
+        sendAlert(ctx, message, "DEBUG")
+    else:
+        sendAlert(ctx, f'Received unknown severity from ONTAP "{record["message"]["severity"]}". The message received is next.', "INFO")
+        sendAlert(ctx, message, "INFO")
+
+################################################################################
+# This function returns the EMS filter rules that make ONTAP push at least
+# all the events that the matching conditions rules might match. ONTAP
+# filters can only match message names, with "*" wildcards, and severities,
+# so the rest of the rules are applied when the events are received.
+################################################################################
+def buildEMSFilterRules(rules):
+    filterRules = []
+    for rule in rules:
+        try:
+            severityCheck = EMSRuleEngine.compile(rule.get("severity"))
+        except re.error:
+            continue  # EMSRuleEngine will skip the rule as well.
+        severities = [severity for severity in emsSeverities if severityCheck(severity)]
+        if len(severities) == 0:
+            continue
+        nameQuery = regexToOntapQuery(rule.get("name"))
+        for namePattern in (nameQuery.split("|") if nameQuery is not None else ["*"]):
+            filterRules.append({
+                "index": len(filterRules) + 1,
+                "type": "include",
+                "message_criteria": {
+                    "name_pattern": namePattern,
+                    "severities": "*" if len(severities) == len(emsSeverities) else ",".join(severities)
+                }
+            })
+    return filterRules
+
+################################################################################
+# This function returns what should be registered with ONTAP to have it push
+# the EMS events: the URL of the destination, which identifies the cluster
+# and includes the emsPushToken, and the filter rules.
+################################################################################
+def buildEMSPushRegistration(ctx, rules):
+    parameters = {"cluster": ctx.config["OntapAdminServer"], "name": ctx.clusterName, "token": ctx.config["emsPushToken"]}
+    separator = "&" if "?" in ctx.config["emsPushUrl"] else "?"
+    return {
+        "destination": f'{ctx.config["emsPushUrl"]}{separator}{urllib.parse.urlencode(parameters)}',
+        "rules": buildEMSFilterRules(rules)
+    }
+
+################################################################################
+# This function returns a hash of the registration. Only the hash is stored
+# in the state, to know if the registration has changed, so the emsPushToken
+# in the destination URL isn't written to S3.
+################################################################################
+def hashEMSPushRegistration(registration):
+    return hashlib.sha256(json.dumps(registration, sort_keys=True).encode('utf-8')).hexdigest()
+
+################################################################################
+# This function removes the EMS destination, and filter, that pushes the
+# events. It returns True if they were removed, or didn't exist.
+################################################################################
+def unregisterEMSPush(ctx):
+    global logger
+
+    for collection in ("destinations", "filters"):
+        endpoint = f'https://{ctx.config["OntapAdminServer"]}/api/support/ems/{collection}/{emsPushName}'
+        response = ctx.request('DELETE', endpoint)
+        if response.status not in (200, 404):
+            logger.warning(f'Warning, failed to remove the EMS {collection[:-1]} "{emsPushName}". API call to {endpoint} failed. HTTP status code: {response.status}.')
+            return False
+
+    ctx.stateStore.set("emsPush", None)
+    return True
+
+################################################################################
+# This function creates an EMS filter, from the matching conditions, and a
+# REST API destination, with that filter, so ONTAP pushes the EMS events to
+# emsPushUrl as they happen. Any previous registration is replaced. If this
+# fails, the events continue to be polled for.
+################################################################################
+def registerEMSPush(ctx, registration):
+    global logger
+
+    if not unregisterEMSPush(ctx):
+        return
+
+    baseEndpoint = f'https://{ctx.config["OntapAdminServer"]}/api/support/ems'
+    requests = [
+        ("filters", {"name": emsPushName, "rules": registration["rules"]}),
+        ("destinations", {"name": emsPushName, "type": "rest_api", "destination": registration["destination"], "filters": [{"name": emsPushName}]})
+    ]
+    for collection, body in requests:
+        endpoint = f'{baseEndpoint}/{collection}'
+        response = ctx.request('POST', endpoint, body=json.dumps(body))
+        if response.status not in (200, 201):
+            logger.warning(f'Warning, failed to create the EMS {collection[:-1]} "{emsPushName}", so EMS events will continue to be polled for. API call to {endpoint} failed. HTTP status code: {response.status}.')
+            return
+
+    logger.info(f'Registered {registration["destination"].split("?")[0]} to receive the EMS events from {ctx.clusterName}.')
+    ctx.stateStore.set("emsPush", hashEMSPushRegistration(registration))
+
+################################################################################
+# This function returns the name of the element, without its namespace.
+################################################################################
+def getLocalName(element):
+    return element.tag.rsplit("}", 1)[-1].lower().replace("_", "-")
+
+################################################################################
+# This function converts a notification pushed by ONTAP into a list of EMS
+# event records, in the same format the /api/support/ems/events API returns
+# them. Both JSON, with either a single record or a list of them, and XML
+# notifications are accepted. For XML, any element with a message name child
+# element is taken to be an event. It raises ValueError if it can't be parsed.
+################################################################################
+def parseEMSNotification(body):
+    body = body.strip()
+    if not body.startswith(b"<"):
+        data = json.loads(body)
+        if isinstance(data, dict):
+            data = data.get("records", [data])
+        records = data
     else:
-        logger.warning(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+        try:
+            root = xml.etree.ElementTree.fromstring(body)
+        except xml.etree.ElementTree.ParseError as err:
+            raise ValueError(f'Invalid XML: {err}')
+        records = []
+        for element in root.iter():
+            fields = {getLocalName(child): (child.text or "").strip() for child in element if len(child) == 0}
+            values = {}
+            for field, aliases in emsNotificationFields.items():
+                values[field] = next((fields[alias] for alias in aliases if alias in fields), "")
+            if values["name"] == "":
+                continue
+            records.append({
+                "index": values["index"],
+                "time": values["time"],
+                "node": {"name": values["node"]},
+                "message": {"name": values["name"], "severity": values["severity"]},
+                "log_message": values["logMessage"]
+            })
+
+    for record in records:
+        if not isinstance(record, dict) or not isinstance(record.get("message"), dict) or "name" not in record["message"]:
+            raise ValueError("Missing the EMS message name.")
+        record["message"]["severity"] = record["message"].get("severity", "").lower()
+        record.setdefault("log_message", "")
+        record.setdefault("time", "")
+    return records
 
 ################################################################################
-# This function is used to find an existing SM relationship based on the source
-# and destinatino path passed in. It returns None if one isn't found
+# This function handles an EMS notification pushed by ONTAP, received through
+# a Lambda function URL or an API Gateway. The cluster it came from is
+# identified by the "cluster" parameter of the URL registered with ONTAP, and
+# only that cluster's configuration is looked up. The notification must
+# include that cluster's emsPushToken. The events are run through the same
+# rules as the polled ones. It returns the HTTP response.
+################################################################################
+def processEMSPush(event):
+    global config, logger
+
+    parameters = event.get("queryStringParameters") or {}
+    if isFleetMode(config):
+        clusterConfig = getFleetCluster(parameters.get("cluster"))
+    else:
+        clusterConfig = config if config["OntapAdminServer"] == parameters.get("cluster") else None
+    if clusterConfig is None:
+        logger.warning(f'Warning, received an EMS notification for unknown cluster "{parameters.get("cluster")}".')
+        return {"statusCode": 404, "body": "Unknown cluster"}
+
+    if clusterConfig["emsPushToken"] is None:
+        logger.error(f'Error, received an EMS notification for {clusterConfig["OntapAdminServer"]}, but emsPushToken is not set for it.')
+        return {"statusCode": 403, "body": "Forbidden"}
+
+    if not hmac.compare_digest(parameters.get("token", ""), clusterConfig["emsPushToken"]):
+        logger.warning(f'Warning, received an EMS notification for {clusterConfig["OntapAdminServer"]} without a valid token.')
+        return {"statusCode": 403, "body": "Forbidden"}
+
+    body = event.get("body") or ""
+    body = base64.b64decode(body) if event.get("isBase64Encoded") else body.encode('UTF-8')
+    try:
+        records = parseEMSNotification(body)
+    except ValueError as err:
+        logger.warning(f'Warning, could not parse the EMS notification from {clusterConfig["OntapAdminServer"]}: {err}')
+        return {"statusCode": 400, "body": "Invalid notification"}
+
+    metrics = RunMetrics(clusterConfig["OntapAdminServer"])
+    with runMetricsLock:
+        runMetrics.append(metrics)
+    metrics.setService("emsPush")
+    matchingConditions = getMatchingConditions(clusterConfig, metrics)
+    serviceIndex = getServiceIndex("ems", matchingConditions) if matchingConditions is not None else None
+    if serviceIndex is None:
+        return {"statusCode": 200, "body": json.dumps({"received": len(records), "alerts": 0})}
+    #
+    # The ONTAP API isn't used, and neither is the state since ONTAP only
+    # pushes an event once.
+    ctx = ClusterContext(clusterConfig, None, None, None, metrics)
+    ctx.clusterName = parameters.get("name", clusterConfig["OntapAdminServer"])
+    ruleEngine = EMSRuleEngine(matchingConditions["services"][serviceIndex]["rules"])
+    numAlerts = 0
+    for record in records:
+        if ruleEngine.matches(record["message"]["name"], record["message"]["severity"], record["log_message"]):
+            sendEMSAlert(ctx, record)
+            numAlerts += 1
+    metrics.count("recordsEvaluated", len(records))
+    ctx.alerts.flush()
+    return {"statusCode": 200, "body": json.dumps({"received": len(records), "alerts": numAlerts})}
+
+################################################################################
+# This function returns True if the Lambda function was invoked through a
+# function URL, or an API Gateway, which is how EMS notifications are pushed.
+################################################################################
+def isEMSPushRequest(event):
+    return isinstance(event, dict) and "body" in event and ("requestContext" in event or "httpMethod" in event)
+
+################################################################################
+# This function is used to find an existing SM relationship, in the dictionary
+# of relationships indexed by the transfer uuid, based on the uuid passed in.
+# It returns None if one isn't found
 ################################################################################
 def getPreviousSMRecord(relationShips, uuid):
-    for relationship in relationShips:
-        if relationship.get('uuid') == uuid:
-            relationship['refresh'] = True
-            return(relationship)
+    relationship = relationShips.get(uuid)
+    if relationship is not None:
+        relationship['refresh'] = True
 
-    return(None)
+    return(relationship)
 
 ################################################################################
 # This function will convert seconds into an ascii string of number days, hours,
@@ -452,148 +1428,152 @@ def convertArrayToString(array):
     return text if text != "" else "*"
 
 ################################################################################
-# This function takes a schedule dictionary and returns the last time it should
-# run. It returns the time in seconds since the UNIX epoch.
+# This function takes the cron section of an ONTAP schedule and returns the
+# equivalent cron expression.
 ################################################################################
-def getLastRunTime(scheduleUUID):
-    global config, http, headers, clusterName, clusterVersion, logger, clusterTimezone
+def cronToExpression(cron):
+    minutes = convertArrayToString(cron["minutes"]) if cron.get("minutes") is not None else "*"
+    hours = convertArrayToString(cron["hours"]) if cron.get("hours") is not None else "*"
+    daysOfMonth = convertArrayToString(cron["days"]) if cron.get("days") is not None else "*"
+    months = convertArrayToString(cron["months"]) if cron.get("months") is not None else "*"
+    daysOfWeek = convertArrayToString(cron["weekdays"]) if cron.get("weekdays") is not None else "*"
 
-    minutes = ""
-    hours = ""
-    months = ""
-    daysOfMonth = ""
-    daysOfWeek = ""
-    #
-    # Run the API call to get the schedule information.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/cluster/schedules/{scheduleUUID}?fields=*&return_timeout=15'
-    response = http.request('GET', endpoint, headers=headers)
-    if response.status == 200:
-        schedule = json.loads(response.data)
-
-        if schedule['cron'].get("minutes") is not None:
-            minutes = convertArrayToString(schedule['cron']['minutes'])
-        else:
-            minutes = "*"
-
-        if schedule['cron'].get("hours") is not None:
-            hours = convertArrayToString(schedule['cron']['hours'])
-        else:
-            hours = "*"
-
-        if schedule['cron'].get("days") is not None:
-            daysOfMonth = convertArrayToString(schedule['cron']['days'])
-        else:
-            daysOfMonth = "*"
-
-        if schedule['cron'].get("months") is not None:
-            months = convertArrayToString(schedule['cron']['months'])
-        else:
-            months = "*"
-
-        if schedule['cron'].get("weekdays") is not None:
-            daysOfWeek = convertArrayToString(schedule['cron']['weekdays'])
-        else:
-            daysOfWeek = "*"
-        #
-        # Create the cron expression.
-        cron_expression = f"{minutes} {hours} {daysOfMonth} {months} {daysOfWeek}"
-        #
-        # Initialize CronSim with the cron expression and current time.
-        curTime = datetime.datetime.now(pytz.timezone(clusterTimezone) if clusterTimezone != None else datetime.timezone.utc)
-        curTimeSec = curTime.timestamp()
-        it = CronSim(cron_expression, curTime, reverse=True)
-        #
-        # Get the last run time.
-        lastRunTime = next(it)
-        lastRunTimeSec = lastRunTime.timestamp()
-        return int(lastRunTimeSec)
-    else:
-        logger.error(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
-        return -1
+    return f"{minutes} {hours} {daysOfMonth} {months} {daysOfWeek}"
 
 ################################################################################
+# This class caches the SnapMirror policies and the cluster schedules needed
+# to determine when a SnapMirror relationship should have last been updated.
+# Instead of retrieving the policy and schedule of every relationship, all of
+# them are retrieved with one API call each, the first time they are needed.
+# The last run time of each schedule is also only calculated once per run.
+#
+# If smScheduleCacheSeconds is set, the policies and schedules are saved with
+# the state and reused by the following runs until they are that old.
 ################################################################################
-def getPolicySchedule(policyUUID):
-    global config, http, headers, clusterName, clusterVersion, logger
-
-    # Run the API call to get the policy information.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/snapmirror/policies/{policyUUID}?fields=*&return_timeout=15'
-    response = http.request('GET', endpoint, headers=headers)
-    if response.status == 200:
-        data = json.loads(response.data)
-        if data.get('transfer_schedule') != None:
-            return data['transfer_schedule']['uuid']
+class SnapMirrorScheduleCache:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.policies = None    # Policy UUID -> schedule UUID (or None).
+        self.schedules = None   # Schedule UUID -> cron expression (or None).
+        self.lastRunTimes = {}  # Schedule UUID -> last run time.
+        self.pending = None     # The policy and schedule records being retrieved by prefetch().
+        self.curTime = datetime.datetime.now(pytz.timezone(ctx.clusterTimezone) if ctx.clusterTimezone != None else datetime.timezone.utc)
+
+        ttl = ctx.config["smScheduleCacheSeconds"]
+        self.ttl = int(ttl) if ttl is not None else None
+        if self.ttl is not None:
+            saved = ctx.stateStore.get("smSchedules")
+            if saved is not None and time.time() - saved["fetched"] < self.ttl:
+                self.policies = saved["policies"]
+                self.schedules = saved["schedules"]
+
+    ############################################################################
+    # This method starts retrieving the policies and schedules, if they
+    # weren't reused from a previous run, so they are ready by the time they
+    # are needed.
+    ############################################################################
+    def prefetch(self):
+        if self.policies is None and self.pending is None:
+            self.pending = (self.ctx.getRecords("/api/snapmirror/policies", "uuid,transfer_schedule.uuid"),
+                            self.ctx.getRecords("/api/cluster/schedules", "uuid,cron"))
+
+    ############################################################################
+    # This method retrieves all the policies and schedules from the cluster.
+    ############################################################################
+    def load(self):
+        if self.pending is not None:
+            policyRecords, scheduleRecords = self.pending
+            self.pending = None
         else:
-            return None
-    else:
-        logger.error(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
-        return None
-
-################################################################################
-# This function is used to find the last time a SnapMirror relationship should
-# have been updated. It returns the time in seconds since the UNIX epoch.
-################################################################################
-def getLastScheduledUpdate(record):
-    global config, http, headers, clusterName, clusterVersion, logger
-    #
-    # First check to see if there is a schedule associated with the SM relationship.
-    if record.get("transfer_schedule") is not None:
-        lastRunTime = getLastRunTime(record["transfer_schedule"]["uuid"])
-    else:
+            policyRecords = self.ctx.getRecords("/api/snapmirror/policies", "uuid,transfer_schedule.uuid")
+            scheduleRecords = self.ctx.getRecords("/api/cluster/schedules", "uuid,cron")
+        try:
+            policies = list(policyRecords)
+            schedules = list(scheduleRecords)
+        except OntapApiError as err:
+            logger.error(err)
+            self.policies = {}
+            self.schedules = {}
+            return
+
+        self.policies = {}
+        for policy in policies:
+            self.policies[policy["uuid"]] = policy["transfer_schedule"]["uuid"] if policy.get("transfer_schedule") is not None else None
+        self.schedules = {}
+        for schedule in schedules:
+            self.schedules[schedule["uuid"]] = cronToExpression(schedule["cron"]) if schedule.get("cron") is not None else None
+
+        if self.ttl is not None:
+            self.ctx.stateStore.set("smSchedules", {"fetched": int(time.time()), "policies": self.policies, "schedules": self.schedules})
+
+    ############################################################################
+    # This method returns the schedule UUID of a policy, or None if it
+    # doesn't have one.
+    ############################################################################
+    def getPolicySchedule(self, policyUUID):
+        if self.policies is None or (policyUUID not in self.policies and self.ttl is not None):
+            #
+            # Reload if the policy was created after the cached copy was saved.
+            self.load()
+        return self.policies.get(policyUUID)
+
+    ############################################################################
+    # This method returns the last time a schedule should have run, in seconds
+    # since the UNIX epoch. It returns -1 if that can't be determined.
+    ############################################################################
+    def getLastRunTime(self, scheduleUUID):
+        lastRunTime = self.lastRunTimes.get(scheduleUUID)
+        if lastRunTime is None:
+            if self.schedules is None or (scheduleUUID not in self.schedules and self.ttl is not None):
+                self.load()
+            cronExpression = self.schedules.get(scheduleUUID)
+            if cronExpression is None:
+                lastRunTime = -1
+            else:
+                lastRunTime = int(next(CronSim(cronExpression, self.curTime, reverse=True)).timestamp())
+            self.lastRunTimes[scheduleUUID] = lastRunTime
+        return lastRunTime
+
+    ############################################################################
+    # This method returns the last time a SnapMirror relationship should have
+    # been updated. It returns the time in seconds since the UNIX epoch, or -1
+    # if the relationship doesn't have a schedule.
+    ############################################################################
+    def getLastScheduledUpdate(self, record):
+        #
+        # First check to see if there is a schedule associated with the SM relationship.
+        if record.get("transfer_schedule") is not None:
+            return self.getLastRunTime(record["transfer_schedule"]["uuid"])
         #
         # If there is no schedule at the relationship level, check to see
         # if the policy has one.
-        scheduleUUID = getPolicySchedule(record["policy"]["uuid"])
+        scheduleUUID = self.getPolicySchedule(record["policy"]["uuid"])
         if scheduleUUID is not None:
-            lastRunTime = getLastRunTime(scheduleUUID)
-        else:
-            lastRunTime = -1
-    return lastRunTime
+            return self.getLastRunTime(scheduleUUID)
+        return -1
 
 ################################################################################
 # This function is used to check SnapMirror relationships.
 ################################################################################
-def processSnapMirrorRelationships(service):
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger, clusterTimezone
+def processSnapMirrorRelationships(ctx, service):
+    global logger
     #
     # Get the saved events so we can ensure we are only reporting on new ones.
-    try:
-        data = s3Client.get_object(Key=config["smEventsFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then it will get created once an alert is sent.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            events = []
-        else:
-            raise err
-    else:
-        events = json.loads(data["Body"].read().decode('UTF-8'))
-    #
-    # Decrement the refresh field to know if any records have really gone away.
-    for event in events:
-        event["refresh"] -= 1
-
-    changedEvents=False
+    events = ctx.stateStore.getHistory("smEvents")
     #
     # Get the saved SM relationships.
-    try:
-        data = s3Client.get_object(Key=config["smRelationshipsFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then it will get created once an alert is sent.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            smRelationships = []
-        else:
-            raise err
-    else:
-        smRelationships = json.loads(data["Body"].read().decode('UTF-8'))
+    smRelationships = {}
+    for relationship in ctx.stateStore.get("smRelationships", []):
+        smRelationships[relationship.get("uuid")] = relationship
     #
     # Set the refresh to False to know if any of the relationships still exist.
-    for relationship in smRelationships:
+    for relationship in smRelationships.values():
         relationship["refresh"] = False
 
     updateRelationships = False
     #
     # Get the current time in seconds since UNIX epoch 01/01/1970.
-    curTimeSeconds = int(datetime.datetime.now(pytz.timezone(clusterTimezone) if clusterTimezone != None else datetime.timezone.utc).timestamp())
+    curTimeSeconds = int(datetime.datetime.now(pytz.timezone(ctx.clusterTimezone) if ctx.clusterTimezone != None else datetime.timezone.utc).timestamp())
     #
     # Consolidate all the rules so we can decide how to process lagtime.
     maxLagTime = None
@@ -619,310 +1599,672 @@ def processSnapMirrorRelationships(service):
             else:
                 logger.warning(f'Unknown snapmirror alert type: "{key}".')
     #
-    # Run the API call to get the current state of all the snapmirror relationships.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/snapmirror/relationships?fields=*&return_timeout=15'
-    response = http.request('GET', endpoint, headers=headers)
-    if response.status == 200:
-        data = json.loads(response.data)
-        for record in data["records"]:
-            #
-            # Since there are multiple ways to process lag time, make sure to only do it one way for each relationship.
-            processedLagTime = False
+    # The policies and schedules are only needed to evaluate maxLagTimePercent.
+    scheduleCache = None
+    if maxLagTimePercent is not None:
+        scheduleCache = SnapMirrorScheduleCache(ctx)
+        scheduleCache.prefetch()
+    #
+    # Run the API call to get the current state of all the snapmirror
+    # relationships, and reduce each of them to just what is needed to
+    # evaluate the rules, stored in parallel arrays.
+    fields = "uuid,source.path,source.cluster.name,destination.path,state,healthy,unhealthy_reason,lag_time,policy.uuid,transfer_schedule.uuid,transfer.uuid,transfer.state,transfer.bytes_transferred"
+    names = []                          # (uuid, source cluster, source path, destination path)
+    lagSeconds = array.array('q')       # -1 if the lag time shouldn't be checked.
+    lastUpdates = array.array('q')      # The last scheduled update, -1 if there isn't a schedule.
+    inTransfer = bytearray()            # 1 if a transfer is in progress.
+    unhealthy = {}                      # index -> the reasons a relationship isn't healthy.
+    transfers = {}                      # index -> (transfer uuid, bytes transferred) of the transferring relationships.
+    try:
+        for record in ctx.getRecords("/api/snapmirror/relationships", fields):
+            index = len(names)
             #
             # If the source cluster isn't defined, then assume it is a local SM relationship.
-            if record['source'].get('cluster') is None:
-                sourceClusterName = clusterName
-            else:
-                sourceClusterName = record['source']['cluster']['name']
+            sourceCluster = record["source"].get("cluster")
+            names.append((record["uuid"], ctx.clusterName if sourceCluster is None else sourceCluster["name"], record["source"]["path"], record["destination"]["path"]))
             #
-            # For lag time if maxLagTimePercent is defined check to see if there is a schedule,
-            # if there is a schedule alert on that otherrwise alert on the maxLagTime.
-            # But, first check that lag_time is defined, and that the state is not "uninitialized",
-            # since the lag_time is set to the oldest snapshot of the source volume which would
-            # cause a false positive.
-            if record.get("lag_time") is not None and record["state"].lower() != "uninitialized":
-                lagSeconds = parseLagTime(record["lag_time"])
-                if maxLagTimePercent is not None:
-                    lastScheduledUpdate = getLastScheduledUpdate(record)
-                    if lastScheduledUpdate != -1:
-                        processedLagTime = True
-                        if lagSeconds > ((curTimeSeconds - lastScheduledUpdate) * maxLagTimePercent/100):
-                            #
-                            # If the transfer is in progress, and they have stalled transfer alert enabled, we don't need to alert on the lag time.
-                            if not (record.get("transfer") is not None and record["transfer"]["state"].lower() in ["transferring", "finalizing", "preparing", "fasttransferring"] and stalledTransferSeconds is not None):
-                                uniqueIdentifier = record["uuid"] + "_" + maxLagTimePercentKey
-                                if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                                    timeStr = lagTimeStr(lagSeconds)
-                                    asciiTime = datetime.datetime.fromtimestamp(lastScheduledUpdate).strftime('%Y-%m-%d %H:%M:%S')
-                                    message = f'Snapmirror Lag Alert: {sourceClusterName}::{record["source"]["path"]} -> {clusterName}::{record["destination"]["path"]} has a lag time of {lagSeconds} seconds ({timeStr}) which is more than {maxLagTimePercent}% of its last scheduled update at {asciiTime}.'
-                                    sendAlert(message, "WARNING")
-                                    changedEvents=True
-                                    event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                    }
-                                    events.append(event)
-
-                if maxLagTime is not None and not processedLagTime:
-                    if lagSeconds > maxLagTime:
-                        uniqueIdentifier = record["uuid"] + "_" + maxLagTimeKey
-                        if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                            timeStr = lagTimeStr(lagSeconds)
-                            message = f'Snapmirror Lag Alert: {sourceClusterName}::{record["source"]["path"]} -> {clusterName}::{record["destination"]["path"]} has a lag time of {lagSeconds} seconds, or {timeStr} which is more than {maxLagTime}.'
-                            sendAlert(message, "WARNING")
-                            changedEvents=True
-                            event = {
-                                "index": uniqueIdentifier,
-                                "message": message,
-                                "refresh": eventResilience
-                            }
-                            events.append(event)
-
-            if healthy is not None:
-                if not healthy and not record["healthy"]: # Report on "not healthy" and the status is "not healthy"
-                    uniqueIdentifier = record["uuid"] + "_" + healthyKey
-                    if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                        message = f'Snapmirror Health Alert: {sourceClusterName}::{record["source"]["path"]} {clusterName}::{record["destination"]["path"]} has a status of {record["healthy"]}.'
-                        for reason in record["unhealthy_reason"]:
-                            message += "\n" + reason["message"]
-                        sendAlert(message, "WARNING")
-                        changedEvents=True
-                        event = {
-                            "index": uniqueIdentifier,
-                            "message": message,
-                            "refresh": eventResilience
-                        }
-                        events.append(event)
-
-            if stalledTransferSeconds is not None:
-                if record.get('transfer') is not None and record['transfer']['state'].lower() == "transferring":
-                    transferUuid = record['transfer']['uuid']
-                    bytesTransferred = record['transfer']['bytes_transferred']
-                    prevRec =  getPreviousSMRecord(smRelationships, transferUuid) # This reset the "refresh" field if found.
-                    if prevRec != None:
-                        timeDiff=curTimeSeconds - prevRec["time"]
-                        if prevRec['bytesTransferred'] == bytesTransferred:
-                            if (curTimeSeconds - prevRec['time']) > stalledTransferSeconds:
-                                uniqueIdentifier = record['uuid'] + "_" + "transfer"
-
-                                if not eventExist(events, uniqueIdentifier):
-                                    message = f"Snapmiorror transfer has stalled: {sourceClusterName}::{record['source']['path']} -> {clusterName}::{record['destination']['path']}."
-                                    sendAlert(message, "WARNING")
-                                    changedEvents=True
-                                    event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                    }
-                                    events.append(event)
-                        else:
-                            prevRec['time'] = curTimeSeconds
-                            prevRec['refresh'] = True
-                            prevRec['bytesTransferred'] = bytesTransferred
-                            updateRelationships = True
-                    else:
-                        prevRec = {
-                            "time": curTimeSeconds,
-                            "refresh": True,
-                            "bytesTransferred": bytesTransferred,
-                            "uuid": transferUuid
-                        }
-                        updateRelationships = True
-                        smRelationships.append(prevRec)
-        #
-        # After processing the records, see if any SM relationships need to be removed.
-        i = 0
-        while i < len(smRelationships):
-            if not smRelationships[i]["refresh"]:
-                relationshipId = smRelationships[i].get("uuid")
-                if relationshipId is None:
-                    id="Old format"
+            # Only check the lag time if it is defined and the state isn't
+            # "uninitialized", since the lag_time is set to the oldest snapshot
+            # of the source volume which would cause a false positive.
+            lagTime = record.get("lag_time")
+            lagSeconds.append(parseLagTime(lagTime) if lagTime is not None and record["state"].lower() != "uninitialized" else -1)
+            lastUpdates.append(scheduleCache.getLastScheduledUpdate(record) if maxLagTimePercent is not None else -1)
+            transfer = record.get("transfer")
+            transferState = transfer["state"].lower() if transfer is not None else None
+            inTransfer.append(transferState in smActiveTransferStates)
+            if transferState == "transferring":
+                transfers[index] = (transfer["uuid"], transfer["bytes_transferred"])
+            if not record["healthy"]:
+                unhealthy[index] = record.get("unhealthy_reason", [])
+    except OntapApiError as err:
+        logger.warning(err)
+        return
+    #
+    # Evaluate all the rules against all the relationships in one pass. The
+    # alerts are collected, then sent in the order of the relationships.
+    pending = evaluateSnapMirrorRules(lagSeconds, lastUpdates, inTransfer, unhealthy, curTimeSeconds, maxLagTime, maxLagTimePercent, healthy, stalledTransferSeconds)
+    #
+    # Check for stalled transfers, which needs the bytes transferred from previous runs.
+    if stalledTransferSeconds is not None:
+        for index, (transferUuid, bytesTransferred) in transfers.items():
+            prevRec =  getPreviousSMRecord(smRelationships, transferUuid) # This reset the "refresh" field if found.
+            if prevRec != None:
+                if prevRec['bytesTransferred'] == bytesTransferred:
+                    if (curTimeSeconds - prevRec['time']) > stalledTransferSeconds:
+                        pending.append((index, 2, "stalled"))
                 else:
-                    id = relationshipId
-                logger.debug(f'Deleting smRelationship: {id}')
-                del smRelationships[i]
+                    prevRec['time'] = curTimeSeconds
+                    prevRec['refresh'] = True
+                    prevRec['bytesTransferred'] = bytesTransferred
+                    updateRelationships = True
+            else:
+                prevRec = {
+                    "time": curTimeSeconds,
+                    "refresh": True,
+                    "bytesTransferred": bytesTransferred,
+                    "uuid": transferUuid
+                }
                 updateRelationships = True
+                smRelationships[transferUuid] = prevRec
+
+    pending.sort()
+    for index, _, alertType in pending:
+        uuid, sourceClusterName, sourcePath, destinationPath = names[index]
+        if alertType == "maxLagTimePercent":
+            uniqueIdentifier = uuid + "_" + maxLagTimePercentKey
+            if not events.exists(uniqueIdentifier):
+                timeStr = lagTimeStr(lagSeconds[index])
+                asciiTime = datetime.datetime.fromtimestamp(lastUpdates[index]).strftime('%Y-%m-%d %H:%M:%S')
+                message = f'Snapmirror Lag Alert: {sourceClusterName}::{sourcePath} -> {ctx.clusterName}::{destinationPath} has a lag time of {lagSeconds[index]} seconds ({timeStr}) which is more than {maxLagTimePercent}% of its last scheduled update at {asciiTime}.'
             else:
-                i += 1
-        #
-        # If any of the SM relationships changed, save it.
-        if(updateRelationships):
-            s3Client.put_object(Key=config["smRelationshipsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(smRelationships).encode('UTF-8'))
+                continue
+        elif alertType == "maxLagTime":
+            uniqueIdentifier = uuid + "_" + maxLagTimeKey
+            if not events.exists(uniqueIdentifier):
+                timeStr = lagTimeStr(lagSeconds[index])
+                message = f'Snapmirror Lag Alert: {sourceClusterName}::{sourcePath} -> {ctx.clusterName}::{destinationPath} has a lag time of {lagSeconds[index]} seconds, or {timeStr} which is more than {maxLagTime}.'
+            else:
+                continue
+        elif alertType == "healthy":
+            uniqueIdentifier = uuid + "_" + healthyKey
+            if not events.exists(uniqueIdentifier):
+                message = f'Snapmirror Health Alert: {sourceClusterName}::{sourcePath} {ctx.clusterName}::{destinationPath} has a status of False.'
+                for reason in unhealthy[index]:
+                    message += "\n" + reason["message"]
+            else:
+                continue
+        else:
+            uniqueIdentifier = uuid + "_" + "transfer"
+            if not events.exists(uniqueIdentifier):
+                message = f"Snapmiorror transfer has stalled: {sourceClusterName}::{sourcePath} -> {ctx.clusterName}::{destinationPath}."
+            else:
+                continue
+        sendAlert(ctx, message, "WARNING")
+        event = {
+            "index": uniqueIdentifier,
+            "message": message
+        }
+        events.add(event)
+    #
+    # After processing the records, see if any SM relationships need to be removed.
+    for relationshipId in [uuid for uuid, relationship in smRelationships.items() if not relationship["refresh"]]:
+        logger.debug(f'Deleting smRelationship: {relationshipId if relationshipId is not None else "Old format"}')
+        del smRelationships[relationshipId]
+        updateRelationships = True
+    #
+    # If any of the SM relationships changed, save it.
+    if(updateRelationships):
+        ctx.stateStore.set("smRelationships", list(smRelationships.values()))
+    #
+    # After processing the records, age the events, and save any that changed.
+    ctx.stateStore.setHistory("smEvents", events)
+
+################################################################################
+# This function evaluates the lag time and health rules against all the
+# SnapMirror relationships at once. The relationships are passed in as
+# parallel arrays, indexed by relationship, of the lag time in seconds (-1
+# to not check it), the last scheduled update (-1 if there isn't a
+# schedule), and whether a transfer is in progress, along with a dictionary
+# of the unhealthy ones. It returns a list of (index, order, alert type)
+# tuples, for the rules that were violated. For lag time, if maxLagTimePercent
+# is set and the relationship has a schedule, it is checked against the time
+# since its last scheduled update, otherwise against maxLagTime.
+################################################################################
+def evaluateSnapMirrorRules(lagSeconds, lastUpdates, inTransfer, unhealthy, curTimeSeconds, maxLagTime, maxLagTimePercent, healthy, stalledTransferSeconds):
+    pending = []
+    if maxLagTime is not None or maxLagTimePercent is not None:
         #
-        # After processing the records, see if any events need to be removed.
-        i = 0
-        while i < len(events):
-            if events[i]["refresh"] <= 0:
-                logger.debug(f'Deleting event: {events[i]["message"]}')
-                del events[i]
-                changedEvents = True
+        # If the transfer is in progress, and they have stalled transfer
+        # alert enabled, there is no need to alert on the percent lag time.
+        ignoreTransferring = stalledTransferSeconds is not None
+        for index, (lag, lastUpdate, transferring) in enumerate(zip(lagSeconds, lastUpdates, inTransfer)):
+            if lag < 0:
+                continue
+            if lastUpdate != -1 and maxLagTimePercent is not None:
+                if lag > (curTimeSeconds - lastUpdate) * maxLagTimePercent/100 and not (transferring and ignoreTransferring):
+                    pending.append((index, 0, "maxLagTimePercent"))
+            elif maxLagTime is not None and lag > maxLagTime:
+                pending.append((index, 0, "maxLagTime"))
+
+    if healthy is not None and not healthy: # Report on "not healthy" and the status is "not healthy"
+        pending.extend((index, 1, "healthy") for index in unhealthy)
+
+    return pending
+
+################################################################################
+# This class holds the history of the used space of the volumes and
+# aggregates, so their growth rate can be determined. Since it is stored with
+# the state, and there can be 10,000s of volumes, it is kept compact:
+#   - The samples for all the volumes and aggregates are taken at the same
+#     time, so the sample times are only stored once.
+#   - The samples, in MiB, are kept in a single array of unsigned 32 bit
+#     integers (typecode 'I', since 'L' is 64 bits on 64 bit Linux), with a
+#     fixed size ring buffer of "numSamples" slots for each UUID. The array
+#     is stored zlib compressed and base64 encoded.
+# A volume, or aggregate, that wasn't seen when a sample was taken gets a
+# "missing" value in that slot, and once it has been missing for all the
+# samples it is removed.
+################################################################################
+class CapacityHistory:
+    missing = 0xFFFFFFFF
+    bytesPerUnit = 1024 * 1024
+
+    def __init__(self, state, numSamples, intervalSeconds):
+        self.numSamples = numSamples
+        self.intervalSeconds = intervalSeconds
+        self.times = array.array('d', [0.0] * numSamples)
+        self.used = array.array('I')
+        self.slots = {}
+        self.next = 0
+        if state is not None and state.get("numSamples") == numSamples:
+            usedBytes = zlib.decompress(base64.b64decode(state["used"]))
+            if len(usedBytes) == len(state["uuids"]) * numSamples * self.used.itemsize:
+                self.times = array.array('d', zlib.decompress(base64.b64decode(state["times"])))
+                self.used = array.array('I', usedBytes)
+                self.slots = {uuid: slot for slot, uuid in enumerate(state["uuids"])}
+                self.next = state["next"]
             else:
-                # If an event wasn't refreshed, then we need to save the new refresh count.
-                if events[i]["refresh"] != eventResilience:
-                    changedEvents = True
-                i += 1
+                logger.warning("Discarding the capacity history since its samples are not in the expected format.")
+        self.seen = set()
+
+    ############################################################################
+    # This method returns True if enough time has passed since the last
+    # sample to take another one.
+    ############################################################################
+    def isSampleDue(self, now):
+        lastTime = self.times[(self.next - 1) % self.numSamples]
+        return now - lastTime >= self.intervalSeconds
+
+    ############################################################################
+    # This method adds the used space of a volume, or aggregate, to the
+    # sample being taken.
+    ############################################################################
+    def record(self, uuid, usedBytes):
+        slot = self.slots.get(uuid)
+        if slot is None:
+            slot = len(self.slots)
+            self.slots[uuid] = slot
+            self.used.extend([self.missing] * self.numSamples)
+        self.used[slot * self.numSamples + self.next] = min(usedBytes // self.bytesPerUnit, self.missing - 1)
+        self.seen.add(uuid)
+
+    ############################################################################
+    # This method completes the sample being taken, at the time passed in.
+    ############################################################################
+    def commit(self, now):
+        numSamples = self.numSamples
+        uuids = []
+        used = array.array('I')
+        for uuid, slot in self.slots.items():
+            start = slot * numSamples
+            if uuid not in self.seen:
+                self.used[start + self.next] = self.missing
+                if self.used[start:start + numSamples].count(self.missing) == numSamples:
+                    continue
+            uuids.append(uuid)
+            used.extend(self.used[start:start + numSamples])
+        self.slots = {uuid: slot for slot, uuid in enumerate(uuids)}
+        self.used = used
+        self.times[self.next] = now
+        self.next = (self.next + 1) % numSamples
+        self.seen = set()
+
+    ############################################################################
+    # This method returns the growth rate, in bytes per hour, of each of the
+    # UUIDs passed in that have at least three samples. It is determined with
+    # a weighted least squares linear regression over the samples, where the
+    # weight of a sample decays exponentially with its age (like an EWMA), so
+    # the rate follows recent changes in the growth. Since the sample times
+    # are the same for every UUID, everything that only depends on them is
+    # calculated once, leaving a single sum(map()), which runs at C speed,
+    # for each UUID.
+    ############################################################################
+    def growthRates(self, uuids):
+        numSamples = self.numSamples
+        latestTime = self.times[(self.next - 1) % numSamples]
+        numEmpty = self.times.count(0.0)
+        if numSamples - numEmpty < 3:
+            return {}
         #
-        # If the events array changed, save it.
-        if(changedEvents):
-            s3Client.put_object(Key=config["smEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
-    else:
-        logger.warning(f'API call to {endpoint} failed. HTTP status code {response.status}.')
+        # Measure the time in hours, relative to the latest sample, to keep
+        # the numbers small. The slots that haven't had a sample taken yet are
+        # "missing" for every UUID, and get a weight of zero.
+        hours = [(sampleTime - latestTime) / 3600 if sampleTime > 0 else 0.0 for sampleTime in self.times]
+        latestPosition = (self.next - 1) % numSamples
+        weights = [0.5 ** (((latestPosition - position) % numSamples) / capacityHistoryHalfLife) if self.times[position] > 0 else 0.0 for position in range(numSamples)]
+        weightedHours = list(map(operator.mul, weights, hours))
+        sumW = sum(weights)
+        sumWX = sum(weightedHours)
+        sumWXX = sum(map(operator.mul, weightedHours, hours))
+        denominator = sumW * sumWXX - sumWX * sumWX
+        if denominator == 0:
+            return {}
+        #
+        # The slope is (sumW*sumWXY - sumWX*sumWY) / denominator, which is the
+        # sum of the samples multiplied by these coefficients.
+        coefficients = [(sumW * weightedHour - sumWX * weight) / denominator * self.bytesPerUnit for weight, weightedHour in zip(weights, weightedHours)]
+
+        rates = {}
+        used = self.used
+        missing = self.missing
+        for uuid in uuids:
+            slot = self.slots.get(uuid)
+            if slot is None:
+                continue
+            samples = used[slot * numSamples:(slot + 1) * numSamples]
+            if samples.count(missing) == numEmpty:
+                rates[uuid] = sum(map(operator.mul, coefficients, samples))
+            else:
+                #
+                # Only use the samples that aren't missing.
+                valid = [i for i, sample in enumerate(samples) if sample != missing and weights[i] > 0]
+                if len(valid) < 3:
+                    continue
+                w = [weights[i] for i in valid]
+                x = [hours[i] for i in valid]
+                y = [samples[i] for i in valid]
+                wx = list(map(operator.mul, w, x))
+                sW, sWX, sWXX = sum(w), sum(wx), sum(map(operator.mul, wx, x))
+                d = sW * sWXX - sWX * sWX
+                if d != 0:
+                    rates[uuid] = (sW * sum(map(operator.mul, wx, y)) - sWX * sum(map(operator.mul, w, y))) / d * self.bytesPerUnit
+        return rates
+
+    ############################################################################
+    # This method returns the history in the format it is stored in the state.
+    ############################################################################
+    def toState(self):
+        return {
+            "numSamples": self.numSamples,
+            "next": self.next,
+            "times": base64.b64encode(zlib.compress(self.times.tobytes())).decode('ascii'),
+            "uuids": list(self.slots.keys()),
+            "used": base64.b64encode(zlib.compress(self.used.tobytes())).decode('ascii')
+        }
 
 ################################################################################
-# This function is used to check all the volume and aggregate utlization.
+# This function formats a number of bytes for the alert messages.
 ################################################################################
-def processStorageUtilization(service):
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
+def formatBytes(numBytes):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(numBytes) < 1024:
+            return f'{numBytes:.1f}{unit}'
+        numBytes /= 1024
+    return f'{numBytes:.1f}PiB'
 
-    changedEvents=False
+################################################################################
+# This function is used to check all the volume and aggregate utlization.
+# The rules are first consolidated into a table of thresholds, so each
+# aggregate and volume (including FlexGroup constituents) only has to be
+# looked at once, as it is received, and checked against all of them.
+#
+# If there is an "aggrProjectedFullHours", or "volumeProjectedFullHours",
+# rule, the used space is also recorded in the capacity history, and an
+# alert is sent if, at the rate it has been growing, the aggregate or volume
+# will be full within that many hours.
+################################################################################
+def processStorageUtilization(ctx, service):
+    global logger
     #
     # Get the saved events so we can ensure we are only reporting on new ones.
-    try:
-        data = s3Client.get_object(Key=config["storageEventsFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then it will get created once an alert it sent.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            events = []
-        else:
-            raise err
-    else:
-        events = json.loads(data["Body"].read().decode('UTF-8'))
-    #
-    # Decrement the refresh field to know if any records have really gone away.
-    for event in events:
-        event["refresh"] -= 1
-    #
-    # Run the API call to get the physical storage used.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/storage/aggregates?fields=space&return_timeout=15'
-    aggrResponse = http.request('GET', endpoint, headers=headers)
-    if aggrResponse.status != 200:
-        logger.error(f'API call to {endpoint} failed. HTTP status code {aggrResponse.status}.')
-        aggrResponse = None
-    #
-    # Run the API call to get the volume information.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/storage/volumes?fields=space,files,svm,state&return_timeout=15'
-    volumeResponse = http.request('GET', endpoint, headers=headers)
-    if volumeResponse.status != 200:
-        logger.error(f'API call to {endpoint} failed. HTTP status code {volumeResponse.status}.')
-        volumeResponse = None
-        volumeRecords = None
-    else:
-        volumeRecords = json.loads(volumeResponse.data).get("records")
-        #
-        # Now get the constituent volumes.
-        endpoint = f'https://{config["OntapAdminServer"]}/api/storage/volumes?is_constituent=true&fields=space,files,svm,state&return_timeout=15'
-        volumeResponse = http.request('GET', endpoint, headers=headers)
-        if volumeResponse.status != 200:
-            logger.error(f'API call to {endpoint} failed. HTTP status code {volumeResponse.status}.')
-        else:
-            volumeRecords.extend(json.loads(volumeResponse.data).get("records"))
+    events = ctx.stateStore.getHistory("storageEvents")
     #
-    # If both API calls failed, no point on continuing.
-    if volumeResponse is None and aggrResponse is None:
-        return
-
+    # Build the threshold table.
+    aggrRules = []
+    volumeSpaceRules = []
+    volumeFilesRules = []
+    offlineRules = []
+    forecastRules = {}
     for rule in service["rules"]:
         for key in rule.keys():
             lkey=key.lower()
             if lkey == "aggrwarnpercentused" or lkey == 'aggrcriticalpercentused':
-                if aggrResponse is not None:
-                    data = json.loads(aggrResponse.data)
-                    for aggr in data["records"]:
-                        if aggr["space"]["block_storage"]["used_percent"] >= rule[key]:
-                            uniqueIdentifier = aggr["uuid"] + "_" + key
-                            if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                                alertType = 'Warning' if lkey == "aggrwarnpercentused" else 'Critical'
-                                message = f'Aggregate {alertType} Alert: Aggregate {aggr["name"]} on {clusterName} is {aggr["space"]["block_storage"]["used_percent"]}% full, which is more or equal to {rule[key]}% full.'
-                                sendAlert(message, "WARNING")
-                                changedEvents = True
+                aggrRules.append((key, rule[key], 'Warning' if lkey == "aggrwarnpercentused" else 'Critical'))
+            elif lkey == "volumewarnpercentused" or lkey == "volumecriticalpercentused":
+                volumeSpaceRules.append((key, rule[key], 'Warning' if lkey == "volumewarnpercentused" else 'Critical'))
+            elif lkey == "volumewarnfilespercentused" or lkey == "volumecriticalfilespercentused":
+                volumeFilesRules.append((key, rule[key], 'Warning' if lkey == "volumewarnfilespercentused" else 'Critical'))
+            elif lkey == "offline":
+                if rule[key]:
+                    offlineRules.append((key, rule[key]))
+            elif lkey == "aggrprojectedfullhours" or lkey == "volumeprojectedfullhours":
+                if rule[key]:
+                    forecastRules["aggregate" if lkey == "aggrprojectedfullhours" else "volume"] = (key, rule[key])
+            else:
+                message = f'Unknown storage alert type: "{key}".'
+                logger.warning(message)
+    #
+    # Get the capacity history, if it's needed for a forecast.
+    history = None
+    if len(forecastRules) > 0:
+        numSamples = int(ctx.config["capacityHistorySamples"]) if ctx.config["capacityHistorySamples"] is not None else capacityHistoryDefaultSamples
+        intervalMinutes = float(ctx.config["capacityHistoryIntervalMinutes"]) if ctx.config["capacityHistoryIntervalMinutes"] is not None else capacityHistoryDefaultIntervalMinutes
+        history = CapacityHistory(ctx.stateStore.get("capacityHistory"), numSamples, intervalMinutes * 60)
+        now = time.time()
+        sampleDue = history.isSampleDue(now)
+    forecasts = {}  # uuid -> (kind, description, available bytes, forecast rule)
+    #
+    # Start the API calls to get the aggregates and volumes, so they run concurrently.
+    checkAggregates = len(aggrRules) > 0 or "aggregate" in forecastRules
+    if checkAggregates:
+        aggrFields = "name,space.block_storage.used_percent"
+        if "aggregate" in forecastRules:
+            aggrFields += ",space.block_storage.used,space.block_storage.available"
+        aggregates = ctx.getRecords("/api/storage/aggregates", aggrFields)
+    checkVolumes = len(volumeSpaceRules) > 0 or len(volumeFilesRules) > 0 or len(offlineRules) > 0 or "volume" in forecastRules
+    if checkVolumes:
+        volumeFields = "name,svm.name,state,space.percent_used,files.maximum,files.used"
+        if "volume" in forecastRules:
+            volumeFields += ",space.used,space.available"
+        volumes = ctx.getRecords("/api/storage/volumes", volumeFields, "&is_constituent=true|false")
+    #
+    # Check the physical storage used.
+    aggrFailed = False
+    if checkAggregates:
+        try:
+            for aggr in aggregates:
+                usedPercent = aggr["space"]["block_storage"]["used_percent"]
+                if "aggregate" in forecastRules and aggr["space"]["block_storage"].get("used") is not None:
+                    if sampleDue:
+                        history.record(aggr["uuid"], aggr["space"]["block_storage"]["used"])
+                    forecasts[aggr["uuid"]] = ("Aggregate", f'Aggregate {aggr["name"]}', aggr["space"]["block_storage"].get("available"), forecastRules["aggregate"])
+                for key, threshold, alertType in aggrRules:
+                    if usedPercent >= threshold:
+                        uniqueIdentifier = aggr["uuid"] + "_" + key
+                        if not events.exists(uniqueIdentifier):
+                            message = f'Aggregate {alertType} Alert: Aggregate {aggr["name"]} on {ctx.clusterName} is {usedPercent}% full, which is more or equal to {threshold}% full.'
+                            sendAlert(ctx, message, "WARNING")
+                            event = {
+                                    "index": uniqueIdentifier,
+                                    "message": message
+                                }
+                            logger.debug(event)
+                            events.add(event)
+        except OntapApiError as err:
+            logger.error(err)
+            aggrFailed = True
+    #
+    # Check the volume information, including the FlexGroup constituents.
+    volumeFailed = False
+    if checkVolumes:
+        try:
+            for record in volumes:
+                usedPercent = record["space"].get("percent_used") if record.get("space") is not None else None
+                if "volume" in forecastRules and record.get("space") is not None and record["space"].get("used") is not None:
+                    if sampleDue:
+                        history.record(record["uuid"], record["space"]["used"])
+                    forecasts[record["uuid"]] = ("Volume", f'volume {record["svm"]["name"]}:{record["name"]}', record["space"].get("available"), forecastRules["volume"])
+                if usedPercent:
+                    for key, threshold, alertType in volumeSpaceRules:
+                        if usedPercent >= threshold:
+                            uniqueIdentifier = record["uuid"] + "_" + key
+                            if not events.exists(uniqueIdentifier):
+                                message = f'Volume Usage {alertType} Alert: volume {record["svm"]["name"]}:{record["name"]} on {ctx.clusterName} is {usedPercent}% full, which is more or equal to {threshold}% full.'
+                                sendAlert(ctx, message, "WARNING")
                                 event = {
                                         "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
+                                        "message": message
                                     }
-                                logger.debug(event)
-                                events.append(event)
-            elif lkey == "volumewarnpercentused" or lkey == "volumecriticalpercentused":
-                if volumeResponse is not None:
-                    for record in volumeRecords:
-                        if record["space"].get("percent_used"):
-                            if record["space"]["percent_used"] >= rule[key]:
+                                events.add(event)
+                #
+                # If a volume is offline, the API will not report the "files" information.
+                if record.get("files") is not None and len(volumeFilesRules) > 0:
+                    maxFiles = record["files"].get("maximum")
+                    usedFiles = record["files"].get("used")
+                    if maxFiles and usedFiles != None:
+                        percentUsed = (usedFiles / maxFiles) * 100
+                        for key, threshold, alertType in volumeFilesRules:
+                            if percentUsed >= threshold:
                                 uniqueIdentifier = record["uuid"] + "_" + key
-                                if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                                    alertType = 'Warning' if lkey == "volumewarnpercentused" else 'Critical'
-                                    message = f'Volume Usage {alertType} Alert: volume {record["svm"]["name"]}:{record["name"]} on {clusterName} is {record["space"]["percent_used"]}% full, which is more or equal to {rule[key]}% full.'
-                                    sendAlert(message, "WARNING")
-                                    changedEvents = True
+                                if not events.exists(uniqueIdentifier):
+                                    message = f"Volume File (inode) Usage {alertType} Alert: volume {record['svm']['name']}:{record['name']} on {ctx.clusterName} is using {percentUsed:.0f}% of it's inodes, which is more or equal to {threshold}% utilization."
+                                    sendAlert(ctx, message, "WARNING")
                                     event = {
                                             "index": uniqueIdentifier,
-                                            "message": message,
-                                            "refresh": eventResilience
+                                            "message": message
                                         }
-                                    events.append(event)
-            elif lkey == "volumewarnfilespercentused" or lkey == "volumecriticalfilespercentused":
-                if volumeResponse is not None:
-                    for record in volumeRecords:
-                        #
-                        # If a volume is offline, the API will not report the "files" information.
-                        if record.get("files") is not None:
-                            maxFiles = record["files"].get("maximum")
-                            usedFiles = record["files"].get("used")
-                            if maxFiles != None and usedFiles != None:
-                                percentUsed = (usedFiles / maxFiles) * 100
-                                if percentUsed >= rule[key]:
-                                    uniqueIdentifier = record["uuid"] + "_" + key
-                                    if not eventExist(events, uniqueIdentifier):
-                                        alertType = 'Warning' if lkey == "volumewarnfilespercentused" else 'Critical'
-                                        message = f"Volume File (inode) Usage {alertType} Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is using {percentUsed:.0f}% of it's inodes, which is more or equal to {rule[key]}% utilization."
-                                        sendAlert(message, "WARNING")
-                                        changedEvents = True
-                                        event = {
-                                                "index": uniqueIdentifier,
-                                                "message": message,
-                                                "refresh": eventResilience
-                                            }
-                                        events.append(event)
-            elif lkey == "offline":
-                for record in volumeRecords:
-                    if rule[key] and record["state"].lower() == "offline":
-                        uniqueIdentifier = f'{record["uuid"]}_{key}_{rule[key]}'
-                        if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                            message = f"Volume Offline Alert: volume {record['svm']['name']}:{record['name']} on {clusterName} is offline."
-                            sendAlert(message, "WARNING")
-                            changedEvents=True
+                                    events.add(event)
+
+                if record["state"].lower() == "offline":
+                    for key, value in offlineRules:
+                        uniqueIdentifier = f'{record["uuid"]}_{key}_{value}'
+                        if not events.exists(uniqueIdentifier):
+                            message = f"Volume Offline Alert: volume {record['svm']['name']}:{record['name']} on {ctx.clusterName} is offline."
+                            sendAlert(ctx, message, "WARNING")
                             event = {
                                 "index": uniqueIdentifier,
-                                "message": message,
-                                "refresh": eventResilience
+                                "message": message
                             }
-                            events.append(event)
-            else:
-                message = f'Unknown storage alert type: "{key}".'
-                logger.warning(message)
+                            events.add(event)
+        except OntapApiError as err:
+            logger.error(err)
+            volumeFailed = True
     #
-    # After processing the records, see if any events need to be removed.
-    i = 0
-    while i < len(events):
-        if events[i]["refresh"] <= 0:
-            logger.debug(f'Deleting event: {events[i]["message"]}')
-            del events[i]
-            changedEvents = True
-        else:
-            # If an event wasn't refreshed, then we need to save the new refresh count.
-            if events[i]["refresh"] != eventResilience:
-                changedEvents = True
-            i += 1
+    # Forecast when the aggregates and volumes will be full. The sample is
+    # only added to the history if all of it was retrieved, otherwise the
+    # volumes or aggregates not retrieved would be considered missing.
+    if history is not None:
+        if sampleDue and not aggrFailed and not volumeFailed:
+            history.commit(now)
+            ctx.stateStore.set("capacityHistory", history.toState())
+        for uuid, rate in history.growthRates(forecasts.keys()).items():
+            kind, description, available, (key, maxHours) = forecasts[uuid]
+            if rate <= 0 or available is None:
+                continue
+            hoursToFull = available / rate
+            if hoursToFull <= maxHours:
+                uniqueIdentifier = uuid + "_" + key
+                if not events.exists(uniqueIdentifier):
+                    message = f'{kind} Capacity Forecast Alert: {description} on {ctx.clusterName} is growing by {formatBytes(rate)} per hour, and is projected to be full in {hoursToFull:.0f} hours, which is less or equal to {maxHours} hours.'
+                    sendAlert(ctx, message, "WARNING")
+                    event = {
+                        "index": uniqueIdentifier,
+                        "message": message
+                    }
+                    events.add(event)
     #
-    # If the events array changed, save it.
-    if(changedEvents):
-        s3Client.put_object(Key=config["storageEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+    # If both API calls failed, don't age the events since nothing was checked.
+    if aggrFailed and volumeFailed:
+        return
+    #
+    # After processing the records, age the events, and save any that changed.
+    ctx.stateStore.setHistory("storageEvents", events)
+
+################################################################################
+# This class collects the alerts generated while monitoring a cluster and
+# delivers them in batches, instead of making several AWS API calls for each
+# one:
+#   - The CloudWatch log events are sent with as few put_log_events calls as
+#     the CloudWatch limits allow, and the log stream is only looked up (or
+#     created) once, then remembered.
+#   - If snsDigest is set to "true", the alerts with the same severity are
+#     combined into as few SNS messages as the SNS size limit allows.
+#     Otherwise, an SNS message is still published for each alert.
+# The alerts are delivered when flush() is called at the end of the run. If
+# alertBatchSeconds is set, they are also delivered as soon as the oldest
+# undelivered alert is that many seconds old. The SNS topic and CloudWatch
+# log group are the ones configured for the cluster, which, in a fleet, can
+# be in a different region than the default ones.
+################################################################################
+class AlertDispatcher:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.snsClient = None
+        self.cloudWatchClient = None
+        self.alerts = []
+        self.oldestAlertTime = None
+        self.lock = threading.Lock()
+        self.digest = ctx.config["snsDigest"] is not None and ctx.config["snsDigest"].lower() == "true"
+        self.batchSeconds = float(ctx.config["alertBatchSeconds"]) if ctx.config["alertBatchSeconds"] is not None else None
+
+    ############################################################################
+    # This method queues an alert for delivery.
+    ############################################################################
+    def add(self, message, severity):
+        with self.lock:
+            alert = {
+                "message": message,
+                "severity": severity,
+                "timestamp": int(datetime.datetime.now().timestamp() * 1000),
+                "clusterName": self.ctx.clusterName
+            }
+            self.alerts.append(alert)
+            if self.oldestAlertTime is None:
+                self.oldestAlertTime = time.monotonic()
+            flushNow = self.batchSeconds is not None and time.monotonic() - self.oldestAlertTime >= self.batchSeconds
+
+        if flushNow:
+            self.flush()
+
+    ############################################################################
+    # This method delivers all the queued alerts.
+    ############################################################################
+    def flush(self):
+        with self.lock:
+            alerts = self.alerts
+            self.alerts = []
+            self.oldestAlertTime = None
+        if len(alerts) == 0:
+            return
+
+        self.getClients()
+        self.publishToSns(alerts)
+        if self.cloudWatchClient is not None:
+            self.putLogEvents(alerts)
+
+    ############################################################################
+    # This method gets the clients for the SNS topic and CloudWatch log group
+    # of the cluster. They come from the cache shared by all the clusters.
+    ############################################################################
+    def getClients(self):
+        config = self.ctx.config
+        if self.snsClient is None:
+            self.snsClient = getAwsClient('sns', config["snsTopicArn"].split(":")[3], config["snsEndPointHostname"])
+        if self.cloudWatchClient is None and config["cloudWatchLogGroupArn"] is not None:
+            self.cloudWatchClient = getAwsClient('logs', config["cloudWatchLogGroupArn"].split(":")[3], config["cloudWatchLogsEndPointHostname"])
+
+    ############################################################################
+    # This method publishes the alerts to the SNS topic.
+    ############################################################################
+    def publishToSns(self, alerts):
+        if not self.digest:
+            for alert in alerts:
+                self.snsClient.publish(TopicArn=self.ctx.config["snsTopicArn"], Message=alert["message"], Subject=f'{alert["severity"]}: Monitor ONTAP Services Alert for cluster {alert["clusterName"]}')
+            self.ctx.metrics.count("snsPublishes", len(alerts))
+            return
+        #
+        # Combine the alerts of each severity into as few messages as possible.
+        severities = {}
+        for alert in alerts:
+            severities.setdefault(alert["severity"], []).append(alert["message"])
+        for severity, messages in severities.items():
+            digest = []
+            digestBytes = 0
+            for message in messages:
+                messageBytes = len(message.encode('UTF-8')) + 1
+                if len(digest) > 0 and digestBytes + messageBytes > maxSnsMessageBytes:
+                    self.publishDigest(severity, digest)
+                    digest = []
+                    digestBytes = 0
+                digest.append(message)
+                digestBytes += messageBytes
+            self.publishDigest(severity, digest)
+
+    ############################################################################
+    # This method publishes a list of alert messages as one SNS message.
+    ############################################################################
+    def publishDigest(self, severity, messages):
+        if len(messages) == 1:
+            subject = f'{severity}: Monitor ONTAP Services Alert for cluster {self.ctx.clusterName}'
+        else:
+            subject = f'{severity}: {len(messages)} Monitor ONTAP Services Alerts for cluster {self.ctx.clusterName}'
+        self.snsClient.publish(TopicArn=self.ctx.config["snsTopicArn"], Message="\n".join(messages), Subject=subject)
+        self.ctx.metrics.count("snsPublishes")
+
+    ############################################################################
+    # This method sends the alerts to the CloudWatch log group, in a log
+    # stream for the current day.
+    ############################################################################
+    def putLogEvents(self, alerts):
+        #
+        # Don't ask me why AWS puts a ":*" at the end of the log group ARN, but they do.
+        logGroupArn = self.ctx.config["cloudWatchLogGroupArn"]
+        logGroupName = logGroupArn.split(":")[-2] if logGroupArn.endswith(":*") else logGroupArn.split(":")[-1]
+        #
+        # Group the events by log stream, in case the day changed during the run.
+        logStreams = {}
+        for alert in alerts:
+            dateStr = datetime.datetime.fromtimestamp(alert["timestamp"]/1000).strftime("%Y-%m-%d")
+            logStreamName = f'{alert["clusterName"]}-monitor-ontap-services-{dateStr}'
+            logStreams.setdefault(logStreamName, []).append({"timestamp": alert["timestamp"], "message": alert["message"]})
+
+        for logStreamName, logEvents in logStreams.items():
+            self.ensureLogStream(logGroupName, logStreamName)
+            #
+            # The events in a batch have to be in chronological order.
+            logEvents.sort(key=lambda logEvent: logEvent["timestamp"])
+            batch = []
+            batchBytes = 0
+            for logEvent in logEvents:
+                eventBytes = len(logEvent["message"].encode('UTF-8')) + logEventOverheadBytes
+                if len(batch) > 0 and (len(batch) >= maxLogEventsPerBatch or batchBytes + eventBytes > maxLogBatchBytes):
+                    self.cloudWatchClient.put_log_events(logGroupName=logGroupName, logStreamName=logStreamName, logEvents=batch)
+                    self.ctx.metrics.count("cloudWatchPuts")
+                    batch = []
+                    batchBytes = 0
+                batch.append(logEvent)
+                batchBytes += eventBytes
+            self.cloudWatchClient.put_log_events(logGroupName=logGroupName, logStreamName=logStreamName, logEvents=batch)
+            self.ctx.metrics.count("cloudWatchPuts")
+
+    ############################################################################
+    # This method creates the log stream if it doesn't already exist. The log
+    # streams known to exist are remembered so this is only done once. The
+    # lock is not held during the API calls, so the clusters checked
+    # concurrently don't wait on each other. If two of them create the same
+    # log stream, the second one gets ResourceAlreadyExistsException.
+    ############################################################################
+    def ensureLogStream(self, logGroupName, logStreamName):
+        key = (self.cloudWatchClient.meta.region_name, logGroupName, logStreamName)
+        with knownLogStreamsLock:
+            if key in knownLogStreams:
+                return
+
+        logStreams = self.cloudWatchClient.describe_log_streams(logGroupName=logGroupName, logStreamNamePrefix=logStreamName)
+        if not any(logStream["logStreamName"] == logStreamName for logStream in logStreams["logStreams"]):
+            try:
+                self.cloudWatchClient.create_log_stream(logGroupName=logGroupName, logStreamName=logStreamName)
+            except self.cloudWatchClient.exceptions.ResourceAlreadyExistsException:
+                pass
+        with knownLogStreamsLock:
+            knownLogStreams.add(key)
 
 ################################################################################
-# This function sends the message to the various alerting systems.
+# This function logs the message and queues it to be sent to the various
+# alerting systems.
 ################################################################################
-def sendAlert(message, severity):
-    global config, snsClient, logger, cloudWatchClient
+def sendAlert(ctx, message, severity):
+    global logger
 
     if severity == "CRITICAL":
         logger.critical(message)
@@ -937,204 +2279,126 @@ def sendAlert(message, severity):
     else:
         logger.info(message)
 
-    snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'{severity}: Monitor ONTAP Services Alert for cluster {clusterName}')
-
-    if cloudWatchClient is not None:
-        #
-        # Create a new log stream for the current day if it doesn't exist.
-        dateStr = datetime.datetime.now().strftime("%Y-%m-%d")
-        logStreamName = f'{clusterName}-monitor-ontap-services-{dateStr}'
-        #
-        # Don't ask me why AWS puts a ":*" at the end of the log group ARN, but they do.
-        logGroupName = config["cloudWatchLogGroupArn"].split(":")[-2] if config["cloudWatchLogGroupArn"].endswith(":*") else config["cloudWatchLogGroupArn"].split(":")[-1]
-        #
-        # Check to see if the log stream already exists.
-        logStreams = cloudWatchClient.describe_log_streams(logGroupName=logGroupName, logStreamNamePrefix=logStreamName)
-        if len(logStreams["logStreams"]) == 0:
-            cloudWatchClient.create_log_stream(
-                logGroupName=logGroupName,
-                logStreamName=logStreamName)
-        #
-        # Send the message to CloudWatch.
-        cloudWatchClient.put_log_events(
-            logGroupName=logGroupName,
-            logStreamName=logStreamName,
-            logEvents=[
-                {
-                    'timestamp': int(datetime.datetime.now().timestamp() * 1000),
-                    'message': message
-                },
-            ]
-        )
+    ctx.metrics.count("alertsSent")
+    ctx.alerts.add(message, severity)
 
 ################################################################################
-# This function is used to check utilization of quota limits.
+# This function returns the description of what a quota report record
+# applies to, used in the alert messages. I.e. the qtree and users, if any.
 ################################################################################
-def processQuotaUtilization(service):
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
+def getQuotaTarget(record):
+    if record.get("qtree") is not None:
+        qtree=f' under qtree: {record["qtree"]["name"]} '
+    else:
+        qtree=' '
+    if record.get("users") is not None:
+        users = ",".join(user["name"] for user in record["users"])
+        user=f'associated with user(s) "{users}" '
+    else:
+        user=''
+    return f'{qtree}{user}'
 
-    changedEvents=False
+################################################################################
+# This function is used to check utilization of quota limits. Since the quota
+# report can have tens of thousands of entries, it is processed a page at a
+# time, and each record is checked against all the rules as soon as it is
+# received, so only one page has to be held in memory.
+################################################################################
+def processQuotaUtilization(ctx, service):
+    global logger
     #
     # Get the saved events so we can ensure we are only reporting on new ones.
+    events = ctx.stateStore.getHistory("quotaEvents")
+    #
+    # Consolidate the rules so it only has to be done once instead of for every record.
+    inodeRules = []
+    hardSpaceRules = []
+    softSpaceRules = []
+    for rule in service["rules"]:
+        for key in rule.keys():
+            lkey = key.lower() # Convert to all lower case so the key can be case insensitive.
+            if lkey == "maxquotainodespercentused":
+                inodeRules.append((key, rule[key]))
+            elif lkey == "maxhardquotaspacepercentused":
+                hardSpaceRules.append((key, rule[key]))
+            elif lkey == "maxsoftquotaspacepercentused":
+                softSpaceRules.append((key, rule[key]))
+            else:
+                message = f'Unknown quota matching condition type "{key}".'
+                logger.warning(message)
+    if len(inodeRules) == 0 and len(hardSpaceRules) == 0 and len(softSpaceRules) == 0:
+        return
+    #
+    # Run the API call to get the quota report. Only the percentages are needed from the space and files usage.
+    fields = "index,type,svm.name,volume.name,qtree.name,users.name,space.used.hard_limit_percent,space.used.soft_limit_percent,files.used.hard_limit_percent"
     try:
-        data = s3Client.get_object(Key=config["quotaEventsFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then it will get created once an alert it sent.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            events = []
-        else:
-            raise err
-    else:
-        events = json.loads(data["Body"].read().decode('UTF-8'))
-    #
-    # Decrement the refresh field to know if any records have really gone away.
-    for event in events:
-        event["refresh"] -= 1
-    #
-    # Run the API call to get the quota report.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/storage/quota/reports?fields=*&return_timeout=30'
-    response = http.request('GET', endpoint, headers=headers)
-    if response.status == 200:
-        data = json.loads(response.data)
-        for record in data["records"]:
-            for rule in service["rules"]:
-                for key in rule.keys():
-                    lkey = key.lower() # Convert to all lower case so the key can be case insensitive.
-                    if lkey == "maxquotainodespercentused":
-                        #
-                        # Since the quota report might not have the files key, and even if it does, it might not have
-                        # the hard_limit_percent" key, need to check for their existencae first.
-                        if(record.get("files") is not None and record["files"]["used"].get("hard_limit_percent") is not None and
-                                record["files"]["used"]["hard_limit_percent"] > rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                                if record.get("qtree") is not None:
-                                    qtree=f' under qtree: {record["qtree"]["name"]} '
-                                else:
-                                    qtree=' '
-                                if record.get("users") is not None:
-                                    users=None
-                                    for user in record["users"]:
-                                        if users is None:
-                                            users = user["name"]
-                                        else:
-                                            users += ',{user["name"]}'
-                                    user=f'associated with user(s) "{users}" '
-                                else:
-                                    user=''
-                                message = f'Quota Inode Usage Alert: Quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{qtree}{user}on {clusterName} is using {record["files"]["used"]["hard_limit_percent"]}% which is more than {rule[key]}% of its inodes.'
-                                sendAlert(message, "WARNING")
-                                changedEvents=True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                        }
-                                logger.debug(message)
-                                events.append(event)
-                    elif lkey == "maxhardquotaspacepercentused":
-                        if(record.get("space") is not None and record["space"]["used"].get("hard_limit_percent") and
-                                record["space"]["used"]["hard_limit_percent"] >= rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                                if record.get("qtree") is not None:
-                                    qtree=f' under qtree: {record["qtree"]["name"]} '
-                                else:
-                                    qtree=" "
-                                if record.get("users") is not None:
-                                    users=None
-                                    for user in record["users"]:
-                                        if users is None:
-                                            users = user["name"]
-                                        else:
-                                            users += ',{user["name"]}'
-                                    user=f'associated with user(s) "{users}" '
-                                else:
-                                    user=''
-                                message = f'Quota Space Usage Alert: Hard quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{qtree}{user}on {clusterName} is using {record["space"]["used"]["hard_limit_percent"]}% which is more than {rule[key]}% of its allocaed space.'
-                                sendAlert(message, "WARNING")
-                                changedEvents=True
-                                event = {
-                                        "index": uniqueIdentifier,
-                                        "message": message,
-                                        "refresh": eventResilience
-                                        }
-                                logger.debug(message)
-                                events.append(event)
-                    elif lkey == "maxsoftquotaspacepercentused":
-                        if(record.get("space") is not None and record["space"]["used"].get("soft_limit_percent") and
-                                record["space"]["used"]["soft_limit_percent"] >= rule[key]):
-                            uniqueIdentifier = str(record["index"]) + "_" + key
-                            if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
-                                if record.get("qtree") is not None:
-                                    qtree=f' under qtree: {record["qtree"]["name"]} '
-                                else:
-                                    qtree=" "
-                                if record.get("users") is not None:
-                                    users=None
-                                    for user in record["users"]:
-                                        if users is None:
-                                            users = user["name"]
-                                        else:
-                                            users += ',{user["name"]}'
-                                    user=f'associated with user(s) "{users}" '
-                                else:
-                                    user=''
-                                message = f'Quota Space Usage Alert: Soft quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{qtree}{user}on {clusterName} is using {record["space"]["used"]["soft_limit_percent"]}% which is more than {rule[key]}% of its allocaed space.'
-                                sendAlert(message, "WARNING")
-                                changedEvents=True
-                                event = {
+        for record in ctx.getRecords("/api/storage/quota/reports", fields, returnTimeout=30):
+            #
+            # Since the quota report might not have the files or space keys, and even if it does, it might not
+            # have the hard_limit_percent or soft_limit_percent keys, need to check for their existence first.
+            inodesPercent = record["files"]["used"].get("hard_limit_percent") if record.get("files") is not None else None
+            spaceUsed = record["space"]["used"] if record.get("space") is not None else {}
+            hardSpacePercent = spaceUsed.get("hard_limit_percent")
+            softSpacePercent = spaceUsed.get("soft_limit_percent")
+
+            if inodesPercent is not None:
+                for key, threshold in inodeRules:
+                    if inodesPercent > threshold:
+                        uniqueIdentifier = str(record["index"]) + "_" + key
+                        if not events.exists(uniqueIdentifier):
+                            message = f'Quota Inode Usage Alert: Quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{getQuotaTarget(record)}on {ctx.clusterName} is using {inodesPercent}% which is more than {threshold}% of its inodes.'
+                            sendAlert(ctx, message, "WARNING")
+                            event = {
                                     "index": uniqueIdentifier,
-                                    "message": message,
-                                    "refresh": eventResilience
-                                }
-                                logger.debug(message)
-                                events.append(event)
-                    else:
-                        message = f'Unknown quota matching condition type "{key}".'
-                        logger.warning(message)
+                                    "message": message
+                                    }
+                            logger.debug(message)
+                            events.add(event)
+
+            if hardSpacePercent:
+                for key, threshold in hardSpaceRules:
+                    if hardSpacePercent >= threshold:
+                        uniqueIdentifier = str(record["index"]) + "_" + key
+                        if not events.exists(uniqueIdentifier):
+                            message = f'Quota Space Usage Alert: Hard quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{getQuotaTarget(record)}on {ctx.clusterName} is using {hardSpacePercent}% which is more than {threshold}% of its allocaed space.'
+                            sendAlert(ctx, message, "WARNING")
+                            event = {
+                                    "index": uniqueIdentifier,
+                                    "message": message
+                                    }
+                            logger.debug(message)
+                            events.add(event)
+
+            if softSpacePercent:
+                for key, threshold in softSpaceRules:
+                    if softSpacePercent >= threshold:
+                        uniqueIdentifier = str(record["index"]) + "_" + key
+                        if not events.exists(uniqueIdentifier):
+                            message = f'Quota Space Usage Alert: Soft quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{getQuotaTarget(record)}on {ctx.clusterName} is using {softSpacePercent}% which is more than {threshold}% of its allocaed space.'
+                            sendAlert(ctx, message, "WARNING")
+                            event = {
+                                "index": uniqueIdentifier,
+                                "message": message
+                            }
+                            logger.debug(message)
+                            events.add(event)
         #
-        # After processing the records, see if any events need to be removed.
-        i=0
-        while i < len(events):
-            if events[i]["refresh"] <= 0:
-                logger.debug(f'Deleting event: {events[i]["message"]}')
-                del events[i]
-                changedEvents = True
-            else:
-                # If an event wasn't refreshed, then we need to save the new refresh count.
-                if events[i]["refresh"] != eventResilience:
-                    changedEvents = True
-                i += 1
+        # After processing the records, age the events, and save any that changed.
+        ctx.stateStore.setHistory("quotaEvents", events)
+    except OntapApiError as err:
+        logger.error(err)
         #
-        # If the events array changed, save it.
-        if(changedEvents):
-            s3Client.put_object(Key=config["quotaEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
-    else:
-        logger.error(f'API call to {endpoint} failed. HTTP status code {response.status}.')
+        # The alerts for the records processed so far have already been sent,
+        # so save them, so they aren't sent again on the next run.
+        ctx.stateStore.setHistory("quotaEvents", events, complete=False)
 
 ################################################################################
 ################################################################################
-def processVserver(service):
-    global config, s3Client, snsClient, http, headers, clusterName, logger
-
-    changedEvents=False
+def processVserver(ctx, service):
+    global logger
     #
     # Get the saved events so we can ensure we are only reporting on new ones.
-    try:
-        data = s3Client.get_object(Key=config["vserverEventsFilename"], Bucket=config["s3BucketName"])
-    except botocore.exceptions.ClientError as err:
-        # If the error is that the object doesn't exist, then it will get created once an alert it sent.
-        if err.response['Error']['Code'] == "NoSuchKey":
-            events = []
-        else:
-            raise err
-    else:
-        events = json.loads(data["Body"].read().decode('UTF-8'))
-    #
-    # Decrement the refresh field to know if any records have really gone away.
-    for event in events:
-        event["refresh"] -= 1
+    events = ctx.stateStore.getHistory("vserverEvents")
     #
     # Consolidate the rules
     vserverState = None
@@ -1153,93 +2417,81 @@ def processVserver(service):
                 cifsProtocolState = rule[key]
                 cifsProtocolStateKey = key
     #
+    # Start the API calls to get the vserver and protocol states, so they run concurrently.
+    if vserverState is not None and vserverState:
+        vservers = ctx.getRecords("/api/svm/svms", "name,state")
+    if nfsProtocolState is not None and nfsProtocolState:
+        nfsServices = ctx.getRecords("/api/protocols/nfs/services", "svm,state")
+    if cifsProtocolState is not None and cifsProtocolState:
+        cifsServices = ctx.getRecords("/api/protocols/cifs/services", "svm,enabled")
+    #
     # Check for any vservers that are down.
     if vserverState is not None and vserverState:
-        #
-        # Run the API call to get the vserver state for each vserver.
-        endpoint = f'https://{config["OntapAdminServer"]}/api/svm/svms?fields=state&return_timeout=15'
-        response = http.request('GET', endpoint, headers=headers)
-        if response.status == 200:
-            data = json.loads(response.data)
-            for record in data["records"]:
+        try:
+            for record in vservers:
                 if record["state"].lower() != "running":
                     uniqueIdentifier = str(record["uuid"]) + "_" + vserverStateKey
-                    if not eventExist(events, uniqueIdentifier):
-                        message = f'SVM State Alert: SVM {record["name"]} on {clusterName} is not online.'
-                        sendAlert(message, "WARNING")
-                        changedEvents=True
+                    if not events.exists(uniqueIdentifier):
+                        message = f'SVM State Alert: SVM {record["name"]} on {ctx.clusterName} is not online.'
+                        sendAlert(ctx, message, "WARNING")
                         event = {
                                 "index": uniqueIdentifier,
-                                "message": message,
-                                "refresh": eventResilience
+                                "message": message
                                 }
-                        events.append(event)
-        else:
-            logger.error(f'API call to {endpoint} failed. HTTP status code {response.status}.')
+                        events.add(event)
+        except OntapApiError as err:
+            logger.error(err)
 
     if nfsProtocolState is not None and nfsProtocolState:
-        #
-        # Run the API call to get the NFS protocol state for each vserver.
-        endpoint = f'https://{config["OntapAdminServer"]}/api/protocols/nfs/services?fields=state&return_timeout=15'
-        response = http.request('GET', endpoint, headers=headers)
-        if response.status == 200:
-            data = json.loads(response.data)
-            for record in data["records"]:
+        try:
+            for record in nfsServices:
                 if record["state"].lower() != "online":
                     uniqueIdentifier = str(record["svm"]["uuid"]) + "_" + nfsProtocolStateKey
-                    if not eventExist(events, uniqueIdentifier):
-                        message = f'NFS Protocol State Alert: NFS protocol on {record["svm"]["name"]} on {clusterName} is not online.'
-                        sendAlert(message, "WARNING")
-                        changedEvents=True
+                    if not events.exists(uniqueIdentifier):
+                        message = f'NFS Protocol State Alert: NFS protocol on {record["svm"]["name"]} on {ctx.clusterName} is not online.'
+                        sendAlert(ctx, message, "WARNING")
                         event = {
                                 "index": uniqueIdentifier,
-                                "message": message,
-                                "refresh": eventResilience
+                                "message": message
                                 }
-                        events.append(event) 
-        else:
-            logger.error(f'API call to {endpoint} failed. HTTP status code {response.status}.')
+                        events.add(event)
+        except OntapApiError as err:
+            logger.error(err)
 
     if cifsProtocolState is not None and cifsProtocolState:
-        #
-        # Run the API call to get the NFS protocol state for each vserver.
-        endpoint = f'https://{config["OntapAdminServer"]}/api/protocols/cifs/services?fields=enabled&return_timeout=15'
-        response = http.request('GET', endpoint, headers=headers)
-        if response.status == 200:
-            data = json.loads(response.data)
-            for record in data["records"]:
+        try:
+            for record in cifsServices:
                 if not record["enabled"]:
                     uniqueIdentifier = str(record["svm"]["uuid"]) + "_" + cifsProtocolStateKey
-                    if not eventExist(events, uniqueIdentifier):
-                        message = f'CIFS Protocol State Alert: CIFS protocol on {record["svm"]["name"]} on {clusterName} is not online.'
-                        sendAlert(message, "WARNING")
-                        changedEvents=True
+                    if not events.exists(uniqueIdentifier):
+                        message = f'CIFS Protocol State Alert: CIFS protocol on {record["svm"]["name"]} on {ctx.clusterName} is not online.'
+                        sendAlert(ctx, message, "WARNING")
                         event = {
                                 "index": uniqueIdentifier,
-                                "message": message,
-                                "refresh": eventResilience
+                                "message": message
                                 }
-                        events.append(event) 
-        else:
-            logger.error(f'API call to {endpoint} failed. HTTP status code {response.status}.')
+                        events.add(event)
+        except OntapApiError as err:
+            logger.error(err)
 
     #
-    # After processing the records, see if any events need to be removed.
-    i=0
-    while i < len(events):
-        if events[i]["refresh"] <= 0:
-            logger.debug(f'Deleting event: {events[i]["message"]}')
-            del events[i]
-            changedEvents = True
-        else:
-            # If an event wasn't refreshed, then we need to save the new refresh count.
-            if events[i]["refresh"] != eventResilience:
-                changedEvents = True
-            i += 1
-    #
-    # If the events array changed, save it.
-    if(changedEvents):
-        s3Client.put_object(Key=config["vserverEventsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(events).encode('UTF-8'))
+    # After processing the records, age the events, and save any that changed.
+    ctx.stateStore.setHistory("vserverEvents", events)
+
+################################################################################
+# This dictionary maps the name of a service, as used in the matching
+# conditions, to the function that checks it. The services are started in
+# this order, most important first, so if a run is running out of time, it's
+# the least important ones that get skipped.
+################################################################################
+serviceCheckers = {
+    "systemhealth": checkSystemHealth,
+    "ems": processEMSEvents,
+    "vserver": processVserver,
+    "snapmirror": processSnapMirrorRelationships,
+    "storage": processStorageUtilization,
+    "quota": processQuotaUtilization
+}
 
 ################################################################################
 # This function returns the index of the service in the conditions dictionary.
@@ -1259,9 +2511,6 @@ def getServiceIndex(targetService, conditions):
 # environment variables passed in.
 ################################################################################
 def buildDefaultMatchingConditions():
-    #
-    # Define global variables so we don't have to pass them to all the functions.
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
     #
     # Define an empty matching conditions dictionary.
     conditions = { "services": [
@@ -1369,6 +2618,179 @@ def buildDefaultMatchingConditions():
 
     return conditions
 
+################################################################################
+# Define dictionaries with all the configuration variables so we can easily
+# add them and check for their existence.
+################################################################################
+requiredEnvVariables = {
+    "OntapAdminServer": None,   # Not required when monitoring a fleet of clusters.
+    "s3BucketName": None,
+    "s3BucketRegion": None
+    }
+
+optionalVariables = {
+    "configFilename": None,
+    "secretsManagerEndPointHostname": None,
+    "snsEndPointHostname": None,
+    "cloudWatchLogsEndPointHostname": None,
+    "syslogIP": None,
+    "cloudWatchLogGroupArn": None,
+    "awsAccountId": None,
+    "compressState": None,
+    "maxConcurrentServices": None,
+    "fleetManifestFilename": None,
+    "fleetDiscoveryRegion": None,
+    "maxConcurrentClusters": None,
+    "clusterTimeoutSeconds": None,
+    "smScheduleCacheSeconds": None,
+    "maxRecordsPerPage": None,
+    "snsDigest": None,
+    "alertBatchSeconds": None,
+    "metricsFormat": None,
+    "cacheSeconds": None,
+    "emsPushUrl": None,
+    "emsPushToken": None,
+    "capacityHistorySamples": None,
+    "capacityHistoryIntervalMinutes": None,
+    "ontapRequestTimeoutSeconds": None,
+    "stateJournalMaxRatio": None,
+    "maxConcurrentRequests": None,
+    "deadlineMarginSeconds": None
+    }
+
+filenameVariables = {
+    "emsEventsFilename": None,
+    "smEventsFilename": None,
+    "smRelationshipsFilename": None,
+    "conditionsFilename": None,
+    "storageEventsFilename": None,
+    "quotaEventsFilename": None,
+    "systemStatusFilename": None,
+    "vserverEventsFilename": None,
+    "stateFilename": None
+    }
+
+################################################################################
+# This function returns True if the program has been configured to monitor a
+# fleet of clusters, instead of just the one set by OntapAdminServer.
+################################################################################
+def isFleetMode(config):
+    return config["fleetManifestFilename"] is not None or config["fleetDiscoveryRegion"] is not None
+
+################################################################################
+# This function fills in the names of the S3 objects, used to store the state
+# and the matching conditions of a cluster, that haven't already been set.
+################################################################################
+def setDefaultFilenames(clusterConfig):
+    for filename in filenameVariables:
+        if clusterConfig[filename] is None:
+            clusterConfig[filename] = clusterConfig["OntapAdminServer"] + "-" + filename.replace("Filename", "")
+
+################################################################################
+# This function checks that all the configuration parameters required to
+# monitor a cluster have been set.
+################################################################################
+def checkClusterConfig(clusterConfig):
+    for key in clusterConfig:
+        if clusterConfig[key] is None and key not in optionalVariables:
+            raise Exception(f'\n\nMissing configuration parameter "{key}".\n\n')
+
+################################################################################
+# This function returns a boto3 client for the AWS service. The clients are
+# created once and reused, including by later invocations of a warm Lambda.
+################################################################################
+def getAwsClient(service, region, endpointHostname=None):
+    key = (service, region, endpointHostname)
+    with warmCacheLock:
+        client = awsClients.get(key)
+        if client is None:
+            if endpointHostname is None:
+                client = boto3.client(service, region_name=region)
+            else:
+                client = boto3.client(service, region_name=region, endpoint_url=f'https://{endpointHostname}')
+            awsClients[key] = client
+    return client
+
+################################################################################
+# This function returns the number of seconds S3 objects and secrets should
+# be cached for.
+################################################################################
+def getCacheSeconds():
+    if config is not None and config.get("cacheSeconds") is not None:
+        return float(config["cacheSeconds"])
+    return defaultCacheSeconds
+
+################################################################################
+# This function returns the contents of an object in S3. The contents are
+# cached, and for cacheSeconds they are used without checking S3. After that,
+# S3 is asked for the object only if its ETag has changed. It raises the
+# botocore ClientError from S3 if the object can't be retrieved. An object
+# that doesn't exist is remembered for cacheSeconds as well.
+################################################################################
+def getS3Object(bucket, key, metrics=None):
+    with warmCacheLock:
+        cached = s3ObjectCache.get((bucket, key))
+    if cached is not None and time.monotonic() - cached["checked"] < getCacheSeconds():
+        if cached["error"] is not None:
+            raise cached["error"]
+        return cached["body"]
+
+    if metrics is not None:
+        metrics.count("s3Reads")
+    try:
+        if cached is not None and cached["etag"] is not None:
+            data = s3Client.get_object(Key=key, Bucket=bucket, IfNoneMatch=cached["etag"])
+        else:
+            data = s3Client.get_object(Key=key, Bucket=bucket)
+    except botocore.exceptions.ClientError as err:
+        if cached is not None and err.response['Error']['Code'] in ("304", "NotModified"):
+            cached["checked"] = time.monotonic()
+            return cached["body"]
+        if err.response['Error']['Code'] == "NoSuchKey":
+            with warmCacheLock:
+                s3ObjectCache[(bucket, key)] = {"body": None, "etag": None, "error": err, "checked": time.monotonic()}
+        raise err
+
+    body = data["Body"].read()
+    with warmCacheLock:
+        s3ObjectCache[(bucket, key)] = {"body": body, "etag": data["ETag"], "error": None, "checked": time.monotonic()}
+    return body
+
+################################################################################
+# This function updates an object in S3, and the cached copy of it.
+################################################################################
+def putS3Object(bucket, key, body):
+    response = s3Client.put_object(Key=key, Bucket=bucket, Body=body)
+    with warmCacheLock:
+        s3ObjectCache[(bucket, key)] = {"body": body, "etag": response["ETag"], "error": None, "checked": time.monotonic()}
+
+################################################################################
+# This function returns the username and password stored in the secret for a
+# cluster. They are reused for cacheSeconds before being retrieved again.
+# It returns None if the secret doesn't contain them.
+################################################################################
+def getCredentials(clusterConfig):
+    with warmCacheLock:
+        cached = secretsCache.get(clusterConfig["secretArn"])
+    if cached is None or time.monotonic() - cached["retrieved"] >= getCacheSeconds():
+        secretRegion = clusterConfig["secretArn"].split(":")[3]
+        client = getAwsClient('secretsmanager', secretRegion, clusterConfig["secretsManagerEndPointHostname"])
+        secretsInfo = client.get_secret_value(SecretId=clusterConfig["secretArn"])
+        cached = {"secrets": json.loads(secretsInfo['SecretString']), "retrieved": time.monotonic()}
+        with warmCacheLock:
+            secretsCache[clusterConfig["secretArn"]] = cached
+
+    secrets = cached["secrets"]
+    if secrets.get(clusterConfig['secretUsernameKey']) is None:
+        logger.critical(f'Error, "{clusterConfig["secretUsernameKey"]}" not found in secret "{clusterConfig["secretArn"]}".')
+        return None
+
+    if secrets.get(clusterConfig['secretPasswordKey']) is None:
+        logger.critical(f'Error, "{clusterConfig["secretPasswordKey"]}" not found in secret "{clusterConfig["secretArn"]}".')
+        return None
+
+    return (secrets[clusterConfig['secretUsernameKey']], secrets[clusterConfig['secretPasswordKey']])
+
 ################################################################################
 # This function is used to read in all the configuration parameters from the
 # various places:
@@ -1379,36 +2801,7 @@ def buildDefaultMatchingConditions():
 def readInConfig():
     #
     # Define global variables so we don't have to pass them to all the functions.
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
-    #
-    # Define a dictionary with all the required variables so we can
-    # easily add them and check for their existence.
-    requiredEnvVariables = {
-        "OntapAdminServer": None,
-        "s3BucketName": None,
-        "s3BucketRegion": None
-        }
-
-    optionalVariables = {
-        "configFilename": None,
-        "secretsManagerEndPointHostname": None,
-        "snsEndPointHostname": None,
-        "cloudWatchLogsEndPointHostname": None,
-        "syslogIP": None,
-        "cloudWatchLogGroupArn": None,
-        "awsAccountId": None
-        }
-
-    filenameVariables = {
-        "emsEventsFilename": None,
-        "smEventsFilename": None,
-        "smRelationshipsFilename": None,
-        "conditionsFilename": None,
-        "storageEventsFilename": None,
-        "quotaEventsFilename": None,
-        "systemStatusFilename": None,
-        "vserverEventsFilename": None
-        }
+    global config, s3Client, logger
 
     config = {
         "snsTopicArn": None,
@@ -1438,20 +2831,20 @@ def readInConfig():
     #
     # Check that required environmental variables are there.
     for var in requiredEnvVariables:
-        if config[var] is None:
+        if config[var] is None and not (var == "OntapAdminServer" and isFleetMode(config)):
             raise Exception (f'\n\nMissing required environment variable "{var}".')
     #
     # Open a client to the s3 service.
-    s3Client = boto3.client('s3', config["s3BucketRegion"])
+    s3Client = getAwsClient('s3', config["s3BucketRegion"])
     #
     # Calculate the config filename if it hasn't already been provided.
-    defaultConfigFilename = config["OntapAdminServer"] + "-config"
+    defaultConfigFilename = (config["OntapAdminServer"] if config["OntapAdminServer"] is not None else "fleet") + "-config"
     if config["configFilename"] is None:
         config["configFilename"] = defaultConfigFilename
     #
     # Process the config file if it exist.
     try:
-        lines = s3Client.get_object(Key=config["configFilename"], Bucket=config["s3BucketName"])['Body'].iter_lines()
+        lines = getS3Object(config["s3BucketName"], config["configFilename"]).splitlines()
     except botocore.exceptions.ClientError as err:
         if err.response['Error']['Code'] != "NoSuchKey":
             raise err
@@ -1483,10 +2876,10 @@ def readInConfig():
                 else:
                     logger.warning(f"Warning, unknown config parameter '{key}'.")
     #
-    # Now, fill in the filenames for any that aren't already defined.
-    for filename in filenameVariables:
-        if config[filename] is None:
-            config[filename] = config["OntapAdminServer"] + "-" + filename.replace("Filename", "")
+    # Now, fill in the filenames for any that aren't already defined. When
+    # monitoring a fleet of clusters, that is done for each cluster.
+    if not isFleetMode(config):
+        setDefaultFilenames(config)
     #
     # Define endpoints if alternates weren't provided.
     if config.get("secretArn") is not None and config["secretsManagerEndPointHostname"] is None:
@@ -1502,9 +2895,402 @@ def readInConfig():
         config["cloudWatchLogsEndPointHostname"] = f'logs.{cloudWatchRegion}.amazonaws.com'
     #
     # Now, check that all the configuration parameters have been set.
-    for key in config:
-        if config[key] is None and key not in optionalVariables:
-            raise Exception(f'\n\nMissing configuration parameter "{key}".\n\n')
+    if not isFleetMode(config):
+        checkClusterConfig(config)
+
+################################################################################
+# This function returns the configuration for one cluster of the fleet. It is
+# a copy of the configuration read in by readInConfig() with the settings for
+# the cluster, from the fleet manifest or the FSx API, applied on top. The
+# state of each cluster is always kept in its own S3 objects.
+################################################################################
+def buildClusterConfig(clusterEntry):
+    global config, logger
+
+    clusterConfig = dict(config)
+    for filename in filenameVariables:
+        if filename != "conditionsFilename":
+            clusterConfig[filename] = None
+
+    for key, value in clusterEntry.items():
+        if key in clusterConfig:
+            clusterConfig[key] = value
+        elif key != "fileSystemId":
+            logger.warning(f'Warning, unknown parameter "{key}" for cluster "{clusterEntry.get("OntapAdminServer")}" in the fleet manifest.')
+    #
+    # If the cluster's secret, SNS topic, or CloudWatch log group is in a
+    # different region, the default endpoint won't work for it.
+    for arnKey, endpointKey, service in (("secretArn", "secretsManagerEndPointHostname", "secretsmanager"),
+                                         ("snsTopicArn", "snsEndPointHostname", "sns"),
+                                         ("cloudWatchLogGroupArn", "cloudWatchLogsEndPointHostname", "logs")):
+        if (clusterEntry.get(arnKey) is not None and clusterEntry.get(endpointKey) is None and
+                (config[arnKey] is None or config[arnKey].split(":")[3] != clusterEntry[arnKey].split(":")[3])):
+            clusterConfig[endpointKey] = f'{service}.{clusterEntry[arnKey].split(":")[3]}.amazonaws.com'
+
+    setDefaultFilenames(clusterConfig)
+    checkClusterConfig(clusterConfig)
+    return clusterConfig
+
+################################################################################
+# This function returns the fleet manifest, or an empty list if there isn't
+# one.
+################################################################################
+def getFleetManifest():
+    global config
+
+    if config["fleetManifestFilename"] is None:
+        return []
+    return json.loads(getS3Object(config["s3BucketName"], config["fleetManifestFilename"]).decode('UTF-8'))
+
+################################################################################
+# This function returns the fleet entry for an FSx for ONTAP file system
+# found by discovery, with the settings from any matching manifest entry
+# applied to it.
+################################################################################
+def getDiscoveredClusterEntry(fileSystem, manifest):
+    clusterEntry = {
+        "OntapAdminServer": fileSystem["OntapConfiguration"]["Endpoints"]["Management"]["DNSName"],
+        "fileSystemId": fileSystem["FileSystemId"]
+    }
+    for manifestEntry in manifest:
+        if manifestEntry.get("fileSystemId") == clusterEntry["fileSystemId"] or manifestEntry.get("OntapAdminServer") == clusterEntry["OntapAdminServer"]:
+            clusterEntry.update(manifestEntry)
+    return clusterEntry
+
+################################################################################
+# This function returns the configuration of a single cluster of the fleet,
+# without building the configuration of all of them. With discovery, the
+# file system ID is taken from the management DNS name, which is in the form
+# management.<fileSystemId>.fsx.<region>.amazonaws.com, so only that file
+# system has to be described. It returns None if the cluster isn't part of
+# the fleet.
+################################################################################
+def getFleetCluster(ontapAdminServer):
+    global config, logger
+
+    if ontapAdminServer is None:
+        return None
+
+    manifest = getFleetManifest()
+    if config["fleetDiscoveryRegion"] is not None:
+        clusterEntry = None
+        fileSystemIds = [entry["fileSystemId"] for entry in manifest if entry.get("OntapAdminServer") == ontapAdminServer and entry.get("fileSystemId") is not None]
+        if len(ontapAdminServer.split(".")) > 1 and ontapAdminServer.split(".")[1].startswith("fs-"):
+            fileSystemIds.append(ontapAdminServer.split(".")[1])
+        fsxClient = getAwsClient('fsx', config["fleetDiscoveryRegion"])
+        for fileSystemId in fileSystemIds:
+            try:
+                fileSystems = fsxClient.describe_file_systems(FileSystemIds=[fileSystemId])["FileSystems"]
+            except botocore.exceptions.ClientError as err:
+                if err.response['Error']['Code'] != "FileSystemNotFound":
+                    raise err
+                continue
+            for fileSystem in fileSystems:
+                if fileSystem["FileSystemType"] == "ONTAP":
+                    #
+                    # The manifest might have replaced the management DNS name.
+                    discoveredEntry = getDiscoveredClusterEntry(fileSystem, manifest)
+                    if discoveredEntry["OntapAdminServer"] == ontapAdminServer:
+                        clusterEntry = discoveredEntry
+            if clusterEntry is not None:
+                break
+    else:
+        clusterEntry = next((entry for entry in manifest if entry.get("OntapAdminServer") == ontapAdminServer), None)
+
+    if clusterEntry is None:
+        return None
+    try:
+        return buildClusterConfig(clusterEntry)
+    except Exception as err:
+        logger.error(f'Error, skipping cluster "{ontapAdminServer}": {err}')
+        return None
+
+################################################################################
+# This function returns the list of clusters to monitor when in fleet mode.
+# The clusters either come from the fleet manifest, a JSON file in the S3
+# bucket that contains a list of objects, each with at least the
+# "OntapAdminServer" key, and optionally any other configuration parameter
+# specific to that cluster (e.g. "secretArn"). Or, if fleetDiscoveryRegion is
+# set, from all the FSx for ONTAP file systems in that region. In that case,
+# the manifest, if provided, is used to set parameters for specific file
+# systems, matched by either their "fileSystemId" or "OntapAdminServer".
+################################################################################
+def getFleetClusters():
+    global config, s3Client, logger
+
+    manifest = getFleetManifest()
+    if config["fleetDiscoveryRegion"] is not None:
+        clusterEntries = []
+        fsxClient = getAwsClient('fsx', config["fleetDiscoveryRegion"])
+        for page in fsxClient.get_paginator('describe_file_systems').paginate():
+            for fileSystem in page["FileSystems"]:
+                if fileSystem["FileSystemType"] == "ONTAP":
+                    clusterEntries.append(getDiscoveredClusterEntry(fileSystem, manifest))
+    else:
+        clusterEntries = manifest
+
+    clusters = []
+    for clusterEntry in clusterEntries:
+        if clusterEntry.get("OntapAdminServer") is None:
+            logger.warning(f'Warning, skipping fleet manifest entry without an "OntapAdminServer": {clusterEntry}')
+            continue
+        try:
+            clusters.append(buildClusterConfig(clusterEntry))
+        except Exception as err:
+            logger.error(f'Error, skipping cluster "{clusterEntry["OntapAdminServer"]}": {err}')
+    return clusters
+
+################################################################################
+# This function returns the conditions to alert on for a cluster. If the
+# matching conditions file doesn't exist, one is created based on the
+# environment variables. It returns None if the file can't be decoded.
+################################################################################
+def getMatchingConditions(clusterConfig, metrics):
+    global s3Client, logger
+
+    try:
+        matchingConditions = json.loads(getS3Object(clusterConfig["s3BucketName"], clusterConfig["conditionsFilename"], metrics).decode('UTF-8'))
+    except botocore.exceptions.ClientError as err:
+        if err.response['Error']['Code'] != "NoSuchKey":
+            logger.error(f'Error, could not retrieve configuration file {clusterConfig["conditionsFilename"]} from: s3://{clusterConfig["s3BucketName"]}.\nBelow is additional information:')
+            raise err
+        else:
+            matchingConditions = buildDefaultMatchingConditions()
+            metrics.count("s3Writes")
+            putS3Object(clusterConfig["s3BucketName"], clusterConfig["conditionsFilename"], json.dumps(matchingConditions, indent=4).encode('UTF-8'))
+    except json.decoder.JSONDecodeError as err:
+        logger.error(f'Error, could not decode JSON from configuration file "{clusterConfig["conditionsFilename"]}". The error message from the decoder:\n{err}\n')
+        return None
+
+    return matchingConditions
+
+################################################################################
+# This function runs a service check, recording how long it takes. If the run
+# is out of time, the service is skipped, and that is recorded in the metrics.
+# So is a service that runs out of time while being checked. Either way, the
+# state of the service isn't updated.
+################################################################################
+def runChecker(ctx, checker, service):
+    global logger
+
+    ctx.metrics.setService(service["name"])
+    if ctx.deadline.expired():
+        logger.warning(f'Warning, skipping service "{service["name"]}" on {ctx.config["OntapAdminServer"]} since the run is out of time.')
+        ctx.metrics.count("servicesSkipped")
+        return
+    startTime = time.monotonic()
+    try:
+        checker(ctx, service)
+    except DeadlineExceeded:
+        logger.warning(f'Warning, ran out of time checking service "{service["name"]}" on {ctx.config["OntapAdminServer"]}.')
+        ctx.metrics.count("servicesSkipped")
+    finally:
+        ctx.metrics.recordDuration(time.monotonic() - startTime)
+
+################################################################################
+# This function outputs the metrics collected during the run, as a single
+# line, so they end up in the Lambda function's CloudWatch log. If
+# metricsFormat is set to "emf", they are output in the CloudWatch Embedded
+# Metric Format, one line per cluster and service, so CloudWatch turns them
+# into metrics. If it is set to "none", nothing is output. Otherwise, all the
+# metrics are output as one JSON line.
+################################################################################
+def emitMetrics(runDuration):
+    global config
+
+    metricsFormat = config["metricsFormat"].lower() if config["metricsFormat"] is not None else "json"
+    if metricsFormat == "none":
+        return
+
+    with runMetricsLock:
+        summaries = [metrics.summary() for metrics in runMetrics]
+
+    if metricsFormat != "emf":
+        print(json.dumps({"monitorOntapServicesMetrics": {"durationMs": round(runDuration * 1000), "clusters": summaries}}, separators=(',', ':')), flush=True)
+        return
+
+    timestamp = int(time.time() * 1000)
+    for summary in summaries:
+        for service, serviceMetrics in summary["services"].items():
+            endpoints = serviceMetrics["endpoints"].values()
+            values = {
+                "Duration": (round(serviceMetrics["durationMs"]), "Milliseconds"),
+                "ApiCalls": (sum(endpoint["calls"] for endpoint in endpoints), "Count"),
+                "ApiBytes": (sum(endpoint["bytes"] for endpoint in endpoints), "Bytes"),
+                "ApiLatency": (round(sum(endpoint["latencyMs"] for endpoint in endpoints)), "Milliseconds"),
+                "ApiMaxLatency": (round(max([endpoint["maxLatencyMs"] for endpoint in endpoints], default=0)), "Milliseconds")
+            }
+            for counter, value in serviceMetrics["counters"].items():
+                values[counter[0].upper() + counter[1:]] = (value, "Bytes" if "Bytes" in counter else "Count")
+
+            line = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": "MonitorOntapServices",
+                        "Dimensions": [["Cluster", "Service"]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in values.items()]
+                    }]
+                },
+                "Cluster": summary["cluster"],
+                "Service": service,
+                "endpoints": serviceMetrics["endpoints"]
+            }
+            for name, (value, _) in values.items():
+                line[name] = value
+            print(json.dumps(line, separators=(',', ':')), flush=True)
+
+################################################################################
+# This function monitors all the configured services on one cluster. If the
+# 'cancelled' event is set, because the cluster took too long to process, the
+# state is not saved since it might be overwriting a later run. The ONTAP API
+# calls are limited by the 'deadline', so there is time left to deliver the
+# alerts and save the state of the services that did complete.
+################################################################################
+def monitorCluster(clusterConfig, http, cancelled=None, deadline=None):
+    global s3Client, logger
+    #
+    # Get the username and password of the ONTAP/FSxN system.
+    credentials = getCredentials(clusterConfig)
+    if credentials is None:
+        return
+    (username, password) = credentials
+    #
+    # Create the headers to make ONTAP/FSxN API calls with.
+    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
+    headers = { **auth, 'Content-Type': 'application/json' }
+    #
+    # Keep track of where the time is spent.
+    metrics = RunMetrics(clusterConfig["OntapAdminServer"])
+    with runMetricsLock:
+        runMetrics.append(metrics)
+    metrics.setService("setup")
+    #
+    # Get the conditions we know what to alert on.
+    matchingConditions = getMatchingConditions(clusterConfig, metrics)
+    if matchingConditions is None:
+        return
+    #
+    # Get the state saved from the previous runs.
+    stateStore = StateStore(s3Client, clusterConfig, metrics)
+    stateStore.load()
+    ctx = ClusterContext(clusterConfig, http, headers, stateStore, metrics, deadline)
+
+    failedServices = []
+    metrics.setService("checkSystem")
+    startTime = time.monotonic()
+    try:
+        systemUp = checkSystem(ctx)
+    except DeadlineExceeded:
+        logger.warning(f'Warning, ran out of time checking {clusterConfig["OntapAdminServer"]}. Skipping all its services.')
+        metrics.count("servicesSkipped")
+        systemUp = False
+    metrics.recordDuration(time.monotonic() - startTime)
+    if systemUp:
+        #
+        # Check all the configured ONTAP services concurrently, since they
+        # spend most of their time waiting on ONTAP API calls.
+        maxConcurrentServices = int(clusterConfig["maxConcurrentServices"]) if clusterConfig["maxConcurrentServices"] is not None else len(serviceCheckers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrentServices) as executor:
+            futures = {}
+            priorities = list(serviceCheckers.keys())
+            for service in sorted(matchingConditions["services"], key=lambda service: priorities.index(service["name"].lower()) if service["name"].lower() in priorities else len(priorities)):
+                checker = serviceCheckers.get(service["name"].lower())
+                if checker is None:
+                    logger.warning(f'Unknown service "{service["name"]}".')
+                else:
+                    futures[executor.submit(runChecker, ctx, checker, service)] = service["name"]
+            #
+            # Don't let a failure of one service prevent the others from completing.
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.error(f'Error, failed to check service "{futures[future]}" on {clusterConfig["OntapAdminServer"]}: {err}')
+                    failedServices.append(err)
+    ctx.close()
+    #
+    # Deliver the alerts. If that fails, don't save the state, so they will be
+    # generated again on the next run instead of being lost.
+    metrics.setService("delivery")
+    try:
+        ctx.alerts.flush()
+    except Exception as err:
+        logger.error(f'Error, failed to deliver the alerts for {clusterConfig["OntapAdminServer"]}: {err}')
+        raise err
+    #
+    # Save any state that has changed.
+    if cancelled is not None and cancelled.is_set():
+        logger.warning(f'Warning, not saving the state of {clusterConfig["OntapAdminServer"]} since it timed out.')
+    else:
+        stateStore.flush()
+    #
+    # Now that the state of the services that succeeded has been saved, report any failure.
+    if len(failedServices) > 0:
+        raise failedServices[0]
+
+################################################################################
+# This function monitors all the clusters in the fleet concurrently, with at
+# most maxConcurrentClusters at a time. If a cluster takes longer than
+# clusterTimeoutSeconds, it is abandoned so it can't starve the others. Since
+# a thread can't be stopped, every cluster gets its own thread, so an
+# abandoned one doesn't hold up the queue. It returns the number of clusters
+# that failed.
+################################################################################
+def monitorFleet(clusters, http, deadline=None):
+    global config, logger
+
+    maxConcurrentClusters = int(config["maxConcurrentClusters"]) if config["maxConcurrentClusters"] is not None else 4
+    clusterTimeout = float(config["clusterTimeoutSeconds"]) if config["clusterTimeoutSeconds"] is not None else None
+
+    failedClusters = 0
+    pending = list(clusters)
+    running = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(clusters), 1))
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < maxConcurrentClusters:
+            clusterConfig = pending.pop(0)
+            if deadline is not None and deadline.expired():
+                #
+                # Record the cluster as skipped, so it shows up in the metrics.
+                logger.warning(f'Warning, skipping cluster {clusterConfig["OntapAdminServer"]} since the run is out of time.')
+                metrics = RunMetrics(clusterConfig["OntapAdminServer"])
+                metrics.setService("setup")
+                metrics.count("servicesSkipped")
+                with runMetricsLock:
+                    runMetrics.append(metrics)
+                continue
+            cancelled = threading.Event()
+            future = executor.submit(monitorCluster, clusterConfig, http, cancelled, deadline)
+            running[future] = (clusterConfig["OntapAdminServer"], time.monotonic(), cancelled)
+        #
+        # All the remaining clusters might have been skipped above.
+        if len(running) == 0:
+            continue
+        #
+        # Wait for a cluster to finish, or for the next one to time out.
+        waitTime = None
+        if clusterTimeout is not None:
+            waitTime = max(min(startTime for (_, startTime, _) in running.values()) + clusterTimeout - time.monotonic(), 0)
+        done, _ = concurrent.futures.wait(running, timeout=waitTime, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            clusterName = running.pop(future)[0]
+            try:
+                future.result()
+            except Exception as err:
+                logger.error(f'Error, failed to monitor cluster {clusterName}: {err}')
+                failedClusters += 1
+
+        if clusterTimeout is not None:
+            for future, (clusterName, startTime, cancelled) in list(running.items()):
+                if time.monotonic() - startTime >= clusterTimeout:
+                    logger.error(f'Error, monitoring cluster {clusterName} took more than {clusterTimeout} seconds. Abandoning it.')
+                    cancelled.set()
+                    del running[future]
+                    failedClusters += 1
+
+    executor.shutdown(wait=False)
+    return failedClusters
 
 ################################################################################
 # Main logic
@@ -1512,27 +3298,38 @@ def readInConfig():
 def lambda_handler(event, context):
     #
     # Define global variables so we don't have to pass them to all the functions.
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger, cloudWatchClient, clusterTimezone
+    global config, s3Client, logger, loggerConfigured, syslogHandler, httpPool, httpPoolSettings
     #
-    # Set up logging.
+    # Set up logging. This is only done once per container, otherwise the
+    # handlers would be added again on every warm invocation.
     logger = logging.getLogger("mon_fsxn_service")
-    if lambdaFunction:
-        logger.setLevel(logging.INFO)       # Anything at this level and above this get logged.
-    else: # Assume we are running in a test environment.
-        logger.setLevel(logging.DEBUG)      # Anything at this level and above this get logged.
-        formatter = logging.Formatter(
-                fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S"
-            )
-        loggerscreen = logging.StreamHandler()
-        loggerscreen.setFormatter(formatter)
-        logger.addHandler(loggerscreen)
+    if not loggerConfigured:
+        if lambdaFunction:
+            logger.setLevel(logging.INFO)       # Anything at this level and above this get logged.
+        else: # Assume we are running in a test environment.
+            logger.setLevel(logging.DEBUG)      # Anything at this level and above this get logged.
+            formatter = logging.Formatter(
+                    fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S"
+                )
+            loggerscreen = logging.StreamHandler()
+            loggerscreen.setFormatter(formatter)
+            logger.addHandler(loggerscreen)
+        #
+        # Disable warning about connecting to servers with self-signed SSL certificates.
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        loggerConfigured = True
     #
     # Read in the configuraiton.
     readInConfig()   # This defines the s3Client variable.
     #
-    # Set up the logger to log to a file and to syslog.
-    if config["syslogIP"] is not None:
+    # Set up the logger to log to a file and to syslog. The handler is kept
+    # for warm invocations, unless the syslog server has changed.
+    if syslogHandler is not None and (config["syslogIP"] is None or syslogHandler.address[0] != config["syslogIP"]):
+        logger.removeHandler(syslogHandler)
+        syslogHandler.close()
+        syslogHandler = None
+    if config["syslogIP"] is not None and syslogHandler is None:
         #
         # Due to a bug with the SysLogHandler() of not sending proper framing with a message
         # when using TCP (it should end it with a LF and not a NUL like it does now) you must add
@@ -1557,84 +3354,68 @@ def lambda_handler(event, context):
         #
         # You might get away with a simple handler.open() after the close(), without having to
         # remove and add the handler. I didn't test that.
-        handler = logging.handlers.SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(config["syslogIP"], 514))
+        syslogHandler = logging.handlers.SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(config["syslogIP"], 514))
         formatter = logging.Formatter(
                 fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
                 datefmt="%Y-%m-%d %H:%M:%S"
             )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        syslogHandler.setFormatter(formatter)
+        logger.addHandler(syslogHandler)
     #
-    # Create a Secrets Manager client.
-    session = boto3.session.Session()
-    secretRegion = config["secretArn"].split(":")[3]
-    client = session.client(service_name='secretsmanager', region_name=secretRegion, endpoint_url=f'https://{config["secretsManagerEndPointHostname"]}')
+    # The clients to the other AWS services are created as they are needed,
+    # since the clusters of a fleet can use different ones. The s3Client is
+    # defined in readInConfig().
     #
-    # Get the username and password of the ONTAP/FSxN system.
-    secretsInfo = client.get_secret_value(SecretId=config["secretArn"])
-    secrets = json.loads(secretsInfo['SecretString'])
-    if secrets.get(config['secretUsernameKey']) is None:
-        logger.critical(f'Error, "{config["secretUsernameKey"]}" not found in secret "{config["secretArn"]}".')
-        return
-
-    if secrets.get(config['secretPasswordKey']) is None:
-        logger.critical(f'Error, "{config["secretPasswordKey"]}" not found in secret "{config["secretArn"]}".')
-        return
-
-    username = secrets[config['secretUsernameKey']]
-    password = secrets[config['secretPasswordKey']]
+    # EMS notifications pushed by ONTAP are handled as soon as possible, so
+    # don't look up all the clusters, or set up the connections to them.
+    if isEMSPushRequest(event):
+        with runMetricsLock:
+            runMetrics.clear()
+        startTime = time.monotonic()
+        try:
+            return processEMSPush(event)
+        finally:
+            emitMetrics(time.monotonic() - startTime)
     #
-    # Create clients to the other AWS services we will be using.
-    #s3Client = boto3.client('s3', config["s3BucketRegion"])  # Defined in readInConfig()
-    snsRegion = config["snsTopicArn"].split(":")[3]
-    snsClient = boto3.client('sns', region_name=snsRegion, endpoint_url=f'https://{config["snsEndPointHostname"]}')
-    cloudWatchClient = None
-    if config["cloudWatchLogGroupArn"] is not None:
-        cloudWatchRegion = config["cloudWatchLogGroupArn"].split(":")[3]
-        cloudWatchClient = boto3.client('logs', region_name=cloudWatchRegion, endpoint_url=f'https://{config["cloudWatchLogsEndPointHostname"]}')
+    # Get the list of clusters to monitor.
+    if isFleetMode(config):
+        clusters = getFleetClusters()
+    else:
+        clusters = [config]
     #
-    # Create a http handle to make ONTAP/FSxN API calls with.
-    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
-    headers = { **auth }
+    # Create a http handle to make ONTAP/FSxN API calls with. It is kept for
+    # warm invocations, so the connections to the clusters are reused.
+    maxConcurrentServices = int(config["maxConcurrentServices"]) if config["maxConcurrentServices"] is not None else len(serviceCheckers)
     #
-    # Disable warning about connecting to servers with self-signed SSL certificates.
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
-    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries)
+    # Since the ONTAP API calls are made concurrently, allow the pool to keep a connection open for each
+    # one that can be in flight. And, since it is shared by all the clusters, allow it to keep a pool for each cluster.
+    maxConcurrentRequests = int(config["maxConcurrentRequests"]) if config["maxConcurrentRequests"] is not None else defaultMaxConcurrentRequests
+    poolSettings = (max(maxConcurrentServices, maxConcurrentRequests), max(len(clusters), 10))
+    if httpPool is None or httpPoolSettings != poolSettings:
+        if httpPool is not None:
+            httpPool.clear()
+        retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
+        httpPool = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries, maxsize=poolSettings[0], num_pools=poolSettings[1])
+        httpPoolSettings = poolSettings
+    http = httpPool
+
+    with runMetricsLock:
+        runMetrics.clear()
+    startTime = time.monotonic()
     #
-    # Get the conditions we know what to alert on.
+    # Leave time, at the end of the invocation, to deliver the alerts and save the state.
+    deadline = RunDeadline(context, float(config["deadlineMarginSeconds"]) if config["deadlineMarginSeconds"] is not None else defaultDeadlineMarginSeconds)
     try:
-        data = s3Client.get_object(Key=config["conditionsFilename"], Bucket=config["s3BucketName"])
-        matchingConditions = json.loads(data["Body"].read().decode('UTF-8'))
-    except botocore.exceptions.ClientError as err:
-        if err.response['Error']['Code'] != "NoSuchKey":
-            logger.error(f'Error, could not retrieve configuration file {config["conditionsFilename"]} from: s3://{config["s3BucketName"]}.\nBelow is additional information:')
-            raise err
+        if isFleetMode(config):
+            failedClusters = monitorFleet(clusters, http, deadline)
+            if failedClusters > 0:
+                raise Exception(f'Failed to monitor {failedClusters} of the {len(clusters)} clusters.')
         else:
-            matchingConditions = buildDefaultMatchingConditions()
-            s3Client.put_object(Key=config["conditionsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(matchingConditions, indent=4).encode('UTF-8'))
-    except json.decoder.JSONDecodeError as err:
-        logger.error(f'Error, could not decode JSON from configuration file "{config["conditionsFilename"]}". The error message from the decoder:\n{err}\n')
-        return
-
-    if(checkSystem()):
+            monitorCluster(config, http, deadline=deadline)
+    finally:
         #
-        # Loop on all the configured ONTAP services we want to check on.
-        for service in matchingConditions["services"]:
-            if service["name"].lower() == "systemhealth":
-                checkSystemHealth(service)
-            elif service["name"].lower() == "ems":
-                processEMSEvents(service)
-            elif (service["name"].lower() == "snapmirror"):
-                processSnapMirrorRelationships(service)
-            elif service["name"].lower() == "storage":
-                processStorageUtilization(service)
-            elif service["name"].lower() == "quota":
-                processQuotaUtilization(service)
-            elif service["name"].lower() == "vserver":
-                processVserver(service)
-            else:
-                logger.warning(f'Unknown service "{service["name"]}".')
+        # Report where the time was spent, even if the run failed.
+        emitMetrics(time.monotonic() - startTime)
     return
 
 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None: